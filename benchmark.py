@@ -0,0 +1,697 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmarks for khinsider.py that don't need the actual site.
+#
+# A local stand-in for KHInsider is started, serving album, song, search,
+# album list and 404 pages made to look like KHInsider's (broken HTML and
+# all), along with made-up audio files of whatever size and latency you'd
+# like. BASE_URL is pointed at it, and then the parts of khinsider.py that
+# matter are timed.
+#
+# Run "benchmark.py --help" for the options.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import gc
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, quote, unquote, urljoin, urlsplit
+except ImportError: # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import quote, unquote
+    from urlparse import parse_qs, urljoin, urlsplit
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+import requests
+
+import khinsider
+
+# Where BASE_URL points before it's pointed at the stand-in.
+REAL_BASE_URL = khinsider.BASE_URL
+# How many times the memory per track a small album takes up a large one may.
+MEMORY_GROWTH_LIMIT = 1.25
+
+
+# --- The stand-in server ---
+
+PAGE_HEADER = """<!DOCTYPE html>
+<html>
+<head><title>{title} - Download Video Game Music</title></head>
+<body>
+<div id="header"><ul>{nav}</ul></div>
+<div id="pageContent">
+"""
+
+PAGE_FOOTER = """</div>
+<div id="footer"><p>Copyright &#copy; KHInsider &#x; stand-in.</p><ul>{nav}</ul></div>
+</body>
+</html>
+"""
+
+LETTERS = "#ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+NAV = ''.join('<li><a href="/game-soundtracks/browse/{}">{}</a></li>'.format(quote(letter, safe=''), letter)
+              for letter in LETTERS)
+# Words to make up album names from.
+WORDS = ["Jumping", "Flash", "Mother", "Katamari", "Forever", "Persona", "Kirby",
+         "Metroid", "Chrono", "Sonic", "Adventure", "Quest", "Legend", "Star", "Dream"]
+
+ALBUM_ROW = """<tr>
+	<td class="playTrack"><div class="playTrack"></div></td>
+	<td class="clickable-row" align="right">{number}.</td>
+	<td class="clickable-row"><a href="{href}">{name}</a></td>
+	<td class="clickable-row" align="right"><a href="{href}">{duration}</a></td>
+	<td class="clickable-row" align="right"><a href="{href}">{mp3Size}</a></td>
+	<td class="clickable-row" align="right"><a href="{href}">{flacSize}</a></td>
+	<td class="playlistDownloadSong"><a href="{href}">get</a></td>
+</td>
+</tr>"""
+
+
+def trackName(number):
+    # KHInsider doesn't escape ampersands, so there's a stray "&#" in each.
+    return "{:02d}. Track {} &#Stand-In".format(number, number)
+
+
+def formatSize(size):
+    return "{:.2f} MB".format(size / 1024.0 / 1024.0)
+
+
+class StandIn(object):
+    """What the stand-in server serves. Albums are named "album-N", where N
+    is the number of tracks in them. Each album list (one per letter) has
+    `listSize` albums on it, plus one more for each time it's been changed
+    with changeList.
+
+    Files ending in .zip (like bonus archives) are `largeFileSize` bytes. If
+    `connectionSpeed` is set, they're sent no faster than that many bytes per
+    second per connection, like from a CDN limiting each connection.
+    """
+
+    def __init__(self, fileSize=1024 * 1024, latency=0.0, nonexistentTrack=None,
+                 capacity=None, listSize=500, largeFileSize=64 * 1024 * 1024,
+                 connectionSpeed=None):
+        self.fileSize = fileSize
+        self.latency = latency
+        # This track number's page redirects to /404, like deleted songs.
+        self.nonexistentTrack = nonexistentTrack
+        # With more requests than this at once, the rest get 503s.
+        self.capacity = capacity
+        self.busyResponses = 0
+        self.listSize = listSize
+        self.largeFileSize = largeFileSize
+        self.connectionSpeed = connectionSpeed
+        self.listVersions = dict((letter, 0) for letter in LETTERS)
+        self.host = None
+        self._active = 0
+        self._lock = threading.Lock()
+        self._fileData = os.urandom(min(fileSize, 1024 * 1024))
+
+    def albumTracks(self, albumId):
+        m = re.match(r'^album-([0-9]+)$', albumId)
+        return int(m.group(1)) if m else None
+
+    def songHref(self, albumId, number):
+        # KHInsider quotes song URLs twice.
+        return '/game-soundtracks/album/{}/{}'.format(
+            albumId, quote(quote((trackName(number) + '.mp3').encode('utf-8'))))
+
+    def albumPage(self, albumId):
+        tracks = self.albumTracks(albumId)
+        if tracks is None:
+            body = '<h2>Error</h2>\n<p align="left">No such album</p>\n'
+            return (PAGE_HEADER.format(title="Error", nav=NAV) + body +
+                    PAGE_FOOTER.format(nav=NAV)).encode('utf-8')
+
+        rows = [ALBUM_ROW.format(number=i,
+                                 href=self.songHref(albumId, i),
+                                 name=trackName(i),
+                                 duration="{}:{:02d}".format(i % 5 + 1, i % 60),
+                                 mp3Size=formatSize(self.fileSize),
+                                 flacSize=formatSize(self.fileSize * 3))
+                for i in range(1, tracks + 1)]
+        body = ("<h2>Album &#{} Stand-In</h2>\n"
+                "<p align=\"left\">Platforms: Benchmark<br>\nNumber of Files: <b>{}</b></p>\n"
+                "<table><tr><td><div class=\"albumImage\"><a href=\"http://{}/soundtracks/{}/cover.jpg\">"
+                "<img src=\"http://{}/soundtracks/{}/thumbs/cover.jpg\"></a></div></td></tr></table>\n"
+                "<table id=\"songlist\">\n"
+                "<tr id=\"songlist_header\"><th>&nbsp;</th><th align=\"right\">&nbsp;</th><th>Song Name</th>"
+                "<th></th><th>MP3</th><th>FLAC</th><th></th></tr>\n"
+                "{}\n"
+                "<tr id=\"songlist_footer\"><th colspan=\"3\">Total:</th><th>1h 0m</th>"
+                "<th>{}</th><th>{}</th><th></th></tr>\n"
+                "</table>\n").format(albumId, tracks, self.host, albumId, self.host, albumId,
+                                     '\n'.join(rows), formatSize(self.fileSize * tracks),
+                                     formatSize(self.fileSize * tracks * 3))
+        return (PAGE_HEADER.format(title=albumId, nav=NAV) + body +
+                PAGE_FOOTER.format(nav=NAV)).encode('utf-8')
+
+    def songPage(self, albumId, filename):
+        stem = os.path.splitext(filename)[0]
+        base = 'http://{}/soundtracks/{}/{}/'.format(self.host, albumId, 'a1b2c3d4')
+        body = ("<p align=\"left\">&nbsp;</p>\n<p>Song page</p>\n"
+                "<p align=\"left\">Album name: <b>Album &#{} Stand-In</b><br>\n"
+                "Song name: <b>{}</b><br>\nTotal Filesize: <b>1 MB</b></p>\n"
+                "<p><a href=\"{}{}\"><span class=\"songDownloadLink\">Download MP3</span></a></p>\n"
+                "<p><a href=\"{}{}\"><span class=\"songDownloadLink\">Download FLAC</span></a></p>\n"
+                ).format(albumId, stem, base, quote((stem + '.mp3').encode('utf-8')),
+                         base, quote((stem + '.flac').encode('utf-8')))
+        return (PAGE_HEADER.format(title=stem, nav=NAV) + body +
+                PAGE_FOOTER.format(nav=NAV)).encode('utf-8')
+
+    def searchPage(self, term):
+        rows = ''.join(
+            '<tr><td><img src="x.png"></td><td><a href="/game-soundtracks/album/album-{0}">'
+            '{1} Album {0}</a></td><td>Benchmark</td></tr>\n'.format(i, term)
+            for i in range(1, 21))
+        body = ('<h2>Search</h2>\n<p align="left">Found 20 matching albums for "{}".</p>\n'
+                '<table class="albumList"><tr><th></th><th>Album</th><th>Platform</th></tr>\n{}</table>\n'
+                ).format(term, rows)
+        return (PAGE_HEADER.format(title="Search", nav=NAV) + body +
+                PAGE_FOOTER.format(nav=NAV)).encode('utf-8')
+
+    def homePage(self):
+        body = '<h2>Welcome</h2>\n<p align="left">Stand-in.</p>\n'
+        return (PAGE_HEADER.format(title="Home", nav=NAV) + body +
+                PAGE_FOOTER.format(nav=NAV)).encode('utf-8')
+
+    def changeList(self, letter):
+        self.listVersions[letter] += 1
+
+    def listEtag(self, letter):
+        return '"{}-{}"'.format(LETTERS.index(letter), self.listVersions[letter])
+
+    def listPage(self, letter):
+        first = LETTERS.index(letter) * 10000
+        rows = []
+        for i in range(self.listSize + self.listVersions[letter]):
+            name = "{} {} {} {}".format(letter, WORDS[i % len(WORDS)],
+                                        WORDS[i // len(WORDS) % len(WORDS)], i)
+            rows.append('<tr><td><img src="x.png"></td><td><a href="/game-soundtracks/album/album-{}">'
+                        '{}</a></td><td>Benchmark</td><td>Soundtrack</td><td>2024</td></tr>'.format(
+                            first + i, name))
+        body = ('<h2>Browse: {}</h2>\n<table class="albumList"><tr><th></th><th>Album</th>'
+                '<th>Platform</th><th>Type</th><th>Year</th></tr>\n{}</table>\n').format(
+                    letter, '\n'.join(rows))
+        return (PAGE_HEADER.format(title="Browse", nav=NAV) + body +
+                PAGE_FOOTER.format(nav=NAV)).encode('utf-8')
+
+    def fileData(self, start, end):
+        """Return bytes `start` to `end` (exclusive) of a made-up file."""
+        chunkSize = len(self._fileData)
+        parts = []
+        while start < end:
+            offset = start % chunkSize
+            part = self._fileData[offset:offset + min(end - start, chunkSize - offset)]
+            parts.append(part)
+            start += len(part)
+        return b''.join(parts)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body=b'', contentType='text/html; charset=UTF-8', headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        standIn = self.server.standIn
+        with standIn._lock:
+            standIn._active += 1
+            busy = standIn.capacity is not None and standIn._active > standIn.capacity
+            standIn.busyResponses += busy
+        try:
+            if busy:
+                return self.respond(503, headers=[('Retry-After', '1')])
+            self.handle_GET(standIn)
+        finally:
+            with standIn._lock:
+                standIn._active -= 1
+
+    def handle_GET(self, standIn):
+        if standIn.latency:
+            time.sleep(standIn.latency)
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+
+        if url.path == '/404':
+            return self.respond(404, (PAGE_HEADER.format(title="404", nav=NAV) +
+                                      "<h2>404</h2><p>Not found.</p>" +
+                                      PAGE_FOOTER.format(nav=NAV)).encode('utf-8'))
+        if url.path == '/':
+            return self.respond(200, standIn.homePage())
+        if parts[:2] == ['game-soundtracks', 'browse'] and len(parts) == 3 and parts[2] in LETTERS:
+            etag = standIn.listEtag(parts[2])
+            if self.headers.get('If-None-Match') == etag:
+                return self.respond(304, headers=[('ETag', etag)])
+            return self.respond(200, standIn.listPage(parts[2]), headers=[('ETag', etag)])
+        if url.path == '/search':
+            term = parse_qs(url.query).get('search', [''])[0]
+            if standIn.albumTracks(term) is not None:
+                # KHInsider goes straight to the album if there's only one.
+                return self.respond(302, headers=[('Location', '/game-soundtracks/album/' + term)])
+            return self.respond(200, standIn.searchPage(term))
+        if parts[:2] == ['game-soundtracks', 'album'] and len(parts) == 3:
+            return self.respond(200, standIn.albumPage(parts[2]))
+        if parts[:2] == ['game-soundtracks', 'album'] and len(parts) == 4:
+            filename = unquote(parts[3])
+            m = re.match(r'^([0-9]+)\.', filename)
+            if m and int(m.group(1)) == standIn.nonexistentTrack:
+                return self.respond(302, headers=[('Location', '/404')])
+            return self.respond(200, standIn.songPage(parts[2], filename))
+        if parts[0] == 'soundtracks':
+            return self.sendFile(standIn, parts[-1])
+        self.respond(404)
+
+    def sendFile(self, standIn, filename):
+        speed = None
+        if filename.endswith('.zip'):
+            size = standIn.largeFileSize
+            speed = standIn.connectionSpeed
+        else:
+            size = standIn.fileSize * (3 if filename.endswith('.flac') else 1)
+        start, end = 0, size
+        status = 200
+        headers = [('Accept-Ranges', 'bytes')]
+        m = re.match(r'^bytes=([0-9]+)-([0-9]*)$', self.headers.get('Range') or '')
+        if m:
+            start = int(m.group(1))
+            end = int(m.group(2)) + 1 if m.group(2) else size
+            if start >= size:
+                return self.respond(416, headers=[('Content-Range', 'bytes */{}'.format(size))])
+            end = min(end, size)
+            status = 206
+            headers.append(('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, size)))
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', str(end - start))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        sendStart = time.time()
+        sent = 0
+        while start < end:
+            chunkEnd = min(start + 256 * 1024, end)
+            self.wfile.write(standIn.fileData(start, chunkEnd))
+            sent += chunkEnd - start
+            start = chunkEnd
+            if speed:
+                ahead = sent / float(speed) - (time.time() - sendStart)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, standIn, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StandInHandler)
+        self.standIn = standIn
+        standIn.host = '127.0.0.1:{}'.format(self.server_address[1])
+        self.url = 'http://{}/'.format(standIn.host)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+# --- The benchmarks ---
+
+def timeIt(func, repeat=3):
+    """Return the best time out of `repeat` calls of `func`, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmarkAlbumParse(standIn, tracks):
+    page = standIn.albumPage('album-{}'.format(tracks))
+    def parse():
+        soundtrack = khinsider.Soundtrack('album-{}'.format(tracks))
+        soundtrack._loadPage(page)
+        soundtrack.name, soundtrack.availableFormats, soundtrack.songs
+    return timeIt(parse)
+
+
+def benchmarkSongResolution(server, tracks, jobs, adaptive=False, parseWorkers=0):
+    def resolve():
+        soundtrack = khinsider.Soundtrack('album-{}'.format(tracks))
+        khinsider.resolveSongs(soundtrack.songs, ['flac', 'mp3'],
+                               khinsider.maxJobs(jobs, adaptive),
+                               limiter=khinsider.HostLimiter(jobs, adaptive))
+    if not parseWorkers:
+        return tracks / timeIt(resolve)
+    pool = khinsider.makeParsePool(parseWorkers)
+    try:
+        # Starting the processes isn't what's being timed.
+        list(pool.map(len, [b''] * parseWorkers * 4))
+        khinsider.setParsePool(pool)
+        return tracks / timeIt(resolve)
+    finally:
+        khinsider.setParsePool(None)
+        pool.shutdown()
+
+
+def benchmarkDownload(server, directory, count, jobs, adaptive=False):
+    files = [khinsider.File(server.url + 'soundtracks/bench/a1b2c3d4/{}.mp3'.format(i))
+             for i in range(count)]
+    def download():
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        khinsider.downloadFiles(files, directory, jobs=jobs, adaptive=adaptive)
+    elapsed = timeIt(download)
+    return count * server.standIn.fileSize / 1024.0 / 1024.0 / elapsed
+
+
+def benchmarkLargeFile(server, directory, segments):
+    file = khinsider.File(server.url + 'soundtracks/bench/a1b2c3d4/bonus.zip')
+    def download():
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        file.download(os.path.join(directory, file.filename), segments=segments)
+    return server.standIn.largeFileSize / 1024.0 / 1024.0 / timeIt(download, repeat=1)
+
+
+def benchmarkEndToEnd(directory, tracks, jobs, resolveJobs, adaptive=False, archiveFormat=None):
+    def download():
+        shutil.rmtree(directory, ignore_errors=True)
+        khinsider.download('album-{}'.format(tracks), directory, formatOrder=['mp3'],
+                           jobs=jobs, resolveJobs=resolveJobs, adaptive=adaptive,
+                           archiveFormat=archiveFormat)
+    return timeIt(download)
+
+
+def benchmarkMemory(tracks, jobs):
+    """Return how much memory (in KB per track) a Soundtrack and the Files of
+    its songs take up once they've been loaded, and at most while loading them.
+    """
+    # Whatever's only set up once (connections and such) isn't counted.
+    khinsider.resolveSongs(khinsider.Soundtrack('album-{}'.format(jobs * 2)).songs, ['mp3'], jobs)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        soundtrack = khinsider.Soundtrack('album-{}'.format(tracks))
+        files = khinsider.resolveSongs(soundtrack.songs, ['mp3'], jobs)
+        gc.collect()
+        kept, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del soundtrack, files
+    return (kept - before) / 1024.0 / tracks, (peak - before) / 1024.0 / tracks
+
+
+class MemoryGrowthError(Exception):
+    pass
+
+
+def checkMemoryGrowth(small, large, jobs, limit=MEMORY_GROWTH_LIMIT):
+    """Raise a MemoryGrowthError if a large album takes up more than limit
+    times the memory per track a small one does, kept or at peak. Return the
+    larger of the two ratios otherwise.
+    """
+    smallKept, smallPeak = benchmarkMemory(small, jobs)
+    largeKept, largePeak = benchmarkMemory(large, jobs)
+    ratios = {'kept': largeKept / smallKept, 'peak': largePeak / smallPeak}
+    for name, ratio in sorted(ratios.items()):
+        if ratio > limit:
+            raise MemoryGrowthError(
+                "{} memory per track went from {:.1f} KB at {} tracks to {:.1f} KB at {} "
+                "({:.2f}x, limit {:.2f}x)".format(
+                    name, smallKept if name == 'kept' else smallPeak, small,
+                    largeKept if name == 'kept' else largePeak, large, ratio, limit))
+    return max(ratios.values())
+
+
+def benchmarkCatalog(server, directory):
+    """Return how long it takes to build a Catalog, to update it when nothing
+    has changed, and to update it when one list has.
+    """
+    catalog = khinsider.Catalog(os.path.join(directory, 'catalog.sqlite3'))
+    try:
+        build = timeIt(catalog.update, repeat=1)
+        refresh = timeIt(catalog.update, repeat=1)
+        server.standIn.changeList('K')
+        change = timeIt(catalog.update, repeat=1)
+    finally:
+        catalog.close()
+    return build, refresh, change
+
+
+def benchmarkSearch(directory, catalog):
+    catalog = khinsider.Catalog(os.path.join(directory, 'catalog.sqlite3')) if catalog else False
+    try:
+        return timeIt(lambda: khinsider.search('kirby mother', catalog=catalog))
+    finally:
+        if catalog:
+            catalog.close()
+
+
+def benchmarkSearchDetails(hydrate):
+    """Time a search, and getting the formats of all the soundtracks found."""
+    def searchWithDetails():
+        for soundtracks in khinsider.search('kirby', catalog=False, hydrate=hydrate):
+            for soundtrack in soundtracks:
+                soundtrack.availableFormats
+    return timeIt(searchWithDetails)
+
+
+class Startup(object):
+    """Runs khinsider.py as a script, the way it's used from the command
+    line, with its cache in `directory` instead of the usual place.
+
+    Searches there go to a catalog made from the stand-in's album lists, and
+    album-`tracks` has its pages cached and is already downloaded to
+    `directory`/album, just as if it were all from the actual KHInsider.
+    """
+
+    def __init__(self, server, directory, tracks):
+        self.directory = directory
+        self.albumDirectory = os.path.join(directory, 'album')
+        self.albumId = 'album-{}'.format(tracks)
+        cacheDirectory = os.path.join(directory, 'khinsider')
+        self.environment = dict(os.environ, XDG_CACHE_HOME=directory, LOCALAPPDATA=directory)
+
+        catalog = khinsider.Catalog(os.path.join(cacheDirectory, 'catalog.sqlite3'))
+        try:
+            catalog.update()
+        finally:
+            catalog.close()
+
+        # The script gets its pages from the actual site, so they're cached as
+        # being from there. The files on them are still on the stand-in.
+        standInUrl = khinsider.BASE_URL
+        khinsider.BASE_URL = REAL_BASE_URL
+        khinsider.setPageCache(khinsider.PageCache(cacheDirectory))
+        try:
+            soundtrack = khinsider.Soundtrack(self.albumId)
+            cache = khinsider.getPageCache()
+            cache.put(soundtrack.url, khinsider.CachedPage(
+                soundtrack.url, server.standIn.albumPage(self.albumId)))
+            for i in range(1, tracks + 1):
+                url = urljoin(soundtrack.url, server.standIn.songHref(self.albumId, i))
+                cache.put(url, khinsider.CachedPage(url, server.standIn.songPage(
+                    self.albumId, trackName(i) + '.mp3')))
+            soundtrack.download(self.albumDirectory, formatOrder=['mp3'])
+        finally:
+            khinsider.BASE_URL = standInUrl
+            khinsider.setPageCache(None)
+        # The first run checks the dependencies - the rest are what's timed.
+        self.run('--check-dependencies', '--help')
+
+    def run(self, *arguments):
+        with open(os.devnull, 'w') as nowhere:
+            subprocess.check_call([sys.executable, khinsider.__file__] + list(arguments),
+                                  stdout=nowhere, env=self.environment, cwd=self.directory)
+
+
+def benchmarkStartup(startup, *arguments):
+    return timeIt(lambda: startup.run(*arguments))
+
+
+def benchmarkPythonStartup():
+    return timeIt(lambda: subprocess.check_call([sys.executable, '-c', 'pass']))
+
+
+def report(name, formatStr, benchmark):
+    try:
+        result = formatStr.format(benchmark())
+    except (khinsider.KhinsiderError, requests.RequestException,
+            subprocess.CalledProcessError, MemoryGrowthError) as e:
+        result = "failed ({})".format(e)
+    print("  {:<24} {}".format(name + ":", result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark khinsider.py against a local stand-in for KHInsider.")
+    parser.add_argument('--sizes', default='10,50,200',
+                        help="Comma-separated album sizes (in tracks) to benchmark (default: 10,50,200).")
+    parser.add_argument('--file-size', type=int, default=1024,
+                        help="Size of each made-up MP3 file in KB (default: 1024).")
+    parser.add_argument('--latency', type=float, default=20,
+                        help="How long the server waits before each response, in ms (default: 20).")
+    parser.add_argument('--jobs', type=int, default=khinsider.DEFAULT_JOBS,
+                        help="Files to download at once (default: {}).".format(khinsider.DEFAULT_JOBS))
+    parser.add_argument('--resolve-jobs', type=int, default=khinsider.DEFAULT_RESOLVE_JOBS,
+                        help="Song pages to fetch at once (default: {}).".format(khinsider.DEFAULT_RESOLVE_JOBS))
+    parser.add_argument('--capacity', type=int, default=None,
+                        help="Have the server respond with 503 to requests past this many at once.")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="Use adaptive limits (see khinsider.HostLimiter).")
+    parser.add_argument('--large-file-size', type=int, default=64,
+                        help="Size of the made-up bonus archive in MB, or 0 to skip the large file "
+                        "benchmarks (default: 64).")
+    parser.add_argument('--connection-speed', type=float, default=16,
+                        help="How fast the server sends the bonus archive over each connection, in MB/s "
+                        "(default: 16).")
+    parser.add_argument('--segments', type=int, default=4,
+                        help="Segments to download the bonus archive in at once (default: 4).")
+    parser.add_argument('--list-size', type=int, default=500,
+                        help="Albums on each of the 27 album lists for the catalog benchmarks, "
+                        "or 0 to skip them (default: 500).")
+    parser.add_argument('--parse-workers', default='2,4',
+                        help="Comma-separated numbers of processes to also time song resolutions with "
+                        "pages parsed in (see khinsider.setParsePool), or 0 not to (default: 2,4).")
+    parser.add_argument('--no-startup', dest='startup', action='store_false',
+                        help="Skip timing how long khinsider.py takes to start and run from the command line.")
+    arguments = parser.parse_args()
+    sizes = [int(size) for size in arguments.sizes.split(',')]
+    parseWorkers = [int(workers) for workers in arguments.parse_workers.split(',') if int(workers)]
+
+    standIn = StandIn(arguments.file_size * 1024, arguments.latency / 1000.0,
+                      capacity=arguments.capacity, listSize=arguments.list_size,
+                      largeFileSize=arguments.large_file_size * 1024 * 1024,
+                      connectionSpeed=arguments.connection_speed * 1024 * 1024 or None)
+    server = StandInServer(standIn).start()
+    khinsider.BASE_URL = server.url
+    khinsider.setPageCache(None)
+    directory = tempfile.mkdtemp(prefix='khinsider-benchmark-')
+
+    print("Stand-in server at {} ({} ms latency, {} KB files, {} parser{}).".format(
+        server.url, arguments.latency, arguments.file_size, khinsider.PARSER,
+        ", {} requests at once".format(arguments.capacity) if arguments.capacity else ""))
+    try:
+        if arguments.list_size:
+            print("\nCatalog of {} albums:".format(arguments.list_size * len(LETTERS)))
+            catalogDirectory = os.path.join(directory, 'catalog')
+            try:
+                build, refresh, change = benchmarkCatalog(server, catalogDirectory)
+            except (khinsider.KhinsiderError, requests.RequestException) as e:
+                print("  Catalog update:          failed ({})".format(e))
+            else:
+                print("  {:<24} {:8.2f} s".format("Catalog build:", build))
+                print("  {:<24} {:8.2f} s".format("Update (no changes):", refresh))
+                print("  {:<24} {:8.2f} s".format("Update (one change):", change))
+                report("Catalog search", "{:8.2f} ms",
+                       lambda: benchmarkSearch(catalogDirectory, True) * 1000)
+            report("Live search", "{:8.2f} ms",
+                   lambda: benchmarkSearch(catalogDirectory, False) * 1000)
+
+        print("\nSearch results with details (20 albums):")
+        report("One by one", "{:8.1f} ms", lambda: benchmarkSearchDetails(False) * 1000)
+        report("hydrate=True", "{:8.1f} ms", lambda: benchmarkSearchDetails(True) * 1000)
+
+        if arguments.startup:
+            print("\nCommand line:")
+            try:
+                startup = Startup(server, os.path.join(directory, 'startup'), sizes[0])
+            except (khinsider.KhinsiderError, requests.RequestException,
+                    subprocess.CalledProcessError) as e:
+                print("  Setup:                   failed ({})".format(e))
+            else:
+                report("Python itself", "{:8.1f} ms", lambda: benchmarkPythonStartup() * 1000)
+                report("--help", "{:8.1f} ms", lambda: benchmarkStartup(startup, '--help') * 1000)
+                report("--search (catalog)", "{:8.1f} ms",
+                       lambda: benchmarkStartup(startup, '--search', 'kirby', 'mother') * 1000)
+                report("Cached download", "{:8.1f} ms",
+                       lambda: benchmarkStartup(startup, '--format', 'mp3', startup.albumId,
+                                                startup.albumDirectory) * 1000)
+
+        if arguments.large_file_size:
+            print("\n{} MB bonus archive, {} MB/s per connection:".format(
+                arguments.large_file_size, arguments.connection_speed))
+            report("One stream", "{:8.1f} MB/s",
+                   lambda: benchmarkLargeFile(server, os.path.join(directory, 'large'), 1))
+            report("{} segments".format(arguments.segments), "{:8.1f} MB/s",
+                   lambda: benchmarkLargeFile(server, os.path.join(directory, 'large'),
+                                              arguments.segments))
+
+        for tracks in sizes:
+            print("\nAlbum with {} tracks:".format(tracks))
+            standIn.busyResponses = 0
+            report("Album page parse", "{:8.1f} ms",
+                   lambda: benchmarkAlbumParse(standIn, tracks) * 1000)
+            if tracemalloc is not None:
+                report("Memory", "{0[0]:8.1f} KB/track kept, {0[1]:.1f} at peak",
+                       lambda: benchmarkMemory(tracks, arguments.resolve_jobs))
+            report("Song resolutions", "{:8.1f} /s",
+                   lambda: benchmarkSongResolution(server, tracks, arguments.resolve_jobs,
+                                                   arguments.adaptive))
+            for workers in parseWorkers:
+                report("  {} parse workers".format(workers), "{:8.1f} /s",
+                       lambda: benchmarkSongResolution(server, tracks, arguments.resolve_jobs,
+                                                       arguments.adaptive, workers))
+            report("File downloads", "{:8.1f} MB/s",
+                   lambda: benchmarkDownload(server, os.path.join(directory, 'files'), tracks,
+                                             arguments.jobs, arguments.adaptive))
+            report("Soundtrack.download", "{:8.2f} s",
+                   lambda: benchmarkEndToEnd(os.path.join(directory, 'album'), tracks,
+                                             arguments.jobs, arguments.resolve_jobs,
+                                             arguments.adaptive))
+            report("  into a zip", "{:8.2f} s",
+                   lambda: benchmarkEndToEnd(os.path.join(directory, 'album'), tracks,
+                                             arguments.jobs, arguments.resolve_jobs,
+                                             arguments.adaptive, 'zip'))
+            if arguments.capacity:
+                print("  503s sent:               {:8d}".format(standIn.busyResponses))
+
+        if tracemalloc is not None and len(set(sizes)) > 1:
+            print("\nFrom {} to {} tracks:".format(min(sizes), max(sizes)))
+            report("Memory per track", "{:8.2f}x",
+                   lambda: checkMemoryGrowth(min(sizes), max(sizes), arguments.resolve_jobs))
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,15 +7,34 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import errno
+import hashlib
+import json
 import os
+import random
 import re
+import shutil
+import socket
+import struct
 import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from email.utils import mktime_tz, parsedate_tz
 from functools import wraps
 from itertools import chain
 
+try: # Python 2
+    from itertools import izip as zip
+except ImportError:
+    pass
+
 try:
-    from urllib.parse import unquote, urljoin, urlsplit
+    from urllib.parse import quote, unquote, urljoin, urlsplit
 except ImportError: # Python 2
+    from urllib import quote
     from urlparse import unquote, urljoin, urlsplit
 
 try: # Python 2
@@ -23,17 +42,90 @@ try: # Python 2
 except ImportError:
     from os import getcwd
 
+try:
+    from os import replace as replaceFile
+except ImportError: # Python 2
+    def replaceFile(src, dst):
+        # os.rename won't overwrite an existing file on Windows.
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
 class Silence(object):
+    """Swallows everything printed to stdout and stderr by the current thread
+    while active. Other threads can keep printing as usual.
+    """
+    _lock = threading.Lock()
+    _silenced = {} # Thread ID: nesting depth.
+    _originals = None
+    # Other threads may be in the middle of printing to a stream when it's
+    # swapped out, so the wrappers are kept around rather than made anew.
+    _wrappers = {}
+
+    class _Stream(object):
+        def __init__(self, stream):
+            self._stream = stream
+        
+        def write(self, s):
+            if threading.current_thread().ident not in Silence._silenced:
+                self._stream.write(s)
+        
+        def __getattr__(self, name):
+            return getattr(self._stream, name)
+
+    @classmethod
+    def _wrap(cls, stream):
+        if id(stream) not in cls._wrappers:
+            cls._wrappers[id(stream)] = cls._Stream(stream)
+        return cls._wrappers[id(stream)]
+
     def __enter__(self):
-        self._stdout = sys.stdout
-        self._stderr = sys.stderr
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
+        thread = threading.current_thread().ident
+        with Silence._lock:
+            if not Silence._silenced:
+                Silence._originals = sys.stdout, sys.stderr
+                sys.stdout = Silence._wrap(sys.stdout)
+                sys.stderr = Silence._wrap(sys.stderr)
+            Silence._silenced[thread] = Silence._silenced.get(thread, 0) + 1
     
     def __exit__(self, *_):
-        sys.stdout = self._stdout
-        sys.stderr = self._stderr
+        thread = threading.current_thread().ident
+        with Silence._lock:
+            Silence._silenced[thread] -= 1
+            if not Silence._silenced[thread]:
+                del Silence._silenced[thread]
+            if not Silence._silenced:
+                sys.stdout, sys.stderr = Silence._originals
+
+
+def defaultCacheDirectory():
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache'))
+    return os.path.join(base, 'khinsider')
+
+
+# To check for the existence of modules without importing them.
+# Apparently imp and importlib are a forest of deprecation!
+# The API was changed once in 3.3 (deprecating imp),
+# and then again in 3.4 (deprecating the 3.3 API).
+# So.... we have to do this dance to avoid deprecation warnings.
+try:
+    try:
+        from importlib.util import find_spec as find_module # Python 3.4+
+    except ImportError:
+        from importlib import find_loader as find_module # Python 3.3
+except ImportError:
+    from imp import find_module # Python 2
 
+def moduleExists(name):
+    try:
+        result = find_module(name)
+    except ImportError:
+        return False
+    else:
+        return result is not None
 
 # --- Install prerequisites ---
 
@@ -41,32 +133,15 @@ class Silence(object):
 # rest of the module, and doesn't even run if the module isn't run by itself.)
 
 if __name__ == '__main__':
-    # To check for the existence of modules without importing them.
-    # Apparently imp and importlib are a forest of deprecation!
-    # The API was changed once in 3.3 (deprecating imp),
-    # and then again in 3.4 (deprecating the 3.3 API).
-    # So.... we have to do this dance to avoid deprecation warnings.
-    try:
-        try:
-            from importlib.util import find_spec as find_module # Python 3.4+
-        except ImportError:
-            from importlib import find_loader as find_module # Python 3.3
-    except ImportError:
-        from imp import find_module # Python 2
-
     # User-friendly name, import name, pip specification.
     requiredModules = [
         ['requests', 'requests', 'requests >= 2.0.0, < 3.0.0'],
         ['Beautiful Soup 4', 'bs4', 'beautifulsoup4 >= 4.4.0, < 5.0.0']
     ]
+    if sys.version_info[0] == 2:
+        # concurrent.futures is only in the standard library from Python 3.2.
+        requiredModules.append(['futures', 'concurrent', 'futures >= 3.0.0, < 4.0.0'])
 
-    def moduleExists(name):
-        try:
-            result = find_module(name)
-        except ImportError:
-            return False
-        else:
-            return result is not None
     def neededInstalls(requiredModules=requiredModules):
         uninstalledModules = []
         for module in requiredModules:
@@ -100,30 +175,135 @@ if __name__ == '__main__':
                 raise e
     def installRequiredModules(needed=None, verbose=True):
         needed = neededInstalls() if needed is None else needed
-        installModules(neededInstalls(), verbose)
+        installModules(needed, verbose)
 
-    needed = neededInstalls()
-    if needed:
-        if moduleExists('pip'):
-            # Needed to call pip the official way.
-            import subprocess
-        else:
-            print("You don't seem to have pip installed!", file=sys.stderr)
-            print("Get it from https://pip.readthedocs.org/en/latest/installing.html", file=sys.stderr)
-            sys.exit(1)
+    # Once everything's been found installed, that's remembered (for this
+    # particular Python), so it doesn't have to be looked for every time.
+    dependencyMarker = os.path.join(defaultCacheDirectory(), 'dependencies.checked')
+    dependencyMarkerContent = "{}\n{}".format(sys.executable, sys.version).encode('utf-8')
+    def dependenciesChecked():
+        try:
+            with open(dependencyMarker, 'rb') as f:
+                return f.read() == dependencyMarkerContent
+        except (IOError, OSError):
+            return False
+    def markDependenciesChecked():
+        try:
+            if not os.path.isdir(os.path.dirname(dependencyMarker)):
+                os.makedirs(os.path.dirname(dependencyMarker))
+            with open(dependencyMarker, 'wb') as f:
+                f.write(dependencyMarkerContent)
+        except (IOError, OSError):
+            pass
 
-    try:
-        installRequiredModules(needed)
-    except OSError:
-        sys.exit(1)
+    if '--check-dependencies' in sys.argv or not dependenciesChecked():
+        needed = neededInstalls()
+        if needed:
+            if moduleExists('pip'):
+                # Needed to call pip the official way.
+                import subprocess
+            else:
+                print("You don't seem to have pip installed!", file=sys.stderr)
+                print("Get it from https://pip.readthedocs.org/en/latest/installing.html", file=sys.stderr)
+                sys.exit(1)
+
+        try:
+            installRequiredModules(needed)
+        except OSError:
+            sys.exit(1)
+        markDependenciesChecked()
 
 # ------
 
-import requests
-from bs4 import BeautifulSoup
+from importlib import import_module
+
+
+class LazyModule(object):
+    """Stands in for the module `name`, which is only imported once one of
+    its attributes is used. Importing requests and Beautiful Soup takes
+    longer than a lot of runs of the script need to take altogether.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+
+    def __getattr__(self, attribute):
+        module = import_module(self._name)
+        # From now on, the attributes are found without coming back here.
+        self.__dict__.update(vars(module))
+        return getattr(module, attribute)
+
+requests = LazyModule('requests')
+bs4 = LazyModule('bs4')
+urllib3 = LazyModule('urllib3')
+# On Python 2, this is the "futures" backport - so khinsider can at least
+# be imported without it.
+concurrentFutures = LazyModule('concurrent.futures')
 
 BASE_URL = 'https://downloads.khinsider.com/'
 
+# How many song pages to fetch at once when figuring out which files to get.
+DEFAULT_RESOLVE_JOBS = 8
+# How many soundtracks to work on at once when downloading several.
+DEFAULT_ALBUM_JOBS = 4
+# How many files to download at once, and how many of those may be from the
+# same host. Hosts are the ones actually serving the files, so this is what
+# keeps us from hammering any single server.
+DEFAULT_JOBS = 4
+DEFAULT_JOBS_PER_HOST = 4
+
+# The number of connections to keep open per host. This should be at least
+# as many as will be used at once, or they'll be reopened all the time.
+DEFAULT_POOL_SIZE = max(DEFAULT_RESOLVE_JOBS, DEFAULT_JOBS)
+
+# Pages are used straight from the page cache for this many seconds after
+# they were fetched, and after that only once the server says they haven't
+# changed. The cache is kept below the size in bytes.
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+DEFAULT_CACHE_SIZE = 100 * 1024 * 1024
+
+# How much of a file to read at a time while downloading it.
+CHUNK_SIZE = 64 * 1024
+# Unfinished downloads are kept next to where they're going with this suffix.
+PART_SUFFIX = '.part'
+# Files at least this big (in bytes) are downloaded in several segments at
+# once, when asked to (see File.download). Smaller ones aren't worth it.
+SEGMENT_THRESHOLD = 16 * 1024 * 1024
+# Segments are kept apart from single-stream partial files with this suffix,
+# since they have holes in them until they're done.
+SEGMENTED_PART_SUFFIX = '.segments' + PART_SUFFIX
+# When downloading into an archive, files waiting for their turn to be
+# written keep up to this many bytes in memory (see downloadToArchive).
+ARCHIVE_READ_AHEAD = 8 * 1024 * 1024
+# How many songs to look up to learn where the rest of the files are when
+# guessing file URLs (see FileUrlTemplates).
+GUESS_SAMPLES = 2
+
+# What's been downloaded to an album's directory is recorded in this file.
+MANIFEST_FILENAME = '.khinsider-manifest.json'
+# PROGRESS events are sent at most this often (in seconds) per file.
+PROGRESS_INTERVAL = 0.5
+
+# With adaptive limits, up to this many times as many jobs as specified may
+# end up running at once, as long as the servers keep up.
+ADAPTIVE_GROWTH = 4
+# With adaptive limits, responses taking this many times longer than the
+# usual count as the server struggling.
+LATENCY_TOLERANCE = 2.0
+# How long to wait (in seconds) before trying again when a server says it's
+# too busy, but not for how long.
+DEFAULT_RETRY_AFTER = 1.0
+# The defaults for RetryPolicy: how many times to try each request, how long
+# to wait after the first failure (doubling each time) and at most, which
+# statuses are worth trying again after, and after how many failures in a
+# row a host is left alone, and for how long.
+DEFAULT_TRIES = 4
+RETRY_BACKOFF = 0.5
+MAX_RETRY_DELAY = 30.0
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+CIRCUIT_FAILURES = 5
+CIRCUIT_COOLDOWN = 60.0
+
 # Although some of these are valid on Linux, keeping this the same
 # across systems is nice for consistency AND it works on WSL.
 FILENAME_INVALID_RE = re.compile(r'[<>:"/\\|?*]')
@@ -151,6 +331,488 @@ def unicodePrint(*args, **kwargs):
     print(*args, **kwargs)
 
 
+class OrderedPrinter(object):
+    """Prints output from several numbered tasks running at once without
+    interleaving it, and in the order of the tasks' numbers.
+    
+    Output from the lowest-numbered unfinished task is printed right away;
+    everything else is held until all tasks before it are finished. It's
+    printed with `out`, which takes the same arguments as print.
+    """
+
+    def __init__(self, firstIndex=1, out=unicodePrint):
+        self.out = out
+        self._lock = threading.Lock()
+        self._current = firstIndex
+        self._buffers = {}
+        self._finished = set()
+    
+    def printer(self, index):
+        """Return a unicodePrint-like function that prints as task `index`."""
+        def printFunc(*args, **kwargs):
+            self.print(index, *args, **kwargs)
+        return printFunc
+
+    def print(self, index, *args, **kwargs):
+        with self._lock:
+            if index == self._current:
+                self.out(*args, **kwargs)
+            else:
+                self._buffers.setdefault(index, []).append((args, kwargs))
+    
+    def finish(self, index):
+        with self._lock:
+            self._finished.add(index)
+            while self._current in self._finished:
+                self._finished.remove(self._current)
+                self._current += 1
+                for args, kwargs in self._buffers.pop(self._current, []):
+                    self.out(*args, **kwargs)
+
+
+class AdaptiveLimiter(object):
+    """Limits how many requests may run at once, adjusting the limit to how
+    well the server is keeping up - like TCP's congestion control does.
+
+    The limit starts at `initial`. It goes up by one for every `limit`
+    responses in a row that come back about as fast as usual (see record),
+    and is halved whenever the server pushes back (see backOff) or responses
+    start taking LATENCY_TOLERANCE times as long as usual. It's kept between
+    `minimum` and `maximum` - set them to `initial` for a fixed limit.
+    """
+
+    def __init__(self, initial, maximum=None, minimum=1):
+        self.minimum = min(minimum, initial)
+        self.maximum = max(initial, maximum if maximum is not None else initial)
+        self.limit = float(initial)
+        self._condition = threading.Condition()
+        self._active = 0
+        self._pausedUntil = 0
+        self._latency = None
+        self._usualLatency = None
+        self._lastDecrease = 0
+    
+    def acquire(self):
+        """Wait for a free slot (and for any pause from backOff to be over)."""
+        with self._condition:
+            while True:
+                wait = self._pausedUntil - time.time()
+                if wait <= 0 and self._active < int(self.limit):
+                    break
+                self._condition.wait(wait if wait > 0 else None)
+            self._active += 1
+
+    def tryAcquire(self):
+        """Take a free slot if there is one right now, without waiting.
+        Return whether one was taken.
+        """
+        with self._condition:
+            if self._pausedUntil > time.time() or self._active >= int(self.limit):
+                return False
+            self._active += 1
+            return True
+    
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def record(self, latency):
+        """Take into account that a response took `latency` seconds."""
+        with self._condition:
+            if self._latency is None:
+                self._latency = self._usualLatency = latency
+            else:
+                self._latency = 0.8 * self._latency + 0.2 * latency
+                # Slowly forget the fastest times, so that the usual can rise
+                # if things have just gotten slower for good.
+                self._usualLatency = min(self._latency, self._usualLatency * 1.01)
+            
+            if self._latency > self._usualLatency * LATENCY_TOLERANCE:
+                self._decrease()
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                self._condition.notify_all()
+
+    def backOff(self, retryAfter=None):
+        """Lower the limit, and don't let anything new start for `retryAfter`
+        seconds, because the server says it's too busy.
+        """
+        with self._condition:
+            self._decrease()
+            if retryAfter:
+                self._pausedUntil = max(self._pausedUntil, time.time() + retryAfter)
+
+    def _decrease(self):
+        now = time.time()
+        # Requests that were already running when the server started
+        # struggling shouldn't each halve the limit again.
+        if now - self._lastDecrease < (self._latency or 0):
+            return
+        self._lastDecrease = now
+        self.limit = max(self.minimum, self.limit / 2)
+
+
+class HostLimiter(object):
+    """Limits how many connections may be open to each host at once, with
+    an AdaptiveLimiter for each host.
+
+    Each host may have `perHost` connections at once. If `adaptive` is set to
+    True, that's only the starting point - it may go anywhere from 1 to
+    ADAPTIVE_GROWTH times as many depending on how the host's doing.
+    """
+
+    def __init__(self, perHost=DEFAULT_JOBS_PER_HOST, adaptive=False):
+        self.perHost = perHost
+        self.adaptive = adaptive
+        self._lock = threading.Lock()
+        self._limiters = {}
+    
+    def limiter(self, url):
+        """Return the AdaptiveLimiter for the host of `url`."""
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            if host not in self._limiters:
+                if self.adaptive:
+                    limiter = AdaptiveLimiter(self.perHost, self.perHost * ADAPTIVE_GROWTH)
+                else:
+                    limiter = AdaptiveLimiter(self.perHost, self.perHost, self.perHost)
+                self._limiters[host] = limiter
+            return self._limiters[host]
+
+    def acquire(self, url):
+        self.limiter(url).acquire()
+
+    def tryAcquire(self, url):
+        return self.limiter(url).tryAcquire()
+    
+    def release(self, url):
+        self.limiter(url).release()
+    
+    def record(self, url, latency):
+        self.limiter(url).record(latency)
+    
+    def backOff(self, url, retryAfter=None):
+        self.limiter(url).backOff(retryAfter)
+
+
+class BandwidthLimiter(object):
+    """Keeps the downloads that share it below `bytesPerSecond` in total."""
+
+    def __init__(self, bytesPerSecond):
+        self.bytesPerSecond = float(bytesPerSecond)
+        self._lock = threading.Lock()
+        self._next = 0
+    
+    def consume(self, byteCount):
+        """Wait for as long as `byteCount` bytes take at the limit (after the
+        bytes already consumed by others).
+        """
+        with self._lock:
+            now = time.time()
+            self._next = max(self._next, now) + byteCount / self.bytesPerSecond
+            wait = self._next - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RetryPolicy(object):
+    """How requests are tried again when they fail. Every request goes
+    through the same policy - getRetryPolicy().
+
+    A request is tried up to `tries` times in all, as long as it fails in a
+    way that might not happen the next time: a connection error, a timeout,
+    or a response with one of `statuses`. Before each new try, it waits a
+    random amount of time up to `backoff` seconds, doubling with each try
+    (but at most `maxDelay`) - or for as long as the server asked to with
+    Retry-After, if that's longer. Servers asking to wait for longer than
+    `maxDelay` aren't tried again at all.
+
+    Each host also has a circuit breaker: after `failures` failed tries in a
+    row (not counting 429s - the server's there, just busy), nothing more is
+    sent to it for `cooldown` seconds, and HostUnavailableError is raised
+    instead. That way, a server that's down fails the rest of the downloads
+    from it right away instead of each of them waiting for a timeout. After
+    the cooldown, it gets one more chance before the next one.
+
+    Errors it's given up on are marked as such, so that a call further out
+    (say, around work that was split up among threads that each try their
+    own part again) doesn't try the whole thing again from the start.
+    """
+
+    def __init__(self, tries=DEFAULT_TRIES, backoff=RETRY_BACKOFF, maxDelay=MAX_RETRY_DELAY,
+                 statuses=RETRY_STATUSES, failures=CIRCUIT_FAILURES, cooldown=CIRCUIT_COOLDOWN):
+        self.tries = tries
+        self.backoff = backoff
+        self.maxDelay = maxDelay
+        self.statuses = set(statuses)
+        self.failures = failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        # Each host's failures in a row, and when it may be tried again.
+        self._hosts = {}
+        self._local = threading.local()
+    
+    def call(self, url, func, onRetry=None):
+        """Call `func`, which makes a request to `url`, and return what it
+        returns, trying again as described above if it raises an error worth
+        trying again after. If given, `onRetry` is called with the error, how
+        many tries there have been and how long will be waited before each
+        new try.
+
+        Calls made from within `func` (on the same thread) are only tried
+        once, since this call tries them again anyway.
+        """
+        if getattr(self._local, 'calling', False):
+            return func()
+        self._local.calling = True
+        try:
+            triesElapsed = 0
+            while True:
+                self.check(url)
+                try:
+                    result = func()
+                except Exception as e:
+                    if not self.isRetryable(e):
+                        raise
+                    self.failed(url, errorStatus(e))
+                    triesElapsed += 1
+                    delay = self.delay(triesElapsed, getattr(e, 'retryAfter', None))
+                    if triesElapsed >= self.tries or delay is None:
+                        e.givenUp = True
+                        raise
+                    if onRetry is not None:
+                        onRetry(e, triesElapsed, delay)
+                    time.sleep(delay)
+                else:
+                    self.succeeded(url)
+                    return result
+        finally:
+            self._local.calling = False
+
+    def isRetryable(self, error):
+        if getattr(error, 'givenUp', False):
+            return False
+        status = errorStatus(error)
+        if status is not None:
+            return status in self.statuses
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+    def delay(self, triesElapsed, retryAfter=None):
+        """Return how long to wait after `triesElapsed` failed tries, or None
+        if the server asked to wait (`retryAfter` seconds) for too long.
+        """
+        if retryAfter is not None and retryAfter > self.maxDelay:
+            return None
+        delay = random.uniform(0, min(self.maxDelay, self.backoff * 2 ** (triesElapsed - 1)))
+        return max(delay, retryAfter or 0)
+
+    def check(self, url):
+        """Raise HostUnavailableError if the host of `url` isn't to be sent
+        anything right now.
+        """
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            state = self._hosts.get(host)
+            wait = state[1] - time.time() if state is not None else 0
+        if wait > 0:
+            raise HostUnavailableError(host, wait)
+
+    def succeeded(self, url):
+        with self._lock:
+            self._hosts.pop(urlsplit(url).netloc.lower(), None)
+
+    def failed(self, url, status=None):
+        """Count a failed try at `url` (which got a response with `status`,
+        or none at all) towards its host's circuit breaker.
+        """
+        if status == 429:
+            return
+        with self._lock:
+            state = self._hosts.setdefault(urlsplit(url).netloc.lower(), [0, 0])
+            state[0] += 1
+            if state[0] >= self.failures:
+                state[0] = self.failures - 1
+                state[1] = time.time() + self.cooldown
+
+
+def errorStatus(error):
+    """Return the status of the response that caused `error`, or None if it
+    wasn't caused by one.
+    """
+    response = getattr(error, 'response', None)
+    return response.status_code if response is not None else None
+
+_retryPolicy = RetryPolicy()
+def getRetryPolicy():
+    """Return the RetryPolicy all requests are made with."""
+    return _retryPolicy
+
+def setRetryPolicy(policy):
+    """Set the RetryPolicy all requests are made with."""
+    global _retryPolicy
+    _retryPolicy = policy
+
+
+# The types of Events.
+ALBUM_STARTED = 'albumStarted'
+ALBUM_FETCHED = 'albumFetched'
+SONG_RESOLVED = 'songResolved'
+FILE_STARTED = 'fileStarted'
+PROGRESS = 'progress'
+RETRY = 'retry'
+SKIPPED = 'skipped'
+DONE = 'done'
+
+class Event(object):
+    """Something that happened during a download. Functions that take an
+    `events` argument call it with an Event for everything that happens,
+    possibly from several threads at once.
+
+    Properties:
+    * type: What happened - one of the following. Each type has its own
+            properties in addition to these two.
+      * ALBUM_STARTED: The soundtrack's download has started. `url` and
+                       `fetching` (True if its page is about to be fetched,
+                       False if it has been already).
+      * ALBUM_FETCHED: The soundtrack's page has been fetched and its songs
+                       are about to be looked up. `url`, `songs` (how many)
+                       and `seconds` (how long fetching and parsing took).
+      * SONG_RESOLVED: A song has been looked up. `url`, `file` (the URL of
+                       the file chosen, or None if the song doesn't exist)
+                       and `seconds`.
+      * FILE_STARTED:  A file has started downloading. `index`, `total`,
+                       `url`, `filename`, `note` (about how the filename was
+                       changed, or "") and `redownload` (True if it was there
+                       already, but incomplete).
+      * PROGRESS:      Part of a file has been downloaded. `index`, `url`,
+                       `bytes` (so far) and `totalBytes` (or None if unknown).
+      * RETRY:         A download failed and is about to be tried again.
+                       `index`, `url`, `filename`, `attempt` (starting at
+                       2), `error` and `delay` (how long until then).
+      * SKIPPED:       A file wasn't downloaded. `index`, `total`, `url`,
+                       `filename` and `reason` - either "nonexistent" (for
+                       songs that don't exist, with `url` and `filename` set
+                       to None), "exists" (with `note` as for FILE_STARTED
+                       and the file's size as `bytes`) or "stored" (linked
+                       from a ContentStore instead - the same as "exists",
+                       plus the stored file's path as `source` and `link`:
+                       "reflink", "hardlink" or "copy").
+      * DONE:          A download is over. `index`, `total`, `url`,
+                       `filename`, `success`, `bytes`, `seconds` and `error`
+                       (why it failed, or None).
+      Each file gets exactly one SKIPPED or DONE.
+    * time: When it happened, as a timestamp like time.time()'s.
+
+    Events from Soundtrack.download also have a `soundtrack` property with
+    the ID of the soundtrack.
+    """
+
+    def __init__(self, type, **properties):
+        self.type = type
+        self.time = time.time()
+        self.__dict__.update(properties)
+
+    def __repr__(self):
+        return "<{}: {}>".format(self.__class__.__name__, self.type)
+
+    def asDict(self):
+        return dict(self.__dict__)
+
+
+def sendEvent(events, type, **properties):
+    """Call `events` with an Event, unless it's None."""
+    if events is not None:
+        events(Event(type, **properties))
+
+
+def combineEvents(*subscribers):
+    """Return a function to use as an `events` argument that calls all of
+    `subscribers` that aren't None with each event - or None if none are.
+    """
+    subscribers = [subscriber for subscriber in subscribers if subscriber is not None]
+    if len(subscribers) <= 1:
+        return subscribers[0] if subscribers else None
+    def events(event):
+        for subscriber in subscribers:
+            subscriber(event)
+    return events
+
+
+class ProgressPrinter(object):
+    """Prints download progress, for use as an `events` argument. This is
+    what `verbose=True` does.
+
+    Output about each file is printed in the order of the files' indices,
+    starting at `firstIndex` (see OrderedPrinter), with `out`.
+    """
+
+    def __init__(self, firstIndex=1, out=unicodePrint):
+        self._printer = OrderedPrinter(firstIndex, out)
+
+    def __call__(self, event):
+        if event.type == ALBUM_STARTED:
+            if event.fetching:
+                self._printer.out("Getting song list...")
+            return
+        if event.type not in (FILE_STARTED, RETRY, SKIPPED, DONE):
+            return
+
+        out = self._printer.printer(event.index)
+        if event.type == FILE_STARTED:
+            if event.redownload:
+                out("{} is incomplete. Downloading it again.".format(event.filename), file=sys.stderr)
+            out("Downloading {}: {}{}...".format(
+                self._numberStr(event), event.filename, event.note))
+        elif event.type == RETRY:
+            out("Couldn't download {}. Trying again...".format(event.filename), file=sys.stderr)
+        elif event.type == SKIPPED:
+            if event.reason == 'nonexistent':
+                out("Song {} is nonexistent (404: Not Found). Skipping over.".format(
+                    self._numberStr(event)), file=sys.stderr)
+            elif event.reason == 'stored':
+                out("Skipping over {}: {}{}. Already downloaded as \"{}\".".format(
+                    self._numberStr(event), event.filename, event.note, event.source))
+            else:
+                out("Skipping over {}: {}{}. Already exists.".format(
+                    self._numberStr(event), event.filename, event.note))
+        elif not event.success:
+            out("Couldn't download {}. Skipping over.".format(event.filename), file=sys.stderr)
+
+        if event.type in (SKIPPED, DONE):
+            self._printer.finish(event.index)
+
+    @staticmethod
+    def _numberStr(event):
+        return "{}/{}".format(str(event.index).zfill(len(str(event.total))), event.total)
+
+
+class MetricsWriter(object):
+    """Writes events to the file at `path` as JSON, one per line, for use as
+    an `events` argument. Lines are added to the end if the file exists.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'ab')
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event.asDict(), separators=(',', ':'), sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line.encode('utf-8'))
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
 def lazyProperty(func):
     attrName = '_lazy_' + func.__name__
     @property
@@ -162,46 +824,750 @@ def lazyProperty(func):
     return lazyVersion
 
 
-def getSoup(*args, **kwargs):
-    r = requests.get(*args, **kwargs)
-    return toSoup(r)
+def hashFile(path, hasher=None, buffer=None):
+    """Feed the contents of the file at `path` to `hasher` (a new SHA-1 if
+    not specified), reading it into `buffer` if given, and return `hasher`.
+    """
+    hasher = hashlib.sha1() if hasher is None else hasher
+    buffer = bytearray(CHUNK_SIZE) if buffer is None else buffer
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        while True:
+            bytesRead = f.readinto(buffer)
+            if not bytesRead:
+                break
+            hasher.update(view[:bytesRead])
+    return hasher
+
+
+def makeSession(poolSize=DEFAULT_POOL_SIZE, adapter=None):
+    """Return a new requests.Session suitable for talking to KHInsider.
+    
+    Connections are kept alive and reused, up to `poolSize` per host. To
+    control connections in more detail (or to answer requests some other
+    way entirely), pass a transport adapter as `adapter`.
+    """
+    session = requests.Session()
+    if adapter is None:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_session = None
+_sessionLock = threading.Lock()
+def getSession():
+    """Return the session used when none is specified, creating it with
+    makeSession if there isn't one yet.
+    """
+    global _session
+    with _sessionLock:
+        if _session is None:
+            _session = makeSession()
+        return _session
+
+def setSession(session):
+    """Set the session used when none is specified."""
+    global _session
+    with _sessionLock:
+        _session = session
+
+def sessionProperty():
+    """Return a `session` property (stored in `_session`) that's getSession()
+    unless set to something else. Getting the default session is left until
+    it's first needed, so that objects that never make any requests (like
+    search results from the catalog) don't have to import requests.
+    """
+    def get(self):
+        if self._session is None:
+            self._session = getSession()
+        return self._session
+    def set(self, session):
+        self._session = session
+    return property(get, set)
+
+
+class CachedPage(object):
+    """A page from a PageCache. Has the parts of a requests.Response that
+    toSoup and friends use.
+    """
+
+    def __init__(self, url, content, etag=None, lastModified=None, fetchedAt=None):
+        self.url = url
+        self.content = content
+        self.etag = etag
+        self.lastModified = lastModified
+        self.fetchedAt = time.time() if fetchedAt is None else fetchedAt
+        self.status_code = 200
+
+
+class PageCache(object):
+    """An on-disk cache of HTML pages, keyed by URL.
+    
+    Pages younger than `ttl` seconds are used as they are. Older ones are
+    revalidated with If-None-Match/If-Modified-Since when the server gave an
+    ETag or Last-Modified. Once the cache grows past `maxSize` bytes, the
+    least recently used pages are removed.
+    """
 
-REMOVE_RE = re.compile(br"^</td>\s*$", re.MULTILINE)
-BAD_AMPERSAND_RE = re.compile(br"&#([^0-9x]|x[^0-9A-Fa-f])")
-def toSoup(r):
-    content = r.content
-    # Fix errors in khinsider's HTML.
-    content = REMOVE_RE.sub(b'', content)
-    content = BAD_AMPERSAND_RE.sub(b'&amp;#\1', content)
+    def __init__(self, directory=None, ttl=DEFAULT_CACHE_TTL, maxSize=DEFAULT_CACHE_SIZE):
+        self.directory = defaultCacheDirectory() if directory is None else directory
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        """Return the CachedPage for `url`, or None if it isn't cached."""
+        path = self._path(url)
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                content = f.read()
+        except (IOError, OSError, ValueError):
+            return None
+        if header.get('key') != url:
+            return None
+        try:
+            # Bump the modification time, which is what eviction goes by.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return CachedPage(header['url'], content, header.get('etag'),
+                          header.get('lastModified'), header['fetchedAt'])
+    
+    def isFresh(self, page):
+        return time.time() - page.fetchedAt < self.ttl
+
+    def put(self, url, page):
+        """Store the response or CachedPage `page` as the page for `url`."""
+        header = {
+            'key': url,
+            'url': page.url,
+            'etag': getattr(page, 'etag', None),
+            'lastModified': getattr(page, 'lastModified', None),
+            'fetchedAt': getattr(page, 'fetchedAt', time.time())
+        }
+        if hasattr(page, 'headers'):
+            header['etag'] = page.headers.get('ETag')
+            header['lastModified'] = page.headers.get('Last-Modified')
+        data = json.dumps(header).encode('utf-8') + b'\n' + page.content
+
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        path = self._path(url)
+        fd, tempPath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        with self._lock:
+            oldSize = os.path.getsize(path) if os.path.exists(path) else 0
+            replaceFile(tempPath, path)
+            if self._size is not None:
+                self._size += len(data) - oldSize
+            self._evict()
+    
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            # Pages' names are just hashes - the rest are temporary files,
+            # or not pages at all (like the Catalog).
+            if '.' in name:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        if self._size <= self.maxSize:
+            return
+        for _, size, path in sorted(self._entries()):
+            if self._size <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+    
+    def clear(self):
+        with self._lock:
+            for _, _, path in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size = 0
+
+
+_pageCache = None
+_pageCacheEnabled = True
+_pageCacheLock = threading.Lock()
+def getPageCache():
+    """Return the page cache used for KHInsider's pages, creating a PageCache
+    in defaultCacheDirectory() if there isn't one yet. Return None if caching
+    has been turned off with setPageCache(None).
+    """
+    global _pageCache
+    with _pageCacheLock:
+        if _pageCache is None and _pageCacheEnabled:
+            _pageCache = PageCache()
+        return _pageCache
+
+def setPageCache(cache):
+    """Set the page cache to use, or turn caching off by passing None."""
+    global _pageCache, _pageCacheEnabled
+    with _pageCacheLock:
+        _pageCache = cache
+        _pageCacheEnabled = cache is not None
+
+
+# Statuses servers respond with when they want us to slow down.
+BUSY_STATUSES = {429, 503}
+
+def retryAfterSeconds(response):
+    """Return how many seconds the Retry-After header of `response` asks to
+    wait for, or None if it doesn't.
+    """
+    value = (response.headers.get('Retry-After') or '').strip()
+    if value.isdigit():
+        return float(value)
+    date = parsedate_tz(value) if value else None
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - time.time())
+
+
+def raiseIfBusy(response):
+    """Raise ServerBusyError if `response` is the server asking us to slow down."""
+    if response.status_code in BUSY_STATUSES:
+        raise ServerBusyError(response)
+
+
+def requestWithRetries(session, method, url, **kwargs):
+    """Make a request with `session`, tried again as getRetryPolicy() says
+    if it fails, and return the response. Raise the same as getPage.
+    """
+    policy = getRetryPolicy()
+    def attempt():
+        r = session.request(method, url, timeout=10, **kwargs)
+        raiseIfBusy(r)
+        if r.status_code in policy.statuses:
+            r.raise_for_status()
+        return r
+    return policy.call(url, attempt)
+
+
+def getPage(url, session=None, cache=None, **kwargs):
+    """Get the page at `url`, going through the page cache `cache` (which
+    defaults to getPageCache() - pass False to not use a cache at all).
+    Return a requests.Response or a CachedPage.
+
+    The request is tried again as getRetryPolicy() says if it fails. Raise
+    ServerBusyError if the server still says it's too busy after that, and
+    requests.HTTPError if it still responds with another error worth trying
+    again after.
+    """
+    cache = getPageCache() if cache is None else cache
+    page = cache.get(url) if cache else None
+    if page is not None and cache.isFresh(page):
+        return page
+    
+    if page is not None:
+        headers = dict(kwargs.pop('headers', None) or {})
+        if page.etag:
+            headers['If-None-Match'] = page.etag
+        if page.lastModified:
+            headers['If-Modified-Since'] = page.lastModified
+        kwargs['headers'] = headers
+    session = getSession() if session is None else session
+    policy = getRetryPolicy()
+    def fetch():
+        r = session.get(url, **kwargs)
+        raiseIfBusy(r)
+        if r.status_code in policy.statuses:
+            r.raise_for_status()
+        return r
+    r = policy.call(url, fetch)
+    
+    if not cache:
+        return r
+    if r.status_code == 304 and page is not None:
+        page.fetchedAt = time.time()
+        cache.put(url, page)
+        return page
+    if r.status_code == 200:
+        cache.put(url, r)
+    return r
+
+
+def getSoup(url, session=None, cache=None, parseOnly=None, **kwargs):
+    r = getPage(url, session, cache, **kwargs)
+    return toSoup(r, parseOnly)
+
+# lxml is a lot faster than Python's own parser, so use it if it's there.
+if moduleExists('lxml'):
+    lxmlHtml = LazyModule('lxml.html')
+    PARSER = 'lxml'
+else:
+    lxmlHtml = None
+    PARSER = 'html.parser'
+
+class LazyStrainer(object):
+    """A bs4.SoupStrainer that's only made once it's used (see toSoup), so
+    it can be defined without importing Beautiful Soup.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._args = args
+        self._kwargs = kwargs
+        self._strainer = None
+
+    def get(self):
+        if self._strainer is None:
+            self._strainer = bs4.SoupStrainer(*self._args, **self._kwargs)
+        return self._strainer
+
+# Only the parts of each page that are actually used.
+ALBUM_STRAINER = LazyStrainer(id='pageContent')
+SONG_STRAINER = LazyStrainer(['p', 'a'])
+
+# Headings in album pages' song lists that aren't formats. The rest of the
+# headings are the formats the songs are available in, with their sizes.
+SONGLIST_HEADINGS = {"", "#", "CD", "Track", "Song Name", "Time", "Length", "Download", "Size"}
+FORMAT_HEADING_RE = re.compile(r'^[A-Za-z0-9]+$')
+DURATION_RE = re.compile(r'^(?:([0-9]+):)?([0-9]+):([0-9]{2})$')
+SIZE_RE = re.compile(r'^([0-9]+(?:\.[0-9]+)?)\s*([KMG]?)B$', re.IGNORECASE)
+
+def isFormatHeading(heading):
+    return heading not in SONGLIST_HEADINGS and FORMAT_HEADING_RE.match(heading) is not None
+
+def parseDuration(s):
+    """Return the number of seconds in a duration like "3:25" or "1:02:03",
+    or None if `s` isn't one.
+    """
+    m = DURATION_RE.match(s)
+    if m is None:
+        return None
+    hours, minutes, seconds = (int(n or 0) for n in m.groups())
+    return hours * 60 * 60 + minutes * 60 + seconds
+
+def parseSize(s):
+    """Return the number of bytes in a size like "3.45 MB", or None if `s`
+    isn't one. Sizes on KHInsider are rounded, so this is only roughly it.
+    """
+    m = SIZE_RE.match(s)
+    if m is None:
+        return None
+    return int(float(m.group(1)) * 1024 ** " KMG".index(m.group(2).upper() or ' '))
+
+def formatSize(size):
+    """Return the number of bytes `size` in a human-friendly way."""
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return "{:.0f} {}".format(size, unit) if unit == "B" else "{:.1f} {}".format(size, unit)
+        size /= 1024.0
+    return "{:.2f} GB".format(size)
+
+def formatDuration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}h {}m".format(hours, minutes) if hours else "{}m {}s".format(minutes, seconds)
+
+# The path used to be /ost/..., and was changed to
+# /soundtracks/... - but who knows? It might change back!
+FILE_URL_RE = re.compile(r'^https?://[^/]+/(?:soundtracks|ost)/.+$')
+FILE_LINK_STRAINER = LazyStrainer('a', href=FILE_URL_RE)
+
+# Errors in khinsider's HTML: lines with nothing but a stray </td>, and
+# ampersands followed by # that don't start a character reference.
+HTML_FIXES_RE = re.compile(br"^</td>\s*$|&(?=#(?:[^0-9x]|x[^0-9A-Fa-f]))", re.MULTILINE)
+def _htmlFix(m):
+    return b'&amp;' if m.group(0) == b'&' else b''
+
+def toSoup(r, parseOnly=None):
+    """Parse the response (or bytes) `r` from khinsider into a soup. Pass a
+    SoupStrainer (or LazyStrainer) as `parseOnly` to only parse the parts of
+    it that match.
+    """
+    if isinstance(parseOnly, LazyStrainer):
+        parseOnly = parseOnly.get()
+    content = getattr(r, 'content', r)
+    # Fix errors in khinsider's HTML, in one pass.
+    content = HTML_FIXES_RE.sub(_htmlFix, content)
 
     # BS4 outputs unsuppressable error messages when it can't
     # decode the input bytes properly. This... suppresses them.
     with Silence():
-        return BeautifulSoup(content, 'html.parser')
+        return bs4.BeautifulSoup(content, PARSER, parse_only=parseOnly)
+
+
+def songFileUrls(content):
+    """Return the URLs of the files linked to from the song page HTML
+    `content`, without making a whole soup out of it.
+    """
+    content = HTML_FIXES_RE.sub(_htmlFix, content)
+    if not content.strip():
+        return []
+    if lxmlHtml is not None:
+        hrefs = (a.get('href') for a in lxmlHtml.fromstring(content).iter('a'))
+    else:
+        with Silence():
+            soup = bs4.BeautifulSoup(content, PARSER, parse_only=FILE_LINK_STRAINER.get())
+        hrefs = (a['href'] for a in soup('a'))
+    return [href for href in hrefs if href and FILE_URL_RE.match(href)]
+
+
+def songName(page):
+    """Return the name of the song on the song page (or response, or HTML)
+    `page`.
+    """
+    return toSoup(page, SONG_STRAINER)('p')[2]('b')[1].get_text()
+
+
+# Parsing is mostly pure Python, so only one thread can be doing it at a
+# time. With a parse pool, pages are parsed in other processes instead.
+_parsePool = None
+def getParsePool():
+    """Return the pool pages are parsed in, or None if they're parsed right
+    where they're fetched (which is the default).
+    """
+    return _parsePool
+
+def setParsePool(pool):
+    """Parse pages in `pool` - a concurrent.futures.ProcessPoolExecutor (see
+    makeParsePool) - or right where they're fetched if it's None.
 
+    Only the HTML is sent to the pool, and only what's taken from it (like
+    file URLs, song names and search results) comes back. With more than a
+    couple of cores and a lot of songs being looked up at once, this makes
+    looking songs up faster; otherwise, it's mostly just overhead.
+    """
+    global _parsePool
+    _parsePool = pool
+
+def makeParsePool(workers=None):
+    """Return a pool of `workers` processes (one per core by default) for
+    setParsePool.
+
+    Pages are parsed from worker threads, so the processes aren't forked
+    from this one, where another thread might be holding a lock at the
+    time - they're started from a fork server (or from scratch where there
+    isn't one). Pythons older than 3.7 can't do that, so they start them all
+    right away instead, while there are hopefully no other threads yet.
+    """
+    import multiprocessing
+    try:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        return concurrentFutures.ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    except (AttributeError, TypeError): # Before Python 3.7.
+        pool = concurrentFutures.ProcessPoolExecutor(max_workers=workers)
+        pool.submit(int).result() # Starts every process.
+        return pool
+
+def parsePage(func, content):
+    """Return func(content) for the page HTML `content`, calling it in the
+    parse pool if there is one. `func` has to be a module-level function (so
+    that it can be sent to another process) that returns something small -
+    not a soup.
+    """
+    pool = getParsePool()
+    if pool is None:
+        return func(content)
+    return pool.submit(func, content).result()
+
+
+def urlFilename(url):
+    """Return the (unquoted) filename at the end of `url`."""
+    try:
+        url = str(url)
+    except UnicodeError:
+        # Python 2's quote and unquote work with bytestrings.
+        url = url.encode('utf-8')
+    # str('/') makes sure the string doesn't get
+    # converted to a Unicode string on Python 2.
+    filename = unquote(url.rsplit(str('/'), 1)[-1])
+    try:
+        # In Python 2, unquote doesn't handle escaped UTF-8 characters
+        # automatically, so we gotta decode them manually from bytes.
+        filename = filename.decode('utf-8')
+    except AttributeError:
+        pass
+    return filename
+
+
+def songFilename(song):
+    """Return the filename at the end of a song's page URL. It's usually
+    the same as the name of the song's MP3 file.
+    """
+    name = song.url.rsplit('/', 1)[-1]
+    # Song URLs are usually quoted twice over.
+    for _ in range(3):
+        unquoted = unquote(name)
+        if unquoted == name:
+            break
+        name = unquoted
+    return name
+
+
+def fileExtension(file):
+    return os.path.splitext(file.filename)[1][1:].lower()
+
+
+class FileUrlTemplates(object):
+    """Where a soundtrack's files are, learned from a few of its songs.
+
+    A soundtrack's files are usually all in one directory per format, and
+    named after the songs' pages. That way, once a few songs have been
+    looked up, the files of the rest can be guessed without fetching their
+    pages. Guesses still have to be checked (see File.isAvailable).
+
+    Properties:
+    * directories:   A dict of file extensions and the URL of the directory
+                     files of that format are in. Formats whose files don't
+                     follow the pattern for all of the songs are left out.
+    * defaultFormat: The format the songs list first, if it's the same for
+                     all of them.
+    """
+
+    def __init__(self, songs, availableFormats=None):
+        self.availableFormats = availableFormats
+        directories = {}
+        defaultFormats = set()
+        for song in songs:
+            stem = os.path.splitext(songFilename(song))[0]
+            defaultFormats.add(fileExtension(song.files[0]))
+            for file in song.files:
+                extension = fileExtension(file)
+                directory, name = file.url.rsplit('/', 1)
+                if name != quote((stem + '.' + extension).encode('utf-8')):
+                    directory = None
+                directories.setdefault(extension, set()).add(directory)
+        
+        self.directories = dict(
+            (extension, urls.pop()) for extension, urls in directories.items()
+            if len(urls) == 1 and None not in urls
+        )
+        self.defaultFormat = defaultFormats.pop() if len(defaultFormats) == 1 else None
+    
+    def guess(self, song, formatOrder=None):
+        """Return the File that getAppropriateFile would be expected to
+        return for `song`, or None if there's no telling.
+        """
+        if formatOrder is None:
+            formatOrder = [self.defaultFormat]
+        elif self.availableFormats is not None:
+            formatOrder = [f for f in formatOrder if f in self.availableFormats]
+        if not formatOrder or formatOrder[0] not in self.directories:
+            # Can't guess a song only has the later ones.
+            return None
+        
+        extension = formatOrder[0]
+        stem = os.path.splitext(songFilename(song))[0]
+        url = self.directories[extension] + '/' + quote((stem + '.' + extension).encode('utf-8'))
+        return File(url, song.session)
+
+
+def getAppropriateFile(song, formatOrder, templates=None, limiter=None):
+    """Return the File of `song` that's in the format that comes first in
+    `formatOrder`, or its first one if None of them are available.
+
+    If FileUrlTemplates are given as `templates`, try guessing the file
+    first, and only look the song up if the guess turns out wrong. The
+    guess is checked holding a slot of the HostLimiter `limiter`, if given
+    (see File.isAvailable).
+    """
+    if templates is not None:
+        file = templates.guess(song, formatOrder)
+        if file is not None and file.isAvailable(limiter):
+            return file
 
-def getAppropriateFile(song, formatOrder):
     if formatOrder is None:
         return song.files[0]
     
     for extension in formatOrder:
         for file in song.files:
-            if os.path.splitext(file.filename)[1][1:].lower() == extension:
+            if fileExtension(file) == extension:
                 return file
     
     return song.files[0]
 
 
-def friendlyDownloadFile(file, path, index, total, verbose=False):
-    numberStr = "{}/{}".format(
-        str(index).zfill(len(str(total))),
-        str(total)
-    )
+def boundedMap(func, items, jobs, executor=None):
+    """Return [func(item) for item in items], but with up to `jobs` of the
+    calls running at once on `executor` - or on a thread pool of its own if
+    not specified. Sharing an executor between several boundedMaps at once
+    makes them take turns, since each only has `jobs` calls queued at a time.
 
-    if file is None and verbose:
-        print("Song {} is nonexistent (404: Not Found). Skipping over.".format(numberStr), file=sys.stderr)
-        return False
+    Items are only taken from `items` as there's room for them, so it can be
+    an iterator that's still working on the later ones (see boundedIter).
+    
+    The first exception raised by a call is raised, after cancelling the
+    calls that haven't started yet.
+    """
+    if executor is None and jobs <= 1:
+        return [func(item) for item in items]
+    
+    ownExecutor = executor is None
+    if ownExecutor:
+        executor = concurrentFutures.ThreadPoolExecutor(max_workers=jobs)
+    slots = threading.BoundedSemaphore(max(jobs, 1))
+    def run(item):
+        try:
+            return func(item)
+        finally:
+            slots.release()
 
+    futures = []
+    try:
+        for item in items:
+            slots.acquire()
+            futures.append(executor.submit(run, item))
+        return [future.result() for future in futures]
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        if ownExecutor:
+            executor.shutdown(wait=False)
+
+
+def boundedIter(func, items, jobs, executor=None):
+    """Yield func(item) for each item in `items`, in order, with the calls for
+    up to `jobs` items running at once on `executor` (see boundedMap). Each
+    result is yielded as soon as it's ready, while the ones after it are
+    still being worked on.
+
+    Exceptions are raised when their item's turn comes. If the generator
+    is closed early, the calls that haven't started yet are cancelled.
+    """
+    items = iter(items)
+    if executor is None and jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+    
+    ownExecutor = executor is None
+    if ownExecutor:
+        executor = concurrentFutures.ThreadPoolExecutor(max_workers=jobs)
+    futures = deque()
+    try:
+        while True:
+            for item in items:
+                futures.append(executor.submit(func, item))
+                if len(futures) >= jobs:
+                    break
+            if not futures:
+                return
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+        if ownExecutor:
+            executor.shutdown(wait=False)
+
+
+def resolveSongs(songs, formatOrder=None, jobs=DEFAULT_RESOLVE_JOBS, templates=None,
+                 executor=None, events=None, limiter=None):
+    """Return a list with the appropriate File for each Song in `songs` (see
+    getAppropriateFile), in the same order as `songs`. Songs that don't exist
+    get None instead of a File.
+
+    The arguments are the same as for iterResolvedSongs.
+    """
+    return list(iterResolvedSongs(songs, formatOrder, jobs, templates,
+                                  executor, events, limiter))
+
+
+def iterResolvedSongs(songs, formatOrder=None, jobs=DEFAULT_RESOLVE_JOBS, templates=None,
+                      executor=None, events=None, limiter=None):
+    """Yield the appropriate File for each Song in `songs` (see
+    getAppropriateFile), in the same order as `songs`, as soon as it's been
+    found. Songs that don't exist get None instead of a File.
+
+    Up to `jobs` song pages are fetched (or guesses from `templates` checked)
+    at once, on `executor` if given (see boundedIter). A SONG_RESOLVED Event
+    is sent to `events` for each song.
+
+    Pass a HostLimiter as `limiter` to have it limit the requests instead of
+    `jobs` (which then only caps how many may be running at most). Songs are
+    tried again as getRetryPolicy() says if looking them up fails, and the
+    limiter backs off when the server says it's busy.
+    """
+    limiter = HostLimiter(jobs) if limiter is None else limiter
+    policy = getRetryPolicy()
+    def resolve(song):
+        start = time.time()
+        def attempt():
+            # A guess is checked with a slot for the file's host, and only
+            # the song page (if it comes to that) needs one for KHInsider's.
+            file = templates.guess(song, formatOrder) if templates is not None else None
+            if file is not None and file.isAvailable(limiter):
+                return file
+            limiter.acquire(song.url)
+            try:
+                return getAppropriateFile(song, formatOrder)
+            except NonexistentSongError:
+                return None
+            finally:
+                limiter.release(song.url)
+        def onRetry(error, triesElapsed, delay):
+            if isinstance(error, ServerBusyError):
+                limiter.backOff(error.response.url or song.url, error.retryAfter)
+        file = policy.call(song.url, attempt, onRetry)
+        
+        # Only pages that were actually fetched say anything about the server.
+        if song._elapsed is not None:
+            limiter.record(song.url, song._elapsed)
+        sendEvent(events, SONG_RESOLVED, url=song.url,
+                  file=file.url if file is not None else None,
+                  seconds=time.time() - start)
+        return file
+    
+    return boundedIter(resolve, songs, jobs, executor)
+
+
+def maxJobs(jobs, adaptive):
+    """Return how many jobs may end up running at once when starting out at
+    `jobs`, with adaptive limits or without (see HostLimiter).
+    """
+    return jobs * ADAPTIVE_GROWTH if adaptive else jobs
+
+
+def poolSize(jobs, segments=1, adaptive=False):
+    """Return how many connections a session (see makeSession) needs to keep
+    open per host for `jobs` files to be downloaded at once in `segments`
+    parts each.
+    """
+    return max(DEFAULT_POOL_SIZE, maxJobs(jobs, adaptive) * max(segments, 1))
+
+
+def bandwidthLimiter(bandwidth):
+    """Return `bandwidth` as a BandwidthLimiter if it's a number of bytes per
+    second, or as it is if it's already one (or None).
+    """
+    if bandwidth is None or isinstance(bandwidth, BandwidthLimiter):
+        return bandwidth
+    return BandwidthLimiter(bandwidth)
+
+
+def localFilename(file):
+    """Return the name to save `file` as on this system, and a note to add
+    to messages about it if it had to be changed.
+    """
     encoding = sys.getfilesystemencoding()
     # Fun(?) fact: on Python 2, sys.getfilesystemencoding returns 'mbcs' even
     # on Windows NT (1993!) and later where filenames are natively Unicode.
@@ -212,38 +1578,518 @@ def friendlyDownloadFile(file, path, index, total, verbose=False):
     if filename != file.filename:
         byTheWay = " (replaced characters not in the filesystem's \"{}\" encoding)".format(encoding)
     
-    filename = to_valid_filename(filename)
-    path = os.path.join(path, filename)
+    return to_valid_filename(filename), byTheWay
+
+
+class Manifest(object):
+    """A record of the files downloaded to a directory, stored in the file
+    MANIFEST_FILENAME in it.
+
+    Each entry is keyed by where the file came from (a song's URL, or the
+    file's own URL for images), and holds the URL of the file that was
+    chosen, its filename, its size, and its SHA-1. Entries recorded with a
+    different `formatOrder` are ignored, since they may be in the wrong format.
+    """
+
+    def __init__(self, directory, formatOrder=None):
+        self.path = os.path.join(directory, MANIFEST_FILENAME)
+        self.formatOrder = list(formatOrder) if formatOrder else None
+        self._lock = threading.Lock()
+        self._entries = {}
+
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('formatOrder') == self.formatOrder:
+            self._entries = data.get('files', {})
     
-    if not os.path.exists(path):
-        if verbose:
-            unicodePrint("Downloading {}: {}{}...".format(numberStr, filename, byTheWay))
-        for triesElapsed in range(3):
-            if verbose and triesElapsed:
-                unicodePrint("Couldn't download {}. Trying again...".format(filename), file=sys.stderr)
+    def get(self, key):
+        """Return the entry for `key` as a dict, or None if there is none."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def record(self, key, file, filename, size, sha1):
+        with self._lock:
+            self._entries[key] = {
+                'url': file.url,
+                'filename': filename,
+                'size': size,
+                'sha1': sha1
+            }
+    
+    def save(self):
+        with self._lock:
+            data = {'formatOrder': self.formatOrder, 'files': self._entries}
+            data = json.dumps(data, separators=(',', ':'), sort_keys=True)
+        directory = os.path.dirname(self.path)
+        fd, tempPath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data.encode('utf-8'))
+        replaceFile(tempPath, self.path)
+
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+# The Linux ioctl for making a file a copy-on-write clone of another.
+FICLONE = 0x40049409
+
+def reflink(source, destination):
+    """Make `destination` a copy-on-write clone of the file at `source`, which
+    takes no extra space until one of them is changed. Only some filesystems
+    can (like Btrfs and XFS, on Linux) - raise IOError or OSError if not.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks aren't supported here.")
+    with open(source, 'rb') as sourceFile:
+        with open(destination, 'wb') as destinationFile:
             try:
-                file.download(path)
-            except (requests.ConnectionError, requests.Timeout):
-                pass
-            else:
-                break
-        else:
-            if verbose:
-                unicodePrint("Couldn't download {}. Skipping over.".format(filename), file=sys.stderr)
-            return False
-    else:
-        if verbose:
-            unicodePrint("Skipping over {}: {}{}. Already exists.".format(numberStr, filename, byTheWay))
+                fcntl.ioctl(destinationFile.fileno(), FICLONE, sourceFile.fileno())
+            except (IOError, OSError):
+                destinationFile.close()
+                os.remove(destination)
+                raise
+
+
+def defaultStorePath():
+    return os.path.join(defaultCacheDirectory(), 'store.sqlite3')
+
+# Files with other URLs than a stored one of the same size are compared at
+# this many places, this many bytes each, before being taken to be the same.
+STORE_SAMPLES = 3
+STORE_SAMPLE_SIZE = 16 * 1024
+
+class ContentStore(object):
+    """An index of the files that have been downloaded and where they are,
+    kept in an SQLite database at `path`, so that files that are already
+    on disk somewhere - in another album, say, since compilations and
+    re-releases often have the same files - don't have to be downloaded
+    again (see friendlyDownloadFile).
+
+    Files are indexed by URL and by size and SHA-1. Before a file is
+    downloaded, a HEAD request finds out its size. If its URL has been
+    downloaded before at that size, or a few samples of it (fetched with
+    Range requests) match a stored file of the same size, the stored file
+    is linked to instead. Stored files that have been changed or deleted
+    since are noticed, and not used.
+
+    Copies are reflinks if the filesystem can make them, and hardlinks if
+    not - unless `hardlinks` is False, in which case they're plain copies
+    (which still saves downloading them). Hardlinks are the same file
+    under two names, so changing one (retagging it, say) changes the other.
+
+    Properties:
+    * path:       The path of the database.
+    * savedFiles: How many files have been linked instead of downloaded.
+    * savedBytes: How many bytes that's saved downloading.
+    """
+
+    def __init__(self, path=None, hardlinks=True):
+        if sqlite3 is None:
+            raise KhinsiderError("The content store needs Python's sqlite3 module.")
+        self.path = defaultStorePath() if path is None else path
+        self.hardlinks = hardlinks
+        self.savedFiles = 0
+        self.savedBytes = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connection(self):
+        if self._db is not None:
+            return self._db
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS urls '
+                       '(url TEXT PRIMARY KEY, size INTEGER, sha1 TEXT)')
+            db.execute('CREATE TABLE IF NOT EXISTS copies '
+                       '(path TEXT PRIMARY KEY, size INTEGER, sha1 TEXT, mtime REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS copiesBySize ON copies (size, sha1)')
+        self._db = db
+        return db
+
+    def add(self, file, path, size, sha1):
+        """Record that `file` (a File) is at `path`, with the size `size` and
+        the SHA-1 hex digest `sha1`.
+        """
+        path = os.path.abspath(path)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return
+        with self._lock:
+            db = self._connection()
+            with db:
+                db.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?)', (file.url, size, sha1))
+                db.execute('INSERT OR REPLACE INTO copies VALUES (?, ?, ?, ?)',
+                           (path, size, sha1, mtime))
+
+    def _copy(self, size, sha1):
+        """Return the path of a stored file with `size` and `sha1` that's
+        still as it was, or None if there is none.
+        """
+        with self._lock:
+            rows = self._connection().execute(
+                'SELECT path, mtime FROM copies WHERE size = ? AND sha1 = ?', (size, sha1)).fetchall()
+        for path, mtime in rows:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is not None and stat.st_size == size:
+                if stat.st_mtime == mtime:
+                    return path
+                # Changed, but maybe not its contents.
+                if hashFile(path).hexdigest() == sha1:
+                    with self._lock:
+                        with self._connection() as db:
+                            db.execute('UPDATE copies SET mtime = ? WHERE path = ?',
+                                       (stat.st_mtime, path))
+                    return path
+            with self._lock:
+                with self._connection() as db:
+                    db.execute('DELETE FROM copies WHERE path = ?', (path,))
+        return None
+
+    def find(self, file):
+        """Return the path, size and SHA-1 of a stored file that's the same
+        as `file` (a File), or None if there isn't one.
+        """
+        with self._lock:
+            db = self._connection()
+            if db.execute('SELECT 1 FROM copies LIMIT 1').fetchone() is None:
+                return None # Nothing to ask the server about.
+            known = db.execute('SELECT size, sha1 FROM urls WHERE url = ?', (file.url,)).fetchone()
+
+        r = requestWithRetries(file.session, 'HEAD', file.url, allow_redirects=True)
+        size = r.headers.get('Content-Length')
+        if not r.ok or size is None or not size.isdigit():
+            return None
+        size = int(size)
+        
+        if known is not None and known[0] == size:
+            path = self._copy(size, known[1])
+            if path is not None:
+                return path, size, known[1]
+        
+        # Any smaller, and the samples would be about as much as the file.
+        if size < 4 * STORE_SAMPLES * STORE_SAMPLE_SIZE:
+            return None
+        with self._lock:
+            candidates = [row[0] for row in self._connection().execute(
+                'SELECT DISTINCT sha1 FROM copies WHERE size = ?', (size,))]
+        if not candidates:
+            return None
+        samples = self._samples(r.url, file.session, size)
+        if samples is None:
+            return None
+        for sha1 in candidates:
+            path = self._copy(size, sha1)
+            if path is not None and self._matches(path, samples):
+                return path, size, sha1
+        return None
+
+    def _samples(self, url, session, size):
+        """Return a list of the offsets and bytes of a few parts of the file
+        at `url`, or None if the server won't send parts of it.
+        """
+        samples = []
+        step = (size - STORE_SAMPLE_SIZE) // (STORE_SAMPLES - 1)
+        for offset in range(0, size - STORE_SAMPLE_SIZE + 1, step)[:STORE_SAMPLES]:
+            headers = {'Range': 'bytes={}-{}'.format(offset, offset + STORE_SAMPLE_SIZE - 1)}
+            r = requestWithRetries(session, 'GET', url, headers=headers)
+            if r.status_code != 206 or len(r.content) != STORE_SAMPLE_SIZE:
+                return None
+            samples.append((offset, r.content))
+        return samples
+
+    @staticmethod
+    def _matches(path, samples):
+        with open(path, 'rb') as f:
+            for offset, data in samples:
+                f.seek(offset)
+                if f.read(len(data)) != data:
+                    return False
+        return True
+
+    def link(self, file, source, path, size, sha1):
+        """Put a copy of the stored file at `source` at `path` for `file` (a
+        File), and record it. Return how it was copied: 'reflink',
+        'hardlink' or 'copy'.
+
+        Raise IOError or OSError if it can't be copied at all.
+        """
+        partPath = path + PART_SUFFIX
+        if os.path.exists(partPath):
+            os.remove(partPath)
+        try:
+            try:
+                reflink(source, partPath)
+                how = 'reflink'
+            except (IOError, OSError):
+                try:
+                    if not self.hardlinks:
+                        raise OSError(errno.EPERM, "Hardlinks are turned off.")
+                    os.link(source, partPath)
+                    how = 'hardlink'
+                except (AttributeError, OSError): # No os.link on Python 2 on Windows.
+                    shutil.copyfile(source, partPath)
+                    how = 'copy'
+            replaceFile(partPath, path)
+        except (IOError, OSError):
+            if os.path.exists(partPath):
+                os.remove(partPath)
+            raise
+        self.add(file, path, size, sha1)
+        with self._lock:
+            self.savedFiles += 1
+            self.savedBytes += size
+        return how
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+_contentStore = None
+def getContentStore():
+    """Return the ContentStore downloads are checked against and recorded
+    in, or None if there isn't one (which is the default).
+    """
+    return _contentStore
+
+def setContentStore(store):
+    """Set the ContentStore for downloads to use, or None not to use one."""
+    global _contentStore
+    _contentStore = store
+
+
+def friendlyDownloadFile(file, path, index, total, verbose=False,
+                         out=unicodePrint, limiter=None, manifest=None, key=None,
+                         events=None, bandwidth=None, segments=1, store=None):
+    """Download `file` into the directory `path`, unless it's already there.
+    `index` and `total` are only used for the progress output, which is
+    printed with `out` if `verbose` is set to True, and for the Events sent
+    to `events`. Set `limiter` to a HostLimiter to have it limit the
+    connection (and learn how the host's doing), and `bandwidth` to a
+    BandwidthLimiter to limit the download speed. Big files are downloaded
+    in `segments` parts at once (see File.download).
+
+    Failed downloads are tried again as getRetryPolicy() says - connection
+    errors, timeouts and statuses like 503 are, after waiting a while (and
+    for at least as long as the server asks to). Other HTTP errors aren't,
+    since they wouldn't turn out any different.
+
+    If `manifest` is given, the file is recorded in it under `key` - and if
+    it's already there with a different size than recorded, it's taken to be
+    incomplete and downloaded again.
+
+    If `store` (which defaults to getContentStore() - pass False to not use
+    one) has the same file somewhere else already, it's linked to instead of
+    downloaded (see ContentStore) - or downloaded after all if that fails.
+    Downloaded files are recorded in it.
+
+    Return True if the file is there now, False if not.
+    """
+    if verbose:
+        events = combineEvents(events, ProgressPrinter(index, out))
+
+    if file is None:
+        sendEvent(events, SKIPPED, index=index, total=total, url=None, filename=None,
+                  reason='nonexistent')
+        return False
 
+    filename, byTheWay = localFilename(file)
+    path = os.path.join(path, filename)
+
+    entry = manifest.get(key) if manifest is not None else None
+    if entry is not None and (entry['url'] != file.url or entry['filename'] != filename):
+        entry = None
+    
+    exists = os.path.exists(path)
+    redownload = exists and entry is not None and os.path.getsize(path) != entry['size']
+    
+    store = getContentStore() if store is None else store
+    if exists and not redownload:
+        size = os.path.getsize(path)
+        sha1 = entry['sha1'] if entry is not None else None
+        if sha1 is None and (manifest is not None or store):
+            sha1 = hashFile(path).hexdigest()
+        if manifest is not None and entry is None:
+            manifest.record(key, file, filename, size, sha1)
+        if store:
+            store.add(file, path, size, sha1)
+        sendEvent(events, SKIPPED, index=index, total=total, url=file.url, filename=filename,
+                  note=byTheWay, reason='exists', bytes=size)
+        return True
+
+    limiter = HostLimiter() if limiter is None else limiter
+    if store:
+        limiter.acquire(file.url)
+        try:
+            stored = store.find(file)
+        except (ServerBusyError, HostUnavailableError, requests.RequestException):
+            stored = None # It'll just be downloaded, then.
+        finally:
+            limiter.release(file.url)
+        if stored is not None:
+            source, size, sha1 = stored
+            try:
+                how = store.link(file, source, path, size, sha1)
+            except (IOError, OSError):
+                # Say, the store's on another drive that's since filled up.
+                stored = None
+        if stored is not None:
+            if manifest is not None:
+                manifest.record(key, file, filename, size, sha1)
+            sendEvent(events, SKIPPED, index=index, total=total, url=file.url, filename=filename,
+                      note=byTheWay, reason='stored', bytes=size, source=source, link=how)
+            return True
+
+    sendEvent(events, FILE_STARTED, index=index, total=total, url=file.url,
+              filename=filename, note=byTheWay, redownload=redownload)
+    start = time.time()
+    state = {'requested': start, 'bytes': None, 'lastEvent': start}
+    def progress(bytesSoFar, totalBytes):
+        now = time.time()
+        if state['bytes'] is None:
+            # The first call is as soon as the server has responded.
+            limiter.record(file.url, now - state['requested'])
+        elif bandwidth is not None:
+            bandwidth.consume(bytesSoFar - state['bytes'])
+        state['bytes'] = bytesSoFar
+        if now - state['lastEvent'] >= PROGRESS_INTERVAL:
+            state['lastEvent'] = now
+            sendEvent(events, PROGRESS, index=index, url=file.url,
+                      bytes=bytesSoFar, totalBytes=totalBytes)
+
+    def attempt():
+        limiter.acquire(file.url)
+        state['requested'], state['bytes'] = time.time(), None
+        try:
+            return file.download(path, progress=progress, segments=segments, limiter=limiter)
+        finally:
+            limiter.release(file.url)
+    def onRetry(error, triesElapsed, delay):
+        if isinstance(error, ServerBusyError):
+            limiter.backOff(file.url, error.retryAfter)
+        sendEvent(events, RETRY, index=index, url=file.url, filename=filename,
+                  attempt=triesElapsed + 1, error=str(error), delay=delay)
+
+    size = None
+    error = None
+    try:
+        try:
+            size, sha1 = getRetryPolicy().call(file.url, attempt, onRetry)
+        except (ServerBusyError, HostUnavailableError, requests.RequestException) as e:
+            error = e
+    finally:
+        sendEvent(events, DONE, index=index, total=total, url=file.url, filename=filename,
+                  success=size is not None, bytes=size, seconds=time.time() - start,
+                  error=str(error) if size is None and error is not None else None)
+    
+    if size is None:
+        return False
+    if manifest is not None:
+        manifest.record(key, file, filename, size, sha1)
+    if store:
+        store.add(file, path, size, sha1)
     return True
 
 
+def downloadFiles(files, path, verbose=False,
+                  jobs=DEFAULT_JOBS, jobsPerHost=DEFAULT_JOBS_PER_HOST,
+                  manifest=None, keys=None, executor=None, limiter=None,
+                  events=None, adaptive=False, bandwidth=None, total=None, segments=1):
+    """Download every File in `files` into the directory `path`, up to `jobs`
+    at once and at most `jobsPerHost` at once from the same host. Entries
+    that are None (nonexistent songs) count as failures.
+
+    `files` may be an iterator that's still resolving the later files (see
+    Soundtrack.iterFiles) - each file starts downloading as soon as it's
+    there. If so, pass how many files there'll be as `total`.
+
+    If `adaptive` is set to True, those limits are only where to start -
+    they go up while the hosts keep up, and down when they struggle (see
+    HostLimiter). `bandwidth` limits the total download speed, in bytes per
+    second or as a BandwidthLimiter to share with other downloads. Files
+    of SEGMENT_THRESHOLD bytes or more are downloaded in `segments` parts
+    at once, each over its own connection (see File.download).
+
+    Progress is printed in order if `verbose` is set to True, numbered by
+    each file's position in `files`, and sent to `events` (see Event).
+
+    If `manifest` is given, each file is checked against and recorded in it
+    under the corresponding key in `keys` (see friendlyDownloadFile).
+
+    To share workers and connection limits with other downloads, pass an
+    `executor` (see boundedMap) and a HostLimiter as `limiter`, which takes
+    the place of `jobsPerHost` and `adaptive`.
+
+    Return True if all files were downloaded successfully, False if not.
+    """
+    if total is None:
+        files = list(files)
+        total = len(files)
+    keys = [None] * total if keys is None else keys
+
+    if verbose:
+        events = combineEvents(events, ProgressPrinter())
+    limiter = HostLimiter(jobsPerHost, adaptive) if limiter is None else limiter
+    bandwidth = bandwidthLimiter(bandwidth)
+    def downloadOne(item):
+        fileNumber, (file, key) = item
+        return friendlyDownloadFile(file, path, fileNumber, total, limiter=limiter,
+                                    manifest=manifest, key=key, events=events,
+                                    bandwidth=bandwidth, segments=segments)
+
+    # Exceptions other than the ones friendlyDownloadFile handles are
+    # raised here, just as they would've been if downloading one by one.
+    results = boundedMap(downloadOne, enumerate(zip(files, keys), 1),
+                         maxJobs(jobs, limiter.adaptive), executor)
+    return all(results)
+
+
 class KhinsiderError(Exception):
     pass
 
 class NonexistentSongError(KhinsiderError):
     pass
 
+class ServerBusyError(KhinsiderError, IOError):
+    """The server responded with one of BUSY_STATUSES. `response` is that
+    response, and `retryAfter` is how many seconds it asked to wait
+    (DEFAULT_RETRY_AFTER if it didn't say).
+    """
+    def __init__(self, response):
+        super(ServerBusyError, self).__init__(
+            "{} {} for {}".format(response.status_code, response.reason, response.url))
+        self.response = response
+        retryAfter = retryAfterSeconds(response)
+        self.retryAfter = DEFAULT_RETRY_AFTER if retryAfter is None else retryAfter
+
+class HostUnavailableError(KhinsiderError, IOError):
+    """Requests to `host` have failed too many times in a row, so nothing
+    more is sent there for `wait` more seconds (see RetryPolicy).
+    """
+    def __init__(self, host, wait):
+        super(HostUnavailableError, self).__init__(
+            "{} has failed too many times in a row - not trying it again for "
+            "{:.0f} seconds".format(host, wait))
+        self.host = host
+        self.wait = wait
+
 class SoundtrackError(Exception):
     def __init__(self, soundtrack):
         self.soundtrack = soundtrack
@@ -275,11 +2121,21 @@ class Soundtrack(object):
     * availableFormats: A list of the formats the soundtrack is available in.
     * songs:  A list of Song objects representing the songs in the soundtrack.
     * images: A list of File objects representing the images in the soundtrack.
+    * session: The requests.Session used for all of the soundtrack's requests
+               (including its songs' and files'). Defaults to getSession().
     """
 
-    def __init__(self, soundtrackId):
+    # Soundtracks (and their songs and files) only keep what's been read from
+    # their pages, not the pages themselves, so there can be a lot of them.
+    __slots__ = ('id', 'url', '_session', '_fetchSeconds', '_lazy_name',
+                 '_lazy_availableFormats', '_lazy_songs', '_lazy_images')
+
+    session = sessionProperty()
+
+    def __init__(self, soundtrackId, session=None):
         self.id = soundtrackId
         self.url = urljoin(BASE_URL, 'game-soundtracks/album/' + self.id)
+        self._session = session
     
     def __repr__(self):
         return "<{}: {}>".format(self.__class__.__name__, self.id)
@@ -287,9 +2143,36 @@ class Soundtrack(object):
     def _isLoaded(self, property):
         return hasattr(self, '_lazy_' + property)
 
-    @lazyProperty
-    def _contentSoup(self):
-        soup = getSoup(self.url)
+    def _load(self):
+        start = time.time()
+        page = getPage(self.url, self._session)
+        self._fetchSeconds = time.time() - start
+        self._loadPage(page)
+
+    def _loadPage(self, page):
+        """Read everything there is to know about the soundtrack from its
+        album page `page`, all at once.
+        """
+        contentSoup = self._parseAlbumPage(page)
+        if not self._isLoaded('name'):
+            self._lazy_name = '{}'.format(next(contentSoup.find('h2').stripped_strings))
+        
+        table = contentSoup.find('table', id='songlist')
+        header = table.find('tr')
+        headings = [td.get_text(strip=True) for td in header(['th', 'td'])]
+        formats = [s.lower() for s in headings if isFormatHeading(s)]
+        self._lazy_availableFormats = formats or ['mp3']
+        self._lazy_songs = self._songsInTable(table, headings)
+
+        # Currently, the table with the images is always present, but if
+        # it's ever removed for imageless albums, it should be handled
+        # gracefully.
+        imageTable = contentSoup.find('table')
+        anchors = [a for a in imageTable('a') if a.find('img')] if imageTable else []
+        self._lazy_images = [File(urljoin(self.url, a['href']), self._session) for a in anchors]
+    
+    def _parseAlbumPage(self, page):
+        soup = toSoup(page, ALBUM_STRAINER)
         contentSoup = soup.find(id='pageContent')
         if contentSoup.find('p').string == "No such album":
             # The pageContent and p exist even if the soundtrack doesn't, so no
@@ -297,41 +2180,60 @@ class Soundtrack(object):
             raise NonexistentSoundtrackError(self)
         return contentSoup
 
+    def _songsInTable(self, table, headings):
+        songs = []
+        for tr in table('tr'):
+            if tr.find('th'):
+                continue
+            song = Song(urljoin(self.url, tr.find('a')['href']), self._session)
+            # The rest of what's known about the song is in the row too.
+            cells = [td.get_text(strip=True) for td in tr('td')]
+            if len(cells) == len(headings):
+                for heading, cell in zip(headings, cells):
+                    if heading == "Song Name":
+                        song._lazy_name = cell
+                    elif isFormatHeading(heading):
+                        size = parseSize(cell)
+                        if size is not None:
+                            song.sizes[heading.lower()] = size
+                    elif song.duration is None:
+                        song.duration = parseDuration(cell)
+            songs.append(song)
+        return songs
+
     @lazyProperty
     def name(self):
-        return next(self._contentSoup.find('h2').stripped_strings)
+        self._load()
+        return self._lazy_name
 
     @lazyProperty
     def availableFormats(self):
-        table = self._contentSoup.find('table', id='songlist')
-        header = table.find('tr')
-        headings = [td.get_text(strip=True) for td in header(['th', 'td'])]
-        formats = [s.lower() for s in headings if s not in {"", "Track", "Song Name", "Download", "Size"}]
-        formats = formats or ['mp3']
-        return formats
+        self._load()
+        return self._lazy_availableFormats
 
     @lazyProperty
     def songs(self):
-        table = self._contentSoup.find('table', id='songlist')
-        anchors = [tr.find('a') for tr in table('tr') if not tr.find('th')]
-        urls = [a['href'] for a in anchors]
-        songs = [Song(urljoin(self.url, url)) for url in urls]
-        return songs
+        self._load()
+        return self._lazy_songs
     
     @lazyProperty
     def images(self):
-        table = self._contentSoup.find('table')
-        if not table:
-            # Currently, the table is always present, but if it's ever removed
-            # for imageless albums, it should be handled gracefully.
-            return []
-        anchors = [a for a in table('a') if a.find('img')]
-        urls = [a['href'] for a in anchors]
-        images = [File(urljoin(self.url, url)) for url in urls]
-        print(images)
-        return images
-
-    def download(self, path='', makeDirs=True, formatOrder=None, verbose=False):
+        self._load()
+        return self._lazy_images
+
+    def plan(self, formatOrder=None):
+        """Return a SoundtrackPlan of what downloading the soundtrack in the
+        formats in `formatOrder` (see download) would get. Only the album
+        page is needed for it - none of the songs are looked up.
+        """
+        return SoundtrackPlan(self, formatOrder)
+
+    def download(self, path='', makeDirs=True, formatOrder=None, verbose=False,
+                 resolveJobs=DEFAULT_RESOLVE_JOBS, jobs=DEFAULT_JOBS,
+                 jobsPerHost=DEFAULT_JOBS_PER_HOST, guessUrls=False,
+                 executor=None, limiter=None, events=None, adaptive=False,
+                 bandwidth=None, resolveLimiter=None, segments=1, archive=None,
+                 archiveFormat=None):
         """Download the soundtrack to the directory specified by `path`!
         
         Create any directories that are missing if `makeDirs` is set to True.
@@ -341,37 +2243,206 @@ class Soundtrack(object):
         example, FLAC files will be downloaded if available - if not, Ogg
         files, and if those aren't available, MP3 files.
         
-        Print progress along the way if `verbose` is set to True.
+        Print progress along the way if `verbose` is set to True. To keep
+        track of it some other way, pass a function as `events` - it's called
+        with an Event for each step of the way (see Event).
+
+        `resolveJobs` is how many song pages to fetch at once while finding
+        out which files to download. `jobs` is how many files to download at
+        once, and `jobsPerHost` how many of those may be from the same host.
+        If `adaptive` is set to True, these are only where to start - they go
+        up while the servers keep up, and down when they're struggling or
+        ask us to slow down (see HostLimiter). Set `bandwidth` to limit the
+        download speed, in bytes per second, and `segments` to download big
+        files in that many parts at once (see downloadFiles).
+
+        If `guessUrls` is set to True, only a few songs are looked up, and
+        the files of the rest are guessed from those (see FileUrlTemplates).
+        Only songs whose guesses turn out wrong are looked up after that.
+
+        What's been downloaded is recorded in a Manifest in the directory.
+        Songs that are in it from an earlier download aren't looked up again,
+        and their files are only downloaded again if their sizes are off.
+
+        To share workers and connection limits with other downloads, pass an
+        `executor`, a HostLimiter as `limiter` (see downloadFiles) and
+        another for looking songs up as `resolveLimiter`.
+
+        To download everything into a single zip or tar file instead, pass
+        its path (or a binary file object to write it to) as `archive`. The
+        format goes by the extension (or is zip), unless it's given as
+        `archiveFormat` (see openArchive). The files are streamed straight
+        into it as they're downloaded (see downloadToArchive), and `path` and
+        `segments` aren't used. Archives are always made from scratch, since
+        there's no manifest to go by.
 
         Return True if all files were downloaded successfully, False if not.
         """
-        path = os.path.join(getcwd(), path)
+        if archive is not None:
+            path = os.path.dirname(archive) if not hasattr(archive, 'write') else None
+        path = os.path.join(getcwd(), path or '')
         path = os.path.abspath(os.path.realpath(path))
+
+        if events is not None:
+            subscriber = events
+            def events(event):
+                event.soundtrack = self.id
+                subscriber(event)
+        if verbose:
+            events = combineEvents(events, ProgressPrinter())
+        sendEvent(events, ALBUM_STARTED, url=self.url, fetching=not self._isLoaded('songs'))
+
         if formatOrder:
             formatOrder = [extension.lower() for extension in formatOrder]
             if not set(self.availableFormats) & set(formatOrder):
                 raise NonexistentFormatsError(self, formatOrder)
 
-        if verbose and not self._isLoaded('songs'):
-            print("Getting song list...")
-        files = []
-        for song in self.songs:
-            try:
-                files.append(getAppropriateFile(song, formatOrder))
-            except NonexistentSongError:
-                files.append(None)
-        files.extend(self.images)
-        totalFiles = len(files)
+        manifest = Manifest(path, formatOrder) if archive is None else None
+        start = time.time()
+        songs = self.songs
+        sendEvent(events, ALBUM_FETCHED, url=self.url, songs=len(songs),
+                  seconds=getattr(self, '_fetchSeconds', 0) + time.time() - start)
+        unresolved = [song for song in songs
+                      if manifest is None or manifest.get(song.url) is None]
+        if resolveLimiter is None:
+            resolveLimiter = HostLimiter(resolveJobs, adaptive)
+        resolved = self.iterFiles(formatOrder, resolveJobs, guessUrls, executor,
+                                  events, resolveLimiter, unresolved)
+        images = self.images
+        # Songs are looked up while the files before them are downloading.
+        def files():
+            for song in songs:
+                entry = manifest.get(song.url) if manifest is not None else None
+                yield File(entry['url'], self._session) if entry is not None else next(resolved)
+            for image in images:
+                yield image
+        keys = [song.url for song in songs] + [image.url for image in images]
 
         if makeDirs and not os.path.isdir(path):
             os.makedirs(os.path.abspath(os.path.realpath(path)))
 
-        success = True
-        for fileNumber, file in enumerate(files, 1):
-            if not friendlyDownloadFile(file, path, fileNumber, totalFiles, verbose):
-                success = False
+        if archive is not None:
+            try:
+                with openArchive(archive, archiveFormat) as writer:
+                    return downloadToArchive(files(), writer, False, jobs, jobsPerHost,
+                                             executor, limiter, events, adaptive, bandwidth,
+                                             total=len(keys))
+            finally:
+                resolved.close()
+        try:
+            return downloadFiles(files(), path, False, jobs, jobsPerHost, manifest, keys,
+                                 executor, limiter, events, adaptive, bandwidth,
+                                 total=len(keys), segments=segments)
+        finally:
+            resolved.close()
+            manifest.save()
+
+    def iterFiles(self, formatOrder=None, resolveJobs=DEFAULT_RESOLVE_JOBS,
+                  guessUrls=False, executor=None, events=None, limiter=None,
+                  songs=None):
+        """Yield the File to download for each of the soundtrack's songs, in
+        order, as soon as its song page has been looked up - None for songs
+        that don't exist. Songs are looked up `resolveJobs` at a time, ahead
+        of the one that was last yielded, so the files that come first can
+        be downloaded while the rest are still being found.
+
+        `formatOrder` and `guessUrls` work as for download, and `executor`,
+        `events` and `limiter` as for resolveSongs. Pass a list of `songs`
+        to only look those up instead of all of them.
+        """
+        if formatOrder:
+            formatOrder = [extension.lower() for extension in formatOrder]
+        songs = self.songs if songs is None else list(songs)
+        limiter = HostLimiter(resolveJobs) if limiter is None else limiter
+        jobs = maxJobs(resolveJobs, limiter.adaptive)
+
+        if not guessUrls or len(songs) <= GUESS_SAMPLES:
+            for file in iterResolvedSongs(songs, formatOrder, jobs, None,
+                                          executor, events, limiter):
+                yield file
+            return
         
-        return success
+        samples = songs[:GUESS_SAMPLES]
+        sampleFiles = resolveSongs(samples, formatOrder, jobs, None, executor, events, limiter)
+        for file in sampleFiles:
+            yield file
+        templates = FileUrlTemplates(
+            [song for song, file in zip(samples, sampleFiles) if file is not None],
+            self.availableFormats
+        )
+        for file in iterResolvedSongs(songs[GUESS_SAMPLES:], formatOrder, jobs,
+                                      templates, executor, events, limiter):
+            yield file
+
+
+class SoundtrackPlan(object):
+    """What downloading a soundtrack would get, going by its album page (see
+    Soundtrack.plan). Sizes are only as exact as the album page has them.
+
+    Properties:
+    * soundtrack:  The Soundtrack.
+    * formatOrder: The formats that would be preferred, or None.
+    * tracks:      How many songs there are.
+    * formats:     A list of the format each song would be downloaded in (or
+                   None if the album page doesn't say what formats it's in).
+    * bytesPerFormat: An OrderedDict of each of the soundtrack's formats and
+                   the total size of the songs in it.
+    * totalBytes:  The total size of the songs that would be downloaded (not
+                   including the images). Songs with no size listed count
+                   as 0 - see `unknownSizes`.
+    * unknownSizes: How many songs there's no size listed for.
+    * duration:    The total length of the songs in seconds.
+    """
+
+    def __init__(self, soundtrack, formatOrder=None):
+        self.soundtrack = soundtrack
+        self.formatOrder = [extension.lower() for extension in formatOrder] if formatOrder else None
+        songs = soundtrack.songs
+        self.tracks = len(songs)
+        self.bytesPerFormat = OrderedDict(
+            (format, sum(song.sizes.get(format, 0) for song in songs))
+            for format in soundtrack.availableFormats)
+        self.duration = sum(song.duration or 0 for song in songs)
+
+        self.formats = []
+        self.totalBytes = 0
+        self.unknownSizes = 0
+        for song in songs:
+            # The same choice getAppropriateFile makes, going by the listed
+            # sizes instead of the song's files.
+            available = [format for format in soundtrack.availableFormats
+                         if format in song.sizes]
+            format = next((format for format in self.formatOrder or () if format in available),
+                          available[0] if available else None)
+            self.formats.append(format)
+            if format is None:
+                self.unknownSizes += 1
+            else:
+                self.totalBytes += song.sizes[format]
+    
+    def __repr__(self):
+        return "<{}: {}, {} tracks, {} bytes>".format(
+            self.__class__.__name__, self.soundtrack.id, self.tracks, self.totalBytes)
+
+
+def printPlans(plans, file=sys.stdout):
+    """Print a summary of a list of SoundtrackPlans, and their total if
+    there's more than one.
+    """
+    s = ""
+    for plan in plans:
+        s += "{}: {} track{}, {}\n".format(plan.soundtrack.id, plan.tracks,
+                                          "" if plan.tracks == 1 else "s",
+                                          formatDuration(plan.duration))
+        for format, size in plan.bytesPerFormat.items():
+            s += "  {:<6} {:>10}\n".format(format.upper() + ":", formatSize(size))
+        s += "  Would download {}{}.\n".format(
+            formatSize(plan.totalBytes),
+            " (and {} songs of unknown size)".format(plan.unknownSizes) if plan.unknownSizes else "")
+    if len(plans) > 1:
+        s += "\nIn total: {} tracks, {} to download.\n".format(
+            sum(plan.tracks for plan in plans), formatSize(sum(plan.totalBytes for plan in plans)))
+    unicodePrint(s, end="", file=file)
 
 
 class Song(object):
@@ -382,31 +2453,48 @@ class Song(object):
     * name:  The name of the song.
     * files: A list of the song's files - there may be several if the song
              is available in more than one format.
+    * duration: The length of the song in seconds, if it's known from its
+             album page (None if not).
+    * sizes: A dictionary of the song's formats and the sizes of its files in
+             them, as far as they're known from its album page.
+    * session: The requests.Session used for the song's requests.
     """
     
-    def __init__(self, url):
+    # Only what's been read from the song's page is kept (see Soundtrack).
+    # The page is fetched again (usually from the page cache) if something
+    # else is needed from it later.
+    __slots__ = ('url', '_session', 'duration', 'sizes', '_elapsed',
+                 '_lazy_name', '_lazy_files')
+
+    session = sessionProperty()
+
+    def __init__(self, url, session=None):
         self.url = url
+        self._session = session
+        self.duration = None
+        self.sizes = {}
+        # How long the song's page took to fetch, if it wasn't cached.
+        self._elapsed = None
     
     def __repr__(self):
         return "<{}: {}>".format(self.__class__.__name__, self.url)
     
-    @lazyProperty
-    def _soup(self):
-        r = requests.get(self.url, timeout=10)
+    def _page(self):
+        r = getPage(self.url, self._session, timeout=10)
         if r.url.rsplit('/', 1)[-1] == '404':
             raise NonexistentSongError("Nonexistent song page (404).")
-        return getSoup(self.url)
+        if not isinstance(r, CachedPage):
+            self._elapsed = r.elapsed.total_seconds()
+        return r
 
     @lazyProperty
     def name(self):
-        return self._soup('p')[2]('b')[1].get_text()
+        return parsePage(songName, self._page().content)
 
     @lazyProperty
     def files(self):
-        # The path used to be /ost/..., and was changed to
-        # /soundtracks/... - but who knows? It might change back!
-        anchors = self._soup('a', href=re.compile(r'^https?://[^/]+/(?:soundtracks|ost)/.+$'))
-        return [File(urljoin(self.url, a['href'])) for a in anchors]
+        urls = parsePage(songFileUrls, self._page().content)
+        return [File(urljoin(self.url, url), self._session) for url in urls]
 
 
 class File(object):
@@ -415,91 +2503,1196 @@ class File(object):
     Properties:
     * url:      The full URL of the file.
     * filename: The file's... filename. You got it.
+    * session:  The requests.Session used to download the file.
     """
 
-    def __init__(self, url):
+    __slots__ = ('url', '_session', 'filename')
+
+    session = sessionProperty()
+
+    def __init__(self, url, session=None):
         self.url = url
+        self._session = session
+        self.filename = urlFilename(url)
 
+    def __repr__(self):
+        return "<{}: {}>".format(self.__class__.__name__, self.url)
+    
+    def isAvailable(self, limiter=None):
+        """Check whether the file exists with a HEAD request, holding a slot
+        of the HostLimiter `limiter` (if given) while it's made.
+
+        The request is tried again as getRetryPolicy() says if it fails.
+        Raise ServerBusyError if the server still says it's too busy after
+        that, and a requests.RequestException if it still can't be reached -
+        neither says anything about whether the file's there.
+        """
+        if limiter is not None:
+            limiter.acquire(self.url)
         try:
-            url = str(url)
-        except UnicodeError:
-            # Python 2's quote and unquote work with bytestrings.
-            url = url.encode('utf-8')
-        # str('/') makes sure the string doesn't get
-        # converted to a Unicode string on Python 2.
-        self.filename = unquote(url.rsplit(str('/'), 1)[-1])
+            r = requestWithRetries(self.session, 'HEAD', self.url, allow_redirects=True)
+            r.close()
+        finally:
+            if limiter is not None:
+                limiter.release(self.url)
+        return r.status_code == 200
+
+    def download(self, path, chunkSize=CHUNK_SIZE, progress=None, segments=1, limiter=None):
+        """Download the file to `path`.
+        
+        The file is streamed to `path` + PART_SUFFIX `chunkSize` bytes at a
+        time, and only moved to `path` once it's complete. If a partial file
+        is already there, the download continues where it left off.
+
+        If `segments` is more than 1 and the file is at least
+        SEGMENT_THRESHOLD bytes, it's downloaded in that many parts at once
+        instead, over as many connections, if the server allows it (see
+        downloadSegmented). Otherwise, it's downloaded in one stream. If the
+        download holds a slot of the HostLimiter `limiter`, pass it along so
+        that the other connections get slots too.
+
+        If given, `progress` is called as soon as the server responds and
+        then after each chunk, with how many bytes of the file are there so
+        far and its total size (or None if unknown).
+
+        Raise ServerBusyError if the server says it's too busy, and
+        requests.HTTPError if it responds with any other error. The file
+        isn't tried again here - friendlyDownloadFile does that.
+
+        Return a tuple of the file's size and the hex digest of its SHA-1.
+        """
+        partPath = path + PART_SUFFIX
+        if segments > 1 and not os.path.exists(partPath):
+            result = self.downloadSegmented(path, segments, chunkSize, progress, limiter)
+            if result is not None:
+                return result
+
+        offset = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        hasher = hashlib.sha1()
+        # One buffer for the whole file, so memory use doesn't grow with it.
+        buffer = bytearray(chunkSize)
+        view = memoryview(buffer)
+
+        response = self.session.get(self.url, headers=headers, stream=True, timeout=10)
         try:
-            # In Python 2, unquote doesn't handle escaped UTF-8 characters
-            # automatically, so we gotta decode them manually from bytes.
-            self.filename = self.filename.decode('utf-8')
-        except AttributeError:
+            if offset and response.status_code == 416:
+                # Either the partial file is actually complete...
+                m = re.match(r'^bytes \*/([0-9]+)$', response.headers.get('Content-Range', ''))
+                if m is not None and int(m.group(1)) == offset:
+                    hashFile(partPath, hasher, buffer)
+                    replaceFile(partPath, path)
+                    return offset, hasher.hexdigest()
+                # ...or it's not a part of this file at all.
+                response.close()
+                os.remove(partPath)
+                offset = 0
+                response = self.session.get(self.url, stream=True, timeout=10)
+            raiseIfBusy(response)
+            response.raise_for_status()
+            if response.status_code != 206:
+                # The server ignored the Range header and is sending it all.
+                offset = 0
+            elif offset:
+                hashFile(partPath, hasher, buffer)
+            
+            expectedSize = response.headers.get('Content-Length')
+            expectedSize = int(expectedSize) if expectedSize is not None else None
+            totalSize = offset + expectedSize if expectedSize is not None else None
+            written = 0
+            if progress is not None:
+                progress(offset, totalSize)
+
+            response.raw.decode_content = True
+            with open(partPath, 'ab' if offset else 'wb') as outFile:
+                while True:
+                    bytesRead = readInto(response, buffer)
+                    if not bytesRead:
+                        break
+                    outFile.write(view[:bytesRead])
+                    hasher.update(view[:bytesRead])
+                    written += bytesRead
+                    if progress is not None:
+                        progress(offset + written, totalSize)
+        finally:
+            response.close()
+        
+        if expectedSize is not None and written < expectedSize:
+            # The rest will be picked up by the next try.
+            raise requests.ConnectionError("Connection closed before the whole file was received.")
+        replaceFile(partPath, path)
+        return offset + written, hasher.hexdigest()
+
+    def downloadSegmented(self, path, segments, chunkSize=CHUNK_SIZE, progress=None,
+                          limiter=None):
+        """Download the file to `path` in `segments` byte ranges at once, each
+        over its own connection, written straight into place in a file of
+        the right size. Each segment is tried again on its own (as
+        getRetryPolicy() says) if its connection fails or the server's busy,
+        picking up where it left off - and once one has run out of tries,
+        the download isn't tried again as a whole (which would start every
+        segment over).
+
+        If `limiter` is given, the download is taken to hold one of its
+        slots for the file's host already, and each other segment needs one
+        too - there are only as many segments as there are free slots for.
+
+        Return None without downloading anything if the file is smaller than
+        SEGMENT_THRESHOLD, the server doesn't do byte ranges or there are no
+        free slots - the file should be downloaded in one stream instead.
+        Otherwise, return and raise the same as download.
+        """
+        r = requestWithRetries(self.session, 'HEAD', self.url, allow_redirects=True)
+        r.close()
+        size = r.headers.get('Content-Length')
+        if (not r.ok or r.headers.get('Accept-Ranges', '').lower() != 'bytes' or
+                r.headers.get('Content-Encoding', 'identity').lower() != 'identity' or
+                size is None or not size.isdigit() or int(size) < SEGMENT_THRESHOLD):
+            return None
+        size = int(size)
+        url = r.url # No need to go through the redirects for every segment.
+
+        slots = 0
+        if limiter is not None:
+            while slots < segments - 1 and limiter.tryAcquire(self.url):
+                slots += 1
+            if not slots:
+                return None
+            segments = slots + 1
+        try:
+            return self._downloadSegments(path, url, size, segments, chunkSize, progress)
+        finally:
+            for _ in range(slots):
+                limiter.release(self.url)
+
+    def _downloadSegments(self, path, url, size, segments, chunkSize, progress):
+        partPath = path + SEGMENTED_PART_SUFFIX
+        fd = os.open(partPath, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+        try:
+            preallocate(fd, size)
+            lock = threading.Lock()
+            # Once one segment has failed, the rest stop too.
+            state = {'bytes': 0, 'stop': False}
+            if progress is not None:
+                progress(0, size)
+            
+            def downloadSegment(bounds):
+                start, end = bounds
+                # Where the next try picks up from.
+                segment = {'position': start}
+                buffer = bytearray(chunkSize)
+                view = memoryview(buffer)
+                def attempt():
+                    if state['stop']:
+                        return None
+                    headers = {'Range': 'bytes={}-{}'.format(segment['position'], end - 1)}
+                    response = self.session.get(url, headers=headers, stream=True, timeout=10)
+                    try:
+                        raiseIfBusy(response)
+                        response.raise_for_status()
+                        m = re.match(r'^bytes ([0-9]+)-[0-9]+/([0-9]+)$',
+                                     response.headers.get('Content-Range', ''))
+                        if (response.status_code != 206 or m is None or
+                                int(m.group(1)) != segment['position'] or int(m.group(2)) != size):
+                            return False
+                        while segment['position'] < end:
+                            if state['stop']:
+                                return None
+                            bytesRead = readInto(response, buffer)
+                            if not bytesRead:
+                                raise requests.ConnectionError(
+                                    "Connection closed before the whole segment was received.")
+                            bytesRead = min(bytesRead, end - segment['position'])
+                            writeAt(fd, view[:bytesRead], segment['position'], lock)
+                            segment['position'] += bytesRead
+                            with lock:
+                                state['bytes'] += bytesRead
+                                if progress is not None:
+                                    progress(state['bytes'], size)
+                        return True
+                    finally:
+                        response.close()
+                # Segments are on threads of their own, so each is tried again
+                # on its own.
+                return getRetryPolicy().call(url, attempt)
+            
+            segmentSize = -(-size // segments)
+            bounds = [(start, min(start + segmentSize, size))
+                      for start in range(0, size, segmentSize)]
+            # Every segment has to be done with the file before it's closed,
+            # so this can't just be a boundedMap.
+            executor = concurrentFutures.ThreadPoolExecutor(max_workers=len(bounds))
+            try:
+                futures = [executor.submit(downloadSegment, b) for b in bounds]
+                results = []
+                error = None
+                for future in futures:
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        state['stop'] = True
+                        error = error or e
+                        results.append(None)
+            finally:
+                executor.shutdown(wait=True)
+        finally:
+            os.close(fd)
+        
+        if error is not None:
+            os.remove(partPath)
+            raise error
+        rangesWork = all(results)
+        
+        if not rangesWork:
+            # The server said it does ranges, but it doesn't after all.
+            os.remove(partPath)
+            return None
+        sha1 = hashFile(partPath).hexdigest()
+        replaceFile(partPath, path)
+        return size, sha1
+
+
+def preallocate(fd, size):
+    """Make the file `fd` `size` bytes big, reserving the space for it on
+    disk if the system can.
+    """
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError: # Not every filesystem can.
             pass
+    os.ftruncate(fd, size)
 
-    def __repr__(self):
-        return "<{}: {}>".format(self.__class__.__name__, self.url)
-    
-    def download(self, path):
-        """Download the file to `path`."""
-        response = requests.get(self.url, timeout=10)
-        with open(path, 'wb') as outFile:
-            outFile.write(response.content)
+
+def writeAt(fd, data, offset, lock):
+    """Write `data` to the file `fd` at `offset`, without disturbing writes
+    elsewhere in it from other threads (which have to use the same `lock`
+    on systems without os.pwrite).
+    """
+    if hasattr(os, 'pwrite'):
+        data = memoryview(data)
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data, offset = data[written:], offset + written
+    else:
+        data = memoryview(data).tobytes()
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+
+
+def readInto(response, buffer):
+    """Read the next bytes of the streamed `response` into `buffer`, and
+    return how many there were (0 once it's over). Connection problems are
+    raised as requests' own errors, so they're tried again like any other.
+    """
+    try:
+        return response.raw.readinto(buffer)
+    except urllib3.exceptions.ReadTimeoutError as e:
+        raise requests.Timeout(e)
+    except (urllib3.exceptions.ProtocolError, socket.error) as e:
+        raise requests.ConnectionError(e)
+
+
+# --- Archives ---
+
+class ArchiveWriter(object):
+    """Writes an archive to the binary file object `fileobj`, one file at a
+    time, as its data comes in - nothing goes through the disk on the way.
+    Use begin(name, size) to start a file, write(data) for its contents,
+    and end() when it's complete, and close() once all files are in.
+
+    If a file can't be completed, call abort() instead of end(). If
+    `fileobj` is seekable, the file is taken back out of the archive.
+    If not, there's no taking it back - it stays in the archive, incomplete.
+
+    See ZipWriter and TarWriter.
+    """
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self._offset = 0
+        try:
+            self._start = fileobj.tell() if fileobj.seekable() else None
+        except (AttributeError, IOError, OSError):
+            self._start = None
+        # The name and where the current file starts in the archive.
+        self._name = None
+        self._memberOffset = None
+        self.names = set()
+
+    def _write(self, data):
+        self._file.write(data)
+        self._offset += len(data)
+
+    def begin(self, name, size=None):
+        """Start the file `name` in the archive. `size` is how big it's going
+        to be, or None if it's not known.
+        """
+        if self._name is not None:
+            raise ValueError("{} isn't finished yet.".format(self._name))
+        self._name = name
+        self._memberOffset = self._offset
+        self._begin(name, size)
+
+    def write(self, data):
+        self._write(data)
+
+    def end(self):
+        self._end()
+        self.names.add(self._name)
+        self._name = None
+
+    def abort(self):
+        if self._start is None:
+            self.end()
+            return
+        self._file.seek(self._start + self._memberOffset)
+        self._file.truncate()
+        self._offset = self._memberOffset
+        self._name = None
+
+    def close(self):
+        if self._name is not None:
+            self.abort()
+        self._close()
+        self._file.flush()
+
+    # What a format writes around each file, and at the very end, goes in
+    # these - written with _write, so the offsets add up. There's nothing
+    # to write by default.
+
+    def _begin(self, name, size):
+        """Write what goes before the data of the file `name` (of `size`
+        bytes, or None if not known).
+        """
+        pass
+
+    def _end(self):
+        """Write what goes after the data of the current file."""
+        pass
+
+    def _close(self):
+        """Write what goes after all of the files."""
+        pass
+
+
+ZIP64_LIMIT = 0xFFFFFFFF
+
+class ZipWriter(ArchiveWriter):
+    """Writes a zip file (see ArchiveWriter). Files are stored as they are -
+    music and images don't get any smaller by being compressed again - and
+    their sizes and CRCs go after their data, so `fileobj` can be anything
+    that can be written to. Files and archives over 4 GB are fine.
+    """
+
+    def __init__(self, fileobj):
+        super(ZipWriter, self).__init__(fileobj)
+        self._entries = []
+        self._current = None
+
+    def _begin(self, name, size):
+        encodedName = name.encode('utf-8')
+        # Bit 3: sizes and CRC after the data. Bit 11: the name is UTF-8.
+        flags = 0x08 | (0x800 if encodedName != name.encode('ascii', 'replace') else 0)
+        t = time.localtime()
+        dosTime = t[3] << 11 | t[4] << 5 | t[5] // 2
+        dosDate = max(t[0] - 1980, 0) << 9 | t[1] << 5 | t[2]
+        zip64 = size is None or size >= ZIP64_LIMIT
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        self._current = {'name': encodedName, 'flags': flags, 'time': dosTime, 'date': dosDate,
+                         'zip64': zip64, 'offset': self._offset, 'crc': 0, 'size': 0}
+        self._write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, flags, 0,
+                                dosTime, dosDate, 0, ZIP64_LIMIT if zip64 else 0,
+                                ZIP64_LIMIT if zip64 else 0, len(encodedName), len(extra)))
+        self._write(encodedName)
+        self._write(extra)
+
+    def write(self, data):
+        self._current['crc'] = zlib.crc32(data, self._current['crc']) & 0xFFFFFFFF
+        self._current['size'] += len(data)
+        self._write(data)
+
+    def _end(self):
+        entry = self._current
+        fmt = '<IIQQ' if entry['zip64'] else '<IIII'
+        self._write(struct.pack(fmt, 0x08074b50, entry['crc'], entry['size'], entry['size']))
+        self._entries.append(entry)
+        self._current = None
+
+    def abort(self):
+        super(ZipWriter, self).abort()
+        self._current = None
+
+    def _close(self):
+        directoryOffset = self._offset
+        for entry in self._entries:
+            # Only the values that don't fit go in the Zip64 extra field.
+            big = [value for value in (entry['size'], entry['size'], entry['offset'])
+                   if value >= ZIP64_LIMIT]
+            extra = struct.pack('<HH' + 'Q' * len(big), 1, 8 * len(big), *big) if big else b''
+            version = 45 if big or entry['zip64'] else 20
+            self._write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | version, version,
+                                    entry['flags'], 0, entry['time'], entry['date'], entry['crc'],
+                                    min(entry['size'], ZIP64_LIMIT), min(entry['size'], ZIP64_LIMIT),
+                                    len(entry['name']), len(extra), 0, 0, 0, 0o100644 << 16,
+                                    min(entry['offset'], ZIP64_LIMIT)))
+            self._write(entry['name'])
+            self._write(extra)
+        directorySize = self._offset - directoryOffset
+
+        count = len(self._entries)
+        if count >= 0xFFFF or directoryOffset >= ZIP64_LIMIT or directorySize >= ZIP64_LIMIT:
+            endOffset = self._offset
+            self._write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                                    count, count, directorySize, directoryOffset))
+            self._write(struct.pack('<IIQI', 0x07064b50, 0, endOffset, 1))
+        self._write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF),
+                                min(count, 0xFFFF), min(directorySize, ZIP64_LIMIT),
+                                min(directoryOffset, ZIP64_LIMIT), 0))
+
+
+TAR_BLOCK_SIZE = 512
+TAR_RECORD_SIZE = 20 * TAR_BLOCK_SIZE
+
+class TarWriter(ArchiveWriter):
+    """Writes an uncompressed tar file (see ArchiveWriter). Tar needs each
+    file's size before its data, so files whose size isn't known are kept
+    in memory (or a temporary file, past ARCHIVE_READ_AHEAD bytes) until
+    they're complete. Files of known size go straight in.
+    """
+
+    def __init__(self, fileobj):
+        super(TarWriter, self).__init__(fileobj)
+        self._remaining = None
+        self._spool = None
+
+    def _header(self, name, size):
+        import tarfile # Only needed for this, and not that quick to import.
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        return info.tobuf(tarfile.PAX_FORMAT, 'utf-8')
+
+    def _begin(self, name, size):
+        if size is None:
+            self._spool = tempfile.SpooledTemporaryFile(ARCHIVE_READ_AHEAD)
+        else:
+            self._write(self._header(name, size))
+            self._remaining = size
+
+    def write(self, data):
+        if self._spool is not None:
+            self._spool.write(data)
+            return
+        if len(data) > self._remaining:
+            raise ValueError("{} is bigger than it was said to be.".format(self._name))
+        self._remaining -= len(data)
+        self._write(data)
+
+    def _end(self):
+        if self._spool is not None:
+            spool, self._spool = self._spool, None
+            size = spool.tell()
+            spool.seek(0)
+            self._write(self._header(self._name, size))
+            buffer = bytearray(CHUNK_SIZE)
+            while True:
+                bytesRead = spool.readinto(buffer)
+                if not bytesRead:
+                    break
+                self._write(memoryview(buffer)[:bytesRead])
+            spool.close()
+        elif self._remaining:
+            # An incomplete file that couldn't be taken back still has to
+            # take up the space it said it would.
+            self._write(b'\0' * self._remaining)
+        self._remaining = None
+        self._write(b'\0' * (-self._offset % TAR_BLOCK_SIZE))
+
+    def abort(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+            self._name = None
+            return
+        super(TarWriter, self).abort()
+        self._remaining = None
+
+    def _close(self):
+        self._write(b'\0' * (2 * TAR_BLOCK_SIZE))
+        self._write(b'\0' * (-self._offset % TAR_RECORD_SIZE))
+
+
+ARCHIVE_FORMATS = OrderedDict([('zip', ZipWriter), ('tar', TarWriter)])
+
+def archiveFormatOf(path):
+    """Return the format (a key of ARCHIVE_FORMATS) of an archive named
+    `path`, or None if its extension isn't one of them.
+    """
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    return extension if extension in ARCHIVE_FORMATS else None
+
+
+class openArchive(object):
+    """Open an ArchiveWriter for `archive` - either a path or a binary file
+    object - in `format` (a key of ARCHIVE_FORMATS; by default, whichever
+    the path's extension says, or zip). Use it in a with statement.
+
+    Archives at paths are written to a file with PART_SUFFIX added, and only
+    take its place once they've been closed without an exception.
+    """
+
+    def __init__(self, archive, format=None):
+        self.archive = archive
+        self.isPath = not hasattr(archive, 'write')
+        if format is None:
+            format = (archiveFormatOf(archive) if self.isPath else None) or 'zip'
+        if format not in ARCHIVE_FORMATS:
+            raise ValueError("\"{}\" isn't an archive format (use {}).".format(
+                format, " or ".join(ARCHIVE_FORMATS)))
+        self.format = format
+        self._file = None
+        self.writer = None
+
+    def __enter__(self):
+        self._file = open(self.archive + PART_SUFFIX, 'wb') if self.isPath else self.archive
+        self.writer = ARCHIVE_FORMATS[self.format](self._file)
+        return self.writer
+
+    def __exit__(self, excType, *_):
+        if not self.isPath:
+            if excType is None:
+                self.writer.close()
+            return
+        try:
+            if excType is None:
+                self.writer.close()
+        finally:
+            self._file.close()
+            if excType is None:
+                replaceFile(self.archive + PART_SUFFIX, self.archive)
+            else:
+                try:
+                    os.remove(self.archive + PART_SUFFIX)
+                except OSError:
+                    pass
+
+
+class ArchiveMember(object):
+    """A File on its way into an archive (see downloadToArchive). Its
+    connection is only kept open while it has a slot from the limiter, so a
+    file that isn't complete after readAhead picks up where it left off in
+    writeTo with a Range request - as it does when a connection drops.
+    """
+
+    def __init__(self, file, index, total, limiter, events=None, bandwidth=None):
+        self.file = file
+        self.index = index
+        self.total = total
+        self.filename, self.note = localFilename(file)
+        self.size = None
+        self.received = 0
+        self.done = False
+        self.error = None
+        self.start = time.time()
+        self._limiter = limiter
+        self._events = events
+        self._bandwidth = bandwidth
+        self._buffered = []
+        self._lastEvent = self.start
+
+    def _open(self):
+        """Return a response for the rest of the file, or None if there's
+        none left.
+        """
+        headers = {'Range': 'bytes={}-'.format(self.received)} if self.received else {}
+        requested = time.time()
+        response = self.file.session.get(self.file.url, headers=headers, stream=True, timeout=10)
+        try:
+            if self.received and response.status_code == 416:
+                m = re.match(r'^bytes \*/([0-9]+)$', response.headers.get('Content-Range', ''))
+                if m is not None and int(m.group(1)) == self.received:
+                    response.close()
+                    self.size = self.received
+                    return None
+            raiseIfBusy(response)
+            response.raise_for_status()
+            self._limiter.record(self.file.url, time.time() - requested)
+            length = response.headers.get('Content-Length')
+            length = int(length) if length is not None else None
+            skip = 0
+            if response.status_code != 206:
+                # The server ignored the Range header, so what's already been
+                # received is sent again, and skipped over.
+                skip = self.received
+                self.received = 0
+            size = self.received + length if length is not None else None
+            if self.size is not None and size is not None and size != self.size:
+                raise requests.ConnectionError("{} changed size while it was being downloaded.".format(
+                    self.file.url))
+            self.size = size
+            response.raw.decode_content = True
+            buffer = bytearray(min(skip, CHUNK_SIZE))
+            while skip:
+                bytesRead = readInto(response, memoryview(buffer)[:skip])
+                if not bytesRead:
+                    raise requests.ConnectionError("Connection closed before the whole file was received.")
+                skip -= bytesRead
+                self.received += bytesRead
+        except BaseException:
+            response.close()
+            raise
+        return response
+
+    def _receive(self, sink, limit=None):
+        """Pass what's received to `sink` until the file is complete or (if
+        given) `limit` bytes have been received. Meant to be retried.
+        """
+        self._limiter.acquire(self.file.url)
+        response = None
+        try:
+            response = self._open()
+            buffer = bytearray(CHUNK_SIZE)
+            view = memoryview(buffer)
+            while True:
+                if response is None or self.received == self.size:
+                    self.done = True
+                    break
+                if limit is not None and self.received >= limit:
+                    break
+                bytesRead = readInto(response, buffer)
+                if not bytesRead:
+                    if self.size is not None and self.received < self.size:
+                        raise requests.ConnectionError("Connection closed before the whole file was received.")
+                    self.done = True
+                    break
+                sink(view[:bytesRead].tobytes())
+                self.received += bytesRead
+                if self._bandwidth is not None:
+                    self._bandwidth.consume(bytesRead)
+                now = time.time()
+                if now - self._lastEvent >= PROGRESS_INTERVAL:
+                    self._lastEvent = now
+                    sendEvent(self._events, PROGRESS, index=self.index, url=self.file.url,
+                              bytes=self.received, totalBytes=self.size)
+        finally:
+            # Other files may get the slot now, so the connection goes too.
+            if response is not None:
+                response.close()
+            self._limiter.release(self.file.url)
+
+    def _transfer(self, sink, limit=None):
+        def onRetry(error, triesElapsed, delay):
+            if isinstance(error, ServerBusyError):
+                self._limiter.backOff(self.file.url, error.retryAfter)
+            sendEvent(self._events, RETRY, index=self.index, url=self.file.url,
+                      filename=self.filename, attempt=triesElapsed + 1, error=str(error),
+                      delay=delay)
+        try:
+            getRetryPolicy().call(self.file.url, lambda: self._receive(sink, limit), onRetry)
+        except (ServerBusyError, HostUnavailableError, requests.RequestException) as e:
+            self.error = e
+        return self.error is None
+
+    def readAhead(self, limit=ARCHIVE_READ_AHEAD):
+        """Start downloading the file, keeping up to `limit` bytes of it in
+        memory until it's its turn to be written.
+        """
+        sendEvent(self._events, FILE_STARTED, index=self.index, total=self.total,
+                  url=self.file.url, filename=self.filename, note=self.note, redownload=False)
+        self._transfer(self._buffered.append, limit)
+        return self
+
+    def writeTo(self, writer):
+        """Write the file into the ArchiveWriter `writer`, downloading the
+        rest of it on the way. Return whether it could be completed.
+        """
+        if self.error is None:
+            writer.begin(self.filename, self.size)
+            for data in self._buffered:
+                writer.write(data)
+            del self._buffered[:]
+            if self.done or self._transfer(writer.write):
+                writer.end()
+            else:
+                writer.abort()
+        success = self.error is None
+        sendEvent(self._events, DONE, index=self.index, total=self.total, url=self.file.url,
+                  filename=self.filename, success=success,
+                  bytes=self.received if success else None, seconds=time.time() - self.start,
+                  error=str(self.error) if self.error is not None else None)
+        return success
+
+
+def downloadToArchive(files, writer, verbose=False,
+                      jobs=DEFAULT_JOBS, jobsPerHost=DEFAULT_JOBS_PER_HOST,
+                      executor=None, limiter=None, events=None, adaptive=False,
+                      bandwidth=None, total=None, readAhead=ARCHIVE_READ_AHEAD):
+    """Download every File in `files` into the ArchiveWriter `writer`, in
+    order, without writing them anywhere else. Entries that are None
+    (nonexistent songs) count as failures, and files with the same name as
+    one that's already in the archive are skipped.
+
+    The files go into the archive one at a time, but up to `jobs` of the
+    ones after the one being written are downloaded at the same time, each
+    keeping up to `readAhead` bytes in memory until its turn comes. The rest
+    of each file is streamed straight into the archive - so memory use
+    stays at no more than about `jobs` times `readAhead`, no matter how
+    big the files are. Most songs fit in `readAhead` entirely, and are
+    downloaded `jobs` at once just as they would be by downloadFiles.
+
+    Failed downloads are tried again as getRetryPolicy() says, picking up
+    where they left off. A file that can't be completed is taken back out
+    of the archive if its file object is seekable (see ArchiveWriter).
+
+    The rest of the arguments are as for downloadFiles.
+
+    Return True if all files made it into the archive, False if not.
+    """
+    if total is None:
+        files = list(files)
+        total = len(files)
+
+    if verbose:
+        events = combineEvents(events, ProgressPrinter())
+    limiter = HostLimiter(jobsPerHost, adaptive) if limiter is None else limiter
+    bandwidth = bandwidthLimiter(bandwidth)
+    def start(item):
+        fileNumber, file = item
+        if file is None:
+            return fileNumber, None
+        member = ArchiveMember(file, fileNumber, total, limiter, events, bandwidth)
+        return fileNumber, member.readAhead(readAhead)
+
+    success = True
+    members = boundedIter(start, enumerate(files, 1), maxJobs(jobs, limiter.adaptive), executor)
+    try:
+        for fileNumber, member in members:
+            if member is None:
+                sendEvent(events, SKIPPED, index=fileNumber, total=total, url=None,
+                          filename=None, reason='nonexistent')
+                success = False
+            elif member.filename in writer.names:
+                sendEvent(events, SKIPPED, index=fileNumber, total=total, url=member.file.url,
+                          filename=member.filename, note=member.note, reason='exists',
+                          bytes=member.received)
+            else:
+                success = member.writeTo(writer) and success
+    finally:
+        members.close()
+    return success
 
 
-def download(soundtrackId, path='', makeDirs=True, formatOrder=None, verbose=False):
+def download(soundtrackId, path='', makeDirs=True, formatOrder=None, verbose=False,
+             resolveJobs=DEFAULT_RESOLVE_JOBS, jobs=DEFAULT_JOBS,
+             jobsPerHost=DEFAULT_JOBS_PER_HOST, session=None, guessUrls=False,
+             events=None, adaptive=False, bandwidth=None, segments=1, archiveFormat=None):
     """Download the soundtrack with the ID `soundtrackId`.
+    If `archiveFormat` is given ("zip" or "tar"), download it into an
+    archive of that format at `path` (with the format's extension added if
+    it doesn't have it) instead of into a directory.
     See Soundtrack.download for more information.
     """
-    soundtrack = Soundtrack(soundtrackId)
+    soundtrack = Soundtrack(soundtrackId, session)
     soundtrack.name # To conistently always load the content in advance.
     path = to_valid_filename(soundtrack.name) if path is None else path
+    archive = None
+    if archiveFormat is not None:
+        archive = path if archiveFormatOf(path) == archiveFormat else path + '.' + archiveFormat
     if verbose:
-        unicodePrint("Downloading to \"{}\".".format(path))
-    return soundtrack.download(path, makeDirs, formatOrder, verbose)
+        unicodePrint("Downloading to \"{}\".".format(archive or path))
+    return soundtrack.download(path, makeDirs, formatOrder, verbose,
+                               resolveJobs, jobs, jobsPerHost, guessUrls,
+                               events=events, adaptive=adaptive, bandwidth=bandwidth,
+                               segments=segments, archive=archive, archiveFormat=archiveFormat)
+
+
+def downloadMany(soundtrackIds, path='', makeDirs=True, formatOrder=None, verbose=False,
+                 resolveJobs=DEFAULT_RESOLVE_JOBS, jobs=DEFAULT_JOBS,
+                 jobsPerHost=DEFAULT_JOBS_PER_HOST, session=None, guessUrls=False,
+                 albumJobs=DEFAULT_ALBUM_JOBS, events=None, adaptive=False,
+                 bandwidth=None, segments=1, archiveFormat=None):
+    """Download all the soundtracks with the IDs in `soundtrackIds`, each
+    to a directory named after it in `path` - or, if `archiveFormat` is
+    given ("zip" or "tar"), to an archive of that format named after it.
+
+    Up to `albumJobs` soundtracks are worked on at once. Their song lookups
+    and file downloads all share one pool of workers (as many as the larger
+    of `resolveJobs` and `jobs`) and one limit of `jobsPerHost` connections
+    per host, with each soundtrack only having up to `resolveJobs` lookups
+    and `jobs` downloads waiting at a time - so they all keep moving. With
+    `adaptive`, the limits adapt to all of them together, and `bandwidth`
+    is the limit for all of them together too.
+    See Soundtrack.download for the rest of the arguments.
+
+    Print which soundtracks are being downloaded if `verbose` is True.
+    Events for all of them are sent to `events`, each with the soundtrack's
+    ID as its `soundtrack` (see Event).
+
+    Return an OrderedDict of each soundtrack ID and its result: True if all
+    of its files were downloaded successfully, False if not, or the
+    exception that stopped it from being downloaded.
+    """
+    soundtrackIds = list(OrderedDict.fromkeys(soundtrackIds))
+    executor = concurrentFutures.ThreadPoolExecutor(
+        max_workers=maxJobs(max(resolveJobs, jobs, 1), adaptive))
+    limiter = HostLimiter(jobsPerHost, adaptive)
+    resolveLimiter = HostLimiter(resolveJobs, adaptive)
+    bandwidth = bandwidthLimiter(bandwidth)
+    printLock = threading.Lock()
+    
+    def downloadOne(soundtrackId):
+        soundtrack = Soundtrack(soundtrackId, session)
+        try:
+            albumPath = os.path.join(path, to_valid_filename(soundtrack.name))
+            archive = albumPath + '.' + archiveFormat if archiveFormat is not None else None
+            if verbose:
+                with printLock:
+                    unicodePrint("Downloading {} to \"{}\"...".format(soundtrackId, archive or albumPath))
+            result = soundtrack.download(albumPath, makeDirs, formatOrder, False,
+                                         resolveJobs, jobs, jobsPerHost, guessUrls,
+                                         executor, limiter, events, adaptive,
+                                         bandwidth, resolveLimiter, segments,
+                                         archive, archiveFormat)
+        except Exception as e:
+            # Even bugs only stop the soundtrack they happened with.
+            result = e
+        if verbose:
+            with printLock:
+                unicodePrint("Finished {}{}.".format(
+                    soundtrackId, "" if result is True else " (with errors)"))
+        return result
+
+    try:
+        # The soundtracks get their own threads, since they mostly just wait
+        # for what they've put in the shared pool.
+        results = boundedMap(downloadOne, soundtrackIds, albumJobs)
+    finally:
+        executor.shutdown(wait=False)
+    return OrderedDict(zip(soundtrackIds, results))
+
+
+def printDownloadSummary(results, file=sys.stdout):
+    """Print a summary of the results downloadMany returned."""
+    padLen = max(len(soundtrackId) for soundtrackId in results) if results else 0
+    s = ""
+    for soundtrackId, result in results.items():
+        if result is True:
+            status = "OK"
+        elif result is False:
+            status = "Not all files could be downloaded"
+        elif isinstance(result, (KhinsiderError, SoundtrackError, requests.RequestException,
+                                 EnvironmentError)):
+            status = "Failed: {}".format(result)
+        else:
+            status = "Failed with an unexpected error: {!r}".format(result)
+        s += "{} {}. {}\n".format(soundtrackId, '.' * (padLen - len(soundtrackId)), status)
+    unicodePrint(s, end="", file=file)
 
 
 class SearchError(KhinsiderError):
     pass
 
 
-def search(term):
+def search(term, session=None, catalog=None, hydrate=False, jobs=DEFAULT_RESOLVE_JOBS):
     """Return a tuple of two lists of Soundtrack objects for the search term
     `term`. The first tuple contains album name results, and the second song
     name results.
+
+    If `catalog` (which defaults to getCatalog() - pass False to not use one)
+    has been updated at least once, the search is done in it, without asking
+    KHInsider at all. There are no song name results in that case.
+
+    Only the soundtracks' IDs and names are known from the search itself.
+    If `hydrate` is set to True, their album pages are fetched too, `jobs`
+    at a time, so their formats, songs and sizes are there right away (see
+    loadSoundtracks) - instead of each being fetched on its own when it's
+    first needed.
+
+    Requests are made with `session`, which defaults to getSession().
+    """
+    catalog = getCatalog() if catalog is None else catalog
+    if catalog and catalog.updated is not None:
+        results = catalog.search(term, session)
+    else:
+        r = getPage(urljoin(BASE_URL, 'search'), session, False, params={'search': term})
+        results = searchResultsFromPage(r, session)
+    if hydrate:
+        loadSoundtracks(searchResultSoundtracks(results), jobs)
+    return results
+
+def searchResultSoundtracks(searchResults):
+    """Return a list of all the Soundtracks in what search returned - which
+    is just the one soundtrack when KHInsider goes straight to it.
+    """
+    if searchResults and isinstance(searchResults[0], Soundtrack):
+        return list(searchResults)
+    return list(chain(*searchResults))
+
+def loadSoundtracks(soundtracks, jobs=DEFAULT_RESOLVE_JOBS):
+    """Fetch the album pages of all the Soundtracks in `soundtracks` that
+    haven't been loaded yet, `jobs` at a time, and read everything there is
+    to know from them. Return a list of the soundtracks that couldn't be
+    loaded - they're left as they were, and raise the error when something
+    is needed from their pages.
     """
-    r = requests.get(urljoin(BASE_URL, 'search'), params={'search': term})
+    soundtracks = [soundtrack for soundtrack in OrderedDict.fromkeys(soundtracks)
+                   if not soundtrack._isLoaded('songs')]
+    def load(soundtrack):
+        try:
+            soundtrack._load()
+        except (KhinsiderError, SoundtrackError, requests.RequestException):
+            return False
+        return True
+    return [soundtrack for soundtrack, loaded in
+            zip(soundtracks, boundedMap(load, soundtracks, jobs)) if not loaded]
+
+def searchResultsFromPage(r, session=None):
+    """Return what search would for the search response (or CachedPage) `r`."""
     path = urlsplit(r.url).path
     if path.split('/', 2)[1] == 'game-soundtracks':
-        return [Soundtrack(path.rsplit('/', 1)[-1])]
+        return [Soundtrack(path.rsplit('/', 1)[-1], session)]
+    return [soundtracksFromRows(rows, session) for rows in parsePage(searchRows, r.content)]
 
-    soup = toSoup(r)
+def searchRows(content):
+    """Return the IDs and names of the soundtracks on the search results page
+    HTML `content`: a list of (id, name) tuples for the album name results,
+    and one for the song name results.
+    """
+    soup = toSoup(content)
 
     tables = soup('table', class_='albumList')
     if not tables:
         raise SearchError(soup.find('p').get_text(strip=True))
 
-    soundtracks = [soundtracksInSearchTable(table) for table in tables]
-    if len(soundtracks) == 1:
+    rows = [searchTableRows(table) for table in tables]
+    if len(rows) == 1:
         if "song" in soup.find(id='pageContent').find('p').get_text():
-            soundtracks.insert(0, [])
+            rows.insert(0, [])
         else:
-            soundtracks.append([])
+            rows.append([])
 
-    return soundtracks
+    return rows
 
-def soundtracksInSearchTable(table):
+def searchTableRows(table):
     anchors = (tr('td')[1].find('a') for tr in table('tr')[1:])
-    soundtrackParams = [(a['href'].split('/')[-1], a.get_text(strip=True)) for a in anchors]
+    return [(a['href'].split('/')[-1], a.get_text(strip=True)) for a in anchors]
 
+def soundtracksFromRows(rows, session=None):
     soundtracks = []
-    for id, name in soundtrackParams:
-        curSoundtrack = Soundtrack(id)
+    for id, name in rows:
+        curSoundtrack = Soundtrack(id, session)
         curSoundtrack._lazy_name = name
         soundtracks.append(curSoundtrack)
-
     return soundtracks
 
+def soundtracksInSearchTable(table, session=None):
+    return soundtracksFromRows(searchTableRows(table), session)
+
+# The album lists are linked from every page, one for each first letter.
+CATALOG_LINK_STRAINER = LazyStrainer('a', href=re.compile(r'/game-soundtracks/browse/[^/]+$'))
+CATALOG_TABLE_STRAINER = LazyStrainer('table', class_='albumList')
+
+def albumListRows(content):
+    """Return the IDs and names of the soundtracks on the album list page
+    HTML `content`, as (id, name) tuples.
+    """
+    tables = toSoup(content, CATALOG_TABLE_STRAINER)('table')
+    return [row for table in tables for row in searchTableRows(table)]
+
+try:
+    import sqlite3
+except ImportError: # Python can be built without it.
+    sqlite3 = None
+
+def defaultCatalogPath():
+    return os.path.join(defaultCacheDirectory(), 'catalog.sqlite3')
+
+
+class Catalog(object):
+    """A local index of every soundtrack on KHInsider, kept in an SQLite
+    database at `path`, for searching without asking KHInsider.
+
+    It's empty until update() has been called, which fetches all of
+    KHInsider's album lists. Later updates only read the lists that have
+    changed since the last one.
+
+    Names are indexed with SQLite's full-text search (FTS5) if it's there,
+    and searched through one by one if not.
+
+    Properties:
+    * path:    The path of the database.
+    * updated: When the catalog was last updated (as a time.time()), or None
+               if it never has been.
+    """
+
+    def __init__(self, path=None):
+        if sqlite3 is None:
+            raise KhinsiderError("The catalog needs Python's sqlite3 module.")
+        self.path = defaultCatalogPath() if path is None else path
+        self._lock = threading.Lock()
+        self._db = None
+        self._fullText = False
+    
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute('SELECT count(*) FROM albums').fetchone()[0]
+
+    def _connection(self):
+        if self._db is not None:
+            return self._db
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value)')
+            db.execute('CREATE TABLE IF NOT EXISTS pages '
+                       '(url TEXT PRIMARY KEY, etag TEXT, lastModified TEXT, sha1 TEXT)')
+            try:
+                db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS albums '
+                           'USING fts5(id UNINDEXED, name, page UNINDEXED)')
+            except sqlite3.OperationalError: # No FTS5.
+                db.execute('CREATE TABLE IF NOT EXISTS albums (id TEXT, name TEXT, page TEXT)')
+        sql = db.execute("SELECT sql FROM sqlite_master WHERE name = 'albums'").fetchone()[0]
+        self._fullText = 'fts5' in sql.lower()
+        self._db = db
+        return db
+
+    @property
+    def updated(self):
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value FROM info WHERE key = 'updated'").fetchone()
+        return row[0] if row is not None else None
+
+    def update(self, jobs=DEFAULT_RESOLVE_JOBS, session=None):
+        """Fetch KHInsider's album lists, `jobs` at a time, and index the
+        soundtracks in the ones that have changed since the last update.
+        Return how many lists had changed.
+
+        Lists are only fetched again if the server says they've changed
+        (with ETag or Last-Modified), and only read again if they really
+        have.
+        """
+        session = getSession() if session is None else session
+        home = getPage(BASE_URL, session, False, timeout=30)
+        home.raise_for_status()
+        soup = toSoup(home, CATALOG_LINK_STRAINER)
+        urls = list(OrderedDict.fromkeys(urljoin(home.url, a['href']) for a in soup('a')))
+        if not urls:
+            raise KhinsiderError("Couldn't find KHInsider's album lists.")
+
+        with self._lock:
+            known = dict((row[0], row[1:]) for row in self._connection().execute(
+                'SELECT url, etag, lastModified, sha1 FROM pages'))
+        
+        def fetch(url):
+            etag, lastModified, sha1 = known.get(url, (None, None, None))
+            headers = {}
+            if etag:
+                headers['If-None-Match'] = etag
+            if lastModified:
+                headers['If-Modified-Since'] = lastModified
+            r = getPage(url, session, False, headers=headers, timeout=30)
+            if r.status_code == 304:
+                return None
+            r.raise_for_status()
+            
+            newSha1 = hashlib.sha1(r.content).hexdigest()
+            albums = None
+            if newSha1 != sha1:
+                albums = OrderedDict(parsePage(albumListRows, r.content))
+            return url, r.headers.get('ETag'), r.headers.get('Last-Modified'), newSha1, albums
+        
+        changed = 0
+        for result in boundedIter(fetch, urls, jobs):
+            if result is None:
+                continue
+            url, etag, lastModified, sha1, albums = result
+            with self._lock:
+                db = self._connection()
+                with db:
+                    db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)',
+                               (url, etag, lastModified, sha1))
+                    if albums is not None:
+                        db.execute('DELETE FROM albums WHERE page = ?', (url,))
+                        db.executemany('INSERT INTO albums (id, name, page) VALUES (?, ?, ?)',
+                                       ((id, name, url) for id, name in albums.items()))
+            changed += albums is not None
+        
+        with self._lock:
+            db = self._connection()
+            with db:
+                for url in set(known) - set(urls):
+                    db.execute('DELETE FROM albums WHERE page = ?', (url,))
+                    db.execute('DELETE FROM pages WHERE url = ?', (url,))
+                db.execute("INSERT OR REPLACE INTO info VALUES ('updated', ?)", (time.time(),))
+        return changed
+
+    def search(self, term, session=None):
+        """Return what search would for `term`, but from the catalog: a list
+        of the Soundtracks with every word in `term` in their names (or
+        starting a word in them), and an empty list of song name results.
+        """
+        words = re.findall(r'\w+', term, re.UNICODE)
+        if not words:
+            return [[], []]
+        with self._lock:
+            db = self._connection()
+            if self._fullText:
+                query = ' '.join('"{}"*'.format(word) for word in words)
+                rows = db.execute('SELECT id, name FROM albums WHERE albums MATCH ? ORDER BY rank',
+                                  (query,)).fetchall()
+            else:
+                conditions = ' AND '.join(["name LIKE ? ESCAPE '\\'"] * len(words))
+                # Words can't have % or \ in them, but they can have _.
+                patterns = ['%{}%'.format(word.replace('_', '\\_')) for word in words]
+                rows = db.execute('SELECT id, name FROM albums WHERE {} ORDER BY name'.format(conditions),
+                                  patterns).fetchall()
+        
+        soundtracks = []
+        for id, name in OrderedDict(rows).items(): # Once each, even if listed twice.
+            soundtrack = Soundtrack(id, session)
+            soundtrack._lazy_name = name
+            soundtracks.append(soundtrack)
+        return [soundtracks, []]
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+_catalog = None
+def getCatalog():
+    """Return the Catalog search uses, or None if it doesn't use one (which
+    is the default).
+    """
+    return _catalog
+
+def setCatalog(catalog):
+    """Set the Catalog for search to use, or None to always ask KHInsider."""
+    global _catalog
+    _catalog = catalog
+
+
 def printSearchResults(searchResults, file=sys.stdout):
-    padLen = max(len(x.id) for x in chain(*searchResults))
+    """Print the results search returned. Soundtracks that have been loaded
+    (see search's `hydrate`) are shown with their number of tracks and how
+    big they are in each format.
+    """
+    if searchResults and isinstance(searchResults[0], Soundtrack):
+        searchResults = [searchResults, []] # KHInsider went straight to it.
+    padLen = max([len(x.id) for x in searchResultSoundtracks(searchResults)] or [0])
     s = ""
     hasPreviousList = False
     for heading, soundtracks in zip(("Album title results:", "Song name results:"), searchResults):
@@ -508,10 +3701,22 @@ def printSearchResults(searchResults, file=sys.stdout):
                 s += "\n"
             s += heading + "\n"
             for soundtrack in soundtracks:
-                s += "{} {}. {}\n".format(soundtrack.id, '.' * (padLen - len(soundtrack.id)), soundtrack.name)
+                s += "{} {}. {}{}\n".format(soundtrack.id, '.' * (padLen - len(soundtrack.id)),
+                                            soundtrack.name, searchResultDetails(soundtrack))
             hasPreviousList = True
     unicodePrint(s, end="", file=file)
 
+def searchResultDetails(soundtrack):
+    """Return the number of tracks in `soundtrack` and its size in each format
+    to show after it in search results, or "" if it hasn't been loaded.
+    """
+    if not soundtrack._isLoaded('songs'):
+        return ""
+    plan = soundtrack.plan()
+    formats = ", ".join("{} {}".format(format.upper(), formatSize(size)) if size else format.upper()
+                        for format, size in plan.bytesPerFormat.items())
+    return " ({} track{}: {})".format(plan.tracks, "" if plan.tracks == 1 else "s", formats)
+
 # --- And now for the execution. ---
 
 if __name__ == '__main__':
@@ -538,13 +3743,100 @@ if __name__ == '__main__':
                 prefix = 'Usage: '
             return super(ProperHelpFormatter, self).add_usage(usage, actions, groups, prefix)
 
+    def parseSpeed(argument):
+        m = re.match(r'^([0-9]+(?:\.[0-9]*)?)\s*([kmg]?)(?:i?b(?:/s)?)?$', argument.strip(), re.IGNORECASE)
+        if m is None or not float(m.group(1)):
+            raise argparse.ArgumentTypeError("\"{}\" isn't a speed.".format(argument))
+        return float(m.group(1)) * 1024 ** " kmg".index(m.group(2).lower() or ' ')
+
+    def printSavings():
+        store = getContentStore()
+        if store is not None and store.savedFiles:
+            print("\nLinked {} file{} that had already been downloaded, instead of downloading {}.".format(
+                store.savedFiles, "" if store.savedFiles == 1 else "s", formatSize(store.savedBytes)))
+
+    def doPlan(soundtrackIds, formatOrder):
+        def plan(soundtrackId):
+            try:
+                return Soundtrack(soundtrackId).plan(formatOrder)
+            except (KhinsiderError, SoundtrackError, requests.RequestException) as e:
+                return e
+        results = boundedMap(plan, soundtrackIds, DEFAULT_ALBUM_JOBS)
+        plans = [result for result in results if isinstance(result, SoundtrackPlan)]
+        for soundtrackId, result in zip(soundtrackIds, results):
+            if not isinstance(result, SoundtrackPlan):
+                print("Couldn't plan {}: {}".format(soundtrackId, result), file=sys.stderr)
+        printPlans(plans)
+        return 0 if len(plans) == len(results) else 1
+
+    def doBatch(arguments, soundtrackId, formatOrder, events):
+        try:
+            if arguments.batch == '-':
+                lines = sys.stdin.read().splitlines()
+            else:
+                with open(arguments.batch, 'rb') as f:
+                    lines = f.read().decode('utf-8').splitlines()
+        except (IOError, OSError) as e:
+            print("Couldn't read the soundtrack list: {}".format(e), file=sys.stderr)
+            return 1
+        soundtrackIds = [soundtrackId(line.strip()) for line in lines
+                         if line.strip() and not line.lstrip().startswith('#')]
+        outPath = arguments.soundtrack or ''
+        if arguments.plan:
+            return doPlan(soundtrackIds, formatOrder)
+
+        try:
+            results = downloadMany(soundtrackIds, outPath, formatOrder=formatOrder,
+                                   verbose=True, jobs=arguments.jobs, events=events,
+                                   adaptive=arguments.adaptive, bandwidth=arguments.max_speed,
+                                   segments=arguments.segments, archiveFormat=arguments.archive)
+        except KeyboardInterrupt:
+            print("Stopped download.", file=sys.stderr)
+            return 1
+        
+        print("\nSummary:")
+        printDownloadSummary(results)
+        printSavings()
+        return 0 if all(result is True for result in results.values()) else 1
+
+    def doCatalog(arguments):
+        if not arguments.catalog:
+            return 0
+        if not arguments.update_catalog and not os.path.exists(defaultCatalogPath()):
+            return 0
+        try:
+            catalog = Catalog()
+        except KhinsiderError as e:
+            print("Couldn't use the catalog: {}".format(e), file=sys.stderr)
+            return 1 if arguments.update_catalog else 0
+        
+        if arguments.update_catalog:
+            print("Updating the soundtrack catalog...")
+            try:
+                changed = catalog.update()
+            except ServerBusyError:
+                print("KHInsider is too busy right now. Try again in a bit.", file=sys.stderr)
+                return 1
+            except (HostUnavailableError, requests.RequestException) as e:
+                print("Couldn't update the catalog: {}".format(e), file=sys.stderr)
+                return 1
+            print("{} album list{} changed - {} soundtracks in the catalog.".format(
+                changed, "" if changed == 1 else "s", len(catalog)))
+        setCatalog(catalog)
+        return 0
+
+    # Whatever doIt opens that has to be closed once it's done, however it ends.
+    toClose = []
+
     def doIt(): # Only in a function to be able to stop after errors, really.
         parser = KindArgumentParser(description="Download entire soundtracks from KHInsider.\n\n"
                                     "Examples:\n"
                                     "%(prog)s jumping-flash\n"
                                     "%(prog)s katamari-forever \"music{}Katamari Forever OST\"\n"
                                     "%(prog)s --search persona\n"
-                                    "%(prog)s --format flac mother-3".format(os.sep),
+                                    "%(prog)s --format flac mother-3\n"
+                                    "%(prog)s --batch soundtracks.txt music\n"
+                                    "%(prog)s --update-catalog".format(os.sep),
                                     epilog="Hope you enjoy the script!",
                                     formatter_class=ProperHelpFormatter,
                                     add_help=False)
@@ -555,7 +3847,7 @@ if __name__ == '__main__':
         except AttributeError:
             pass
 
-        parser.add_argument('soundtrack',
+        parser.add_argument('soundtrack', nargs='?',
                             help="The ID of the soundtrack, used at the end of its URL (e.g. \"jumping-flash\").\n"
                             "May also simply be the URL of the soundtrack.\n"
                             "If it doesn't exist (or --search is specified, orrrr too many arguments are supplied),\n"
@@ -573,19 +3865,109 @@ if __name__ == '__main__':
                             "(for example, \"flac,mp3\": download FLAC if available, otherwise MP3).")
         parser.add_argument('-s', '--search', action='store_true',
                             help="Always search, regardless of whether the specified soundtrack ID exists or not.")
+        parser.add_argument('--details', action='store_true',
+                            help="Show how many tracks each soundtrack in the search results has, and how\n"
+                            "big it is in each format (which fetches their pages, several at once).")
+        parser.add_argument('--update-catalog', action='store_true',
+                            help="Build (or bring up to date) a catalog of every soundtrack on KHInsider, kept\n"
+                            "alongside the page cache. Once there is one, searches are done in it, which is\n"
+                            "a lot faster - but only finds album names, and only the ones there were when\n"
+                            "it was last updated.")
+        parser.add_argument('--no-catalog', dest='catalog', action='store_false',
+                            help="Ask KHInsider when searching, even if there's a catalog.")
+        parser.add_argument('--no-cache', dest='cache', action='store_false',
+                            help="Don't cache KHInsider's pages between runs (by default, they're kept in\n"
+                            "\"{}\").".format(defaultCacheDirectory()))
+        parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS, metavar="N",
+                            help="How many files to download at once (default: {}).".format(DEFAULT_JOBS))
+        parser.add_argument('-b', '--batch', default=None, metavar="FILE",
+                            help="Download every soundtrack listed in FILE (one ID or URL per line,\n"
+                            "or \"-\" to read them from standard input), all at once.\n"
+                            "The first positional argument, if any, is then the directory to download them to.")
+        parser.add_argument('--adaptive', action='store_true',
+                            help="Adjust how many things are downloaded at once to how well the servers\n"
+                            "keep up, starting from --jobs - and slow down when they ask us to.")
+        parser.add_argument('--max-speed', type=parseSpeed, default=None, metavar="SPEED",
+                            help="Don't download faster than SPEED bytes per second in total\n"
+                            "(e.g. \"500K\" or \"2M\").")
+        parser.add_argument('--plan', action='store_true',
+                            help="Don't download anything - just show how many tracks there are and how big\n"
+                            "the download would be, in each format and in total (going by the album page).")
+        parser.add_argument('--segments', type=int, default=1, metavar="N",
+                            help="Download big files (like FLACs of long tracks, or bonus archives)\n"
+                            "in N parts at once, over N connections each.")
+        parser.add_argument('--archive', choices=list(ARCHIVE_FORMATS), default=None,
+                            help="Download the soundtrack into a single zip or tar file (named after the\n"
+                            "download directory) instead of a directory of files. The files are streamed\n"
+                            "straight into it, and not compressed.")
+        parser.add_argument('--dedupe', action='store_true',
+                            help="Keep track of every file downloaded (alongside the page cache), and link to\n"
+                            "files that have already been downloaded somewhere - like the same song in\n"
+                            "another soundtrack - instead of downloading them again.")
+        parser.add_argument('--parse-workers', type=int, default=0, metavar="N",
+                            help="Parse pages in N other processes, to use more cores when looking up\n"
+                            "lots of songs at once.")
+        parser.add_argument('--tries', type=int, default=DEFAULT_TRIES, metavar="N",
+                            help="Try each request up to N times if it fails (default: {}).".format(DEFAULT_TRIES))
+        parser.add_argument('--metrics', default=None, metavar="FILE",
+                            help="Add a line of JSON to FILE for everything that happens during the download\n"
+                            "(pages fetched, files started and finished, retries, and so on), with timings.")
+        # Handled before anything else (see "Install prerequisites").
+        parser.add_argument('--check-dependencies', action='store_true',
+                            help="Check that everything khinsider.py needs is installed (and install it if not).\n"
+                            "This is only done by itself the first time it's run.")
 
         arguments = parser.parse_args()
+        nothingToDownload = arguments.soundtrack is None and arguments.batch is None
+        if nothingToDownload and not arguments.update_catalog:
+            parser.error("No soundtrack specified.")
+        if not arguments.cache:
+            setPageCache(None)
+        if arguments.tries != DEFAULT_TRIES:
+            setRetryPolicy(RetryPolicy(tries=max(arguments.tries, 1)))
+        if poolSize(arguments.jobs, arguments.segments, arguments.adaptive) > DEFAULT_POOL_SIZE:
+            setSession(makeSession(poolSize(arguments.jobs, arguments.segments,
+                                            arguments.adaptive)))
+        if arguments.parse_workers > 0:
+            setParsePool(makeParsePool(arguments.parse_workers))
+        if arguments.dedupe:
+            try:
+                setContentStore(ContentStore())
+            except KhinsiderError as e:
+                print("Couldn't use the content store: {}".format(e), file=sys.stderr)
+                return 1
+        catalogStatus = doCatalog(arguments)
+        if catalogStatus or nothingToDownload:
+            return catalogStatus
+        metrics = None
+        if arguments.metrics is not None:
+            try:
+                metrics = MetricsWriter(arguments.metrics)
+            except (IOError, OSError) as e:
+                print("Couldn't open the metrics file: {}".format(e), file=sys.stderr)
+                return 1
+            toClose.append(metrics)
 
-        try:
-            soundtrack = arguments.soundtrack.decode(sys.getfilesystemencoding())
-        except AttributeError: # Python 3's argv is in Unicode
-            soundtrack = arguments.soundtrack
-        
         urlRe = re.compile(r"^https?://" + urlsplit(BASE_URL).netloc +
                            r"/game-soundtracks/album/(?P<soundtrack>[^/]+)$",
                            re.IGNORECASE)
-        m = urlRe.match(soundtrack)
-        soundtrack = m.group('soundtrack') if m is not None else soundtrack
+        def soundtrackId(argument):
+            try:
+                argument = argument.decode(sys.getfilesystemencoding())
+            except AttributeError: # Python 3's argv is in Unicode
+                pass
+            m = urlRe.match(argument)
+            return m.group('soundtrack') if m is not None else argument
+
+        formatOrder = arguments.format
+        if formatOrder:
+            formatOrder = re.split(r',\s*', formatOrder)
+            formatOrder = [extension.lstrip('.').lower() for extension in formatOrder]
+
+        if arguments.batch is not None:
+            return doBatch(arguments, soundtrackId, formatOrder, metrics)
+
+        soundtrack = soundtrackId(arguments.soundtrack)
 
         outPath = arguments.outPath # Can be None; handled in download().
 
@@ -601,15 +3983,13 @@ if __name__ == '__main__':
             searchTerm = ' '.join(searchTerm)
         searchTerm = searchTerm.replace('-', ' ')
 
-        formatOrder = arguments.format
-        if formatOrder:
-            formatOrder = re.split(r',\s*', formatOrder)
-            formatOrder = [extension.lstrip('.').lower() for extension in formatOrder]
+        if arguments.plan and not onlySearch:
+            return doPlan([soundtrack], formatOrder)
 
         try:
             if onlySearch:
                 try:
-                    searchResults = search(searchTerm)
+                    searchResults = search(searchTerm, hydrate=arguments.details)
                 except SearchError as e:
                     if re.match(r"^Found [0-9]+ matching albums.$", e.args[0]):
                         errorStr = "Couldn't search! {}".format(REPORT_STR)
@@ -617,7 +3997,7 @@ if __name__ == '__main__':
                         errorStr = "Couldn't search. {}".format(e.args[0])
                     print(errorStr, file=sys.stderr)
                 else:
-                    if searchResults:
+                    if any(searchResults):
                         print("Soundtracks found (to download, "
                               "run \"{} soundtrack-name\")!\n".format(SCRIPT_NAME))
                         printSearchResults(searchResults)
@@ -625,18 +4005,24 @@ if __name__ == '__main__':
                         print("No soundtracks found.")
             else:
                 try:
-                    success = download(soundtrack, outPath, formatOrder=formatOrder, verbose=True)
+                    success = download(soundtrack, outPath, formatOrder=formatOrder, verbose=True,
+                                       jobs=arguments.jobs, events=metrics,
+                                       adaptive=arguments.adaptive,
+                                       bandwidth=arguments.max_speed,
+                                       segments=arguments.segments,
+                                       archiveFormat=arguments.archive)
+                    printSavings()
                     if not success:
                         print("\nNot all files could be downloaded.", file=sys.stderr)
                         return 1
                 except NonexistentSoundtrackError:
                     try:
-                        searchResults = search(searchTerm)
+                        searchResults = search(searchTerm, hydrate=arguments.details)
                     except SearchError:
                         searchResults = None
                     print("The soundtrack \"{}\" does not seem to exist.".format(soundtrack), file=sys.stderr)
 
-                    if searchResults: # aww yeah we gon' do some searchin'
+                    if searchResults and any(searchResults): # aww yeah we gon' do some searchin'
                         print("\nThese exist, though:", file=sys.stderr)
                         printSearchResults(searchResults, file=sys.stderr)
                     elif searchResults is None:
@@ -664,7 +4050,12 @@ if __name__ == '__main__':
                 except KeyboardInterrupt:
                     print("Stopped download.", file=sys.stderr)
                     return 1
-        except (requests.ConnectionError, requests.Timeout):
+        except ImportError:
+            raise # See below.
+        except ServerBusyError:
+            print("KHInsider is too busy right now. Try again in a bit.", file=sys.stderr)
+            return 1
+        except (HostUnavailableError, requests.ConnectionError, requests.Timeout):
             print("Could not connect to KHInsider.", file=sys.stderr)
             print("Make sure you have a working internet connection.", file=sys.stderr)
             return 1
@@ -678,4 +4069,19 @@ if __name__ == '__main__':
     
         return 0
     
-    sys.exit(doIt())
+    try:
+        status = doIt()
+    except ImportError as e:
+        # Something that was installed when the dependencies were last
+        # checked isn't anymore, so they'll be checked again next time.
+        try:
+            os.remove(dependencyMarker)
+        except OSError:
+            pass
+        print("Couldn't import a module khinsider.py needs: {}".format(e), file=sys.stderr)
+        print("Run khinsider.py again (or with --check-dependencies) to install it.", file=sys.stderr)
+        status = 1
+    finally:
+        for thing in toClose:
+            thing.close()
+    sys.exit(status)
@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# An asyncio interface to khinsider.py, for downloading soundtracks from
+# inside an event loop. Requires Python 3.7+ and aiohttp.
+#
+# The parsing (and the errors) are the same as khinsider.py's - only the
+# fetching and downloading are done differently.
+
+import asyncio
+import hashlib
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from functools import partial
+from urllib.parse import urljoin
+
+import aiohttp
+
+import khinsider
+from khinsider import (ALBUM_FETCHED, ALBUM_STARTED, CHUNK_SIZE, DEFAULT_JOBS,
+                       DEFAULT_JOBS_PER_HOST, DEFAULT_RESOLVE_JOBS, DONE,
+                       FILE_STARTED, PART_SUFFIX, PROGRESS, PROGRESS_INTERVAL,
+                       RETRY, SKIPPED, SONG_RESOLVED, CachedPage, HostUnavailableError,
+                       KhinsiderError, Manifest, NonexistentFormatsError, NonexistentSongError,
+                       NonexistentSoundtrackError, ProgressPrinter, SoundtrackError,
+                       combineEvents, getAppropriateFile, getcwd, hashFile,
+                       localFilename, replaceFile, sendEvent, songFileUrls,
+                       songName, to_valid_filename, unicodePrint, urlFilename)
+
+TIMEOUT = aiohttp.ClientTimeout(sock_connect=10, sock_read=10)
+
+
+def makeSession(limit=100, limitPerHost=DEFAULT_JOBS_PER_HOST * 2):
+    """Return a new aiohttp.ClientSession suitable for talking to KHInsider.
+
+    At most `limit` connections are open at once, and at most `limitPerHost`
+    to the same host. Share one session between everything running on an
+    event loop to have these limits apply to all of it.
+    """
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limitPerHost)
+    return aiohttp.ClientSession(connector=connector, timeout=TIMEOUT)
+
+
+@asynccontextmanager
+async def _sessionOrNew(session):
+    if session is not None:
+        yield session
+    else:
+        async with makeSession() as session:
+            yield session
+
+
+async def _parse(func, *args):
+    # Parsing is CPU-bound, so keep it from blocking the event loop.
+    return await _inThread(func, *args)
+
+
+async def _inThread(func, *args):
+    # As is waiting for the disk.
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args))
+
+
+def _writeChunk(outFile, hasher, chunk):
+    outFile.write(chunk)
+    hasher.update(chunk)
+
+
+async def getPage(url, session, **kwargs):
+    """Get the page at `url` as a CachedPage (which has `url` and `content`),
+    trying again as khinsider.getRetryPolicy() says if it fails.
+    """
+    async def fetch():
+        async with session.get(url, **kwargs) as r:
+            if r.status in khinsider.getRetryPolicy().statuses:
+                r.raise_for_status()
+            content = await r.read()
+            return CachedPage(str(r.url), content)
+    return await _retrying(url, fetch)
+
+
+async def _retrying(url, func, onRetry=None):
+    """Await `func()`, which makes a request to `url`, trying it again the
+    same way khinsider.RetryPolicy.call would - but waiting in between
+    without holding up the event loop.
+    """
+    policy = khinsider.getRetryPolicy()
+    triesElapsed = 0
+    while True:
+        policy.check(url)
+        try:
+            result = await func()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Errors from responses have their status (and headers).
+            status = getattr(e, 'status', None)
+            if status is not None and status not in policy.statuses:
+                raise
+            policy.failed(url, status)
+            triesElapsed += 1
+            retryAfter = khinsider.retryAfterSeconds(e) if getattr(e, 'headers', None) else None
+            delay = policy.delay(triesElapsed, retryAfter)
+            if triesElapsed >= policy.tries or delay is None:
+                raise
+            if onRetry is not None:
+                onRetry(e, triesElapsed, delay)
+            await asyncio.sleep(delay)
+        else:
+            policy.succeeded(url)
+            return result
+
+
+async def _gatherBounded(func, items, jobs):
+    semaphore = asyncio.Semaphore(max(jobs, 1))
+    async def bounded(item):
+        async with semaphore:
+            return await func(item)
+    return await asyncio.gather(*(bounded(item) for item in items))
+
+
+class Soundtrack(object):
+    """A KHInsider soundtrack. Initialize with a soundtrack ID.
+
+    Same as khinsider.Soundtrack, except that name, availableFormats, songs
+    and images are only there after `await soundtrack.load()`.
+    """
+
+    def __init__(self, soundtrackId, session=None):
+        self.id = soundtrackId
+        self.url = urljoin(khinsider.BASE_URL, 'game-soundtracks/album/' + self.id)
+        self.session = session
+        self._parsed = None
+
+    def __repr__(self):
+        return "<{}: {}>".format(self.__class__.__name__, self.id)
+
+    def _isLoaded(self):
+        return self._parsed is not None
+
+    async def load(self):
+        """Fetch and parse the soundtrack's page, unless that's already done.
+        Raise NonexistentSoundtrackError if the soundtrack doesn't exist.
+        """
+        async with _sessionOrNew(self.session) as session:
+            return await self._load(session)
+
+    async def _load(self, session):
+        if self._parsed is not None:
+            return self
+        start = time.time()
+        page = await getPage(self.url, session)
+
+        def parse():
+            parsed = khinsider.Soundtrack(self.id, session=False)
+            parsed._loadPage(page)
+            return parsed
+        try:
+            parsed = await _parse(parse)
+        except NonexistentSoundtrackError:
+            raise NonexistentSoundtrackError(self)
+
+        self.name = parsed.name
+        self.availableFormats = parsed.availableFormats
+        self.songs = []
+        for parsedSong in parsed.songs:
+            song = Song(parsedSong.url, self.session)
+            song.duration, song.sizes = parsedSong.duration, parsedSong.sizes
+            song._name = getattr(parsedSong, '_lazy_name', None)
+            self.songs.append(song)
+        self.images = [File(image.url, self.session) for image in parsed.images]
+        self._parsed = parsed
+        self._fetchSeconds = time.time() - start
+        return self
+
+    async def plan(self, formatOrder=None):
+        """Return a khinsider.SoundtrackPlan of what downloading the
+        soundtrack would get (see khinsider.Soundtrack.plan).
+        """
+        await self.load()
+        plan = khinsider.SoundtrackPlan(self._parsed, formatOrder)
+        plan.soundtrack = self
+        return plan
+
+    async def download(self, path='', makeDirs=True, formatOrder=None, verbose=False,
+                       resolveJobs=DEFAULT_RESOLVE_JOBS, jobs=DEFAULT_JOBS, events=None):
+        """Download the soundtrack to the directory specified by `path`.
+        See khinsider.Soundtrack.download for what the arguments do.
+
+        At most `resolveJobs` song pages are fetched, and `jobs` files are
+        downloaded, at once for this soundtrack. To limit requests across
+        several soundtracks, share a session from makeSession between them.
+
+        Return True if all files were downloaded successfully, False if not.
+        """
+        if events is not None:
+            subscriber = events
+            def events(event):
+                event.soundtrack = self.id
+                subscriber(event)
+        if verbose:
+            events = combineEvents(events, ProgressPrinter())
+        sendEvent(events, ALBUM_STARTED, url=self.url, fetching=not self._isLoaded())
+
+        async with _sessionOrNew(self.session) as session:
+            await self._load(session)
+            items = self.songs + self.images
+            # Songs and files made without a session need this one for now.
+            for item in items:
+                item.session = session
+            try:
+                return await self._download(session, path, makeDirs, formatOrder,
+                                            resolveJobs, jobs, events)
+            finally:
+                for item in items:
+                    item.session = self.session
+
+    async def _download(self, session, path, makeDirs, formatOrder, resolveJobs, jobs, events):
+        path = os.path.join(getcwd(), path)
+        path = os.path.abspath(os.path.realpath(path))
+        if formatOrder:
+            formatOrder = [extension.lower() for extension in formatOrder]
+            if not set(self.availableFormats) & set(formatOrder):
+                raise NonexistentFormatsError(self, formatOrder)
+
+        manifest = await _inThread(Manifest, path, formatOrder)
+        sendEvent(events, ALBUM_FETCHED, url=self.url, songs=len(self.songs),
+                  seconds=self._fetchSeconds)
+        unresolved = [song for song in self.songs if manifest.get(song.url) is None]
+        resolved = iter(await resolveSongs(unresolved, formatOrder, resolveJobs, events))
+        files = []
+        for song in self.songs:
+            entry = manifest.get(song.url)
+            files.append(File(entry['url'], session) if entry is not None else next(resolved))
+        files.extend(self.images)
+        keys = [song.url for song in self.songs] + [image.url for image in self.images]
+
+        if makeDirs and not await _inThread(os.path.isdir, path):
+            await _inThread(os.makedirs, path)
+
+        total = len(files)
+        async def downloadOne(item):
+            index, (file, key) = item
+            return await friendlyDownloadFile(file, path, index, total, False, manifest, key,
+                                              events)
+        try:
+            results = await _gatherBounded(downloadOne, enumerate(zip(files, keys), 1), jobs)
+        finally:
+            await _inThread(manifest.save)
+        return all(results)
+
+
+class Song(object):
+    """A song on KHInsider.
+
+    Same as khinsider.Song, except that files is only there after
+    `await song.load()`.
+    """
+
+    def __init__(self, url, session=None):
+        self.url = url
+        self.session = session
+        self.duration = None
+        self.sizes = {}
+        self._name = None
+        self._loaded = False
+
+    def __repr__(self):
+        return "<{}: {}>".format(self.__class__.__name__, self.url)
+
+    async def load(self):
+        """Fetch and parse the song's page, unless that's already done.
+        Raise NonexistentSongError if the song doesn't exist.
+        """
+        if self._loaded:
+            return self
+        async with _sessionOrNew(self.session) as session:
+            page = await getPage(self.url, session)
+        if page.url.rsplit('/', 1)[-1] == '404':
+            raise NonexistentSongError("Nonexistent song page (404).")
+
+        def parse():
+            name = self._name if self._name is not None else songName(page)
+            return songFileUrls(page.content), name
+        urls, self._name = await _parse(parse)
+        self.files = [File(urljoin(self.url, url), self.session) for url in urls]
+        self._loaded = True
+        return self
+
+    @property
+    def name(self):
+        """The name of the song. Only there after `await song.load()`, unless
+        the song is from a loaded Soundtrack.
+        """
+        if self._name is None:
+            raise AttributeError("The song has to be loaded first.")
+        return self._name
+
+
+class File(object):
+    """A file belonging to a soundtrack on KHInsider.
+
+    Properties:
+    * url:      The full URL of the file.
+    * filename: The file's filename.
+    """
+
+    def __init__(self, url, session=None):
+        self.url = url
+        self.session = session
+        self.filename = urlFilename(url)
+
+    def __repr__(self):
+        return "<{}: {}>".format(self.__class__.__name__, self.url)
+
+    async def isAvailable(self):
+        """Check whether the file exists with a HEAD request."""
+        async with _sessionOrNew(self.session) as session:
+            try:
+                async with session.head(self.url, allow_redirects=True) as r:
+                    return r.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return False
+
+    async def download(self, path, chunkSize=CHUNK_SIZE, progress=None):
+        """Download the file to `path`, the same way khinsider.File.download
+        does: streamed to a partial file that's resumed if it's already there.
+        `progress` is called after each chunk, as with khinsider.File.download.
+
+        Return a tuple of the file's size and the hex digest of its SHA-1.
+        """
+        async with _sessionOrNew(self.session) as session:
+            return await self._download(session, path, chunkSize, progress)
+
+    async def _download(self, session, path, chunkSize, progress):
+        partPath = path + PART_SUFFIX
+        offset = await _inThread(lambda: os.path.getsize(partPath) if os.path.exists(partPath) else 0)
+        hasher = hashlib.sha1()
+
+        for _ in range(2):
+            headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+            async with session.get(self.url, headers=headers) as response:
+                if offset and response.status == 416:
+                    # Either the partial file is actually complete...
+                    m = re.match(r'^bytes \*/([0-9]+)$', response.headers.get('Content-Range', ''))
+                    if m is not None and int(m.group(1)) == offset:
+                        await _inThread(hashFile, partPath, hasher)
+                        await _inThread(replaceFile, partPath, path)
+                        return offset, hasher.hexdigest()
+                    # ...or it's not a part of this file at all.
+                    await _inThread(os.remove, partPath)
+                    offset = 0
+                    continue
+                response.raise_for_status()
+                if response.status != 206:
+                    # The server ignored the Range header and is sending it all.
+                    offset = 0
+                elif offset:
+                    await _inThread(hashFile, partPath, hasher)
+
+                expectedSize = response.content_length
+                totalSize = offset + expectedSize if expectedSize is not None else None
+                written = 0
+                if progress is not None:
+                    progress(offset, totalSize)
+                outFile = await _inThread(open, partPath, 'ab' if offset else 'wb')
+                try:
+                    async for chunk in response.content.iter_chunked(chunkSize):
+                        await _inThread(_writeChunk, outFile, hasher, chunk)
+                        written += len(chunk)
+                        if progress is not None:
+                            progress(offset + written, totalSize)
+                finally:
+                    await _inThread(outFile.close)
+            break
+
+        if expectedSize is not None and written < expectedSize:
+            raise aiohttp.ClientPayloadError("Connection closed before the whole file was received.")
+        await _inThread(replaceFile, partPath, path)
+        return offset + written, hasher.hexdigest()
+
+
+async def resolveSongs(songs, formatOrder=None, jobs=DEFAULT_RESOLVE_JOBS, events=None):
+    """Return a list with the appropriate File for each Song in `songs`, in
+    the same order as `songs`, fetching up to `jobs` song pages at once.
+    Songs that don't exist get None instead of a File. A SONG_RESOLVED Event
+    is sent to `events` for each song.
+    """
+    async def resolve(song):
+        start = time.time()
+        try:
+            await song.load()
+        except NonexistentSongError:
+            file = None
+        else:
+            file = getAppropriateFile(song, formatOrder)
+        sendEvent(events, SONG_RESOLVED, url=song.url,
+                  file=file.url if file is not None else None,
+                  seconds=time.time() - start)
+        return file
+    return await _gatherBounded(resolve, songs, jobs)
+
+
+async def friendlyDownloadFile(file, path, index, total, verbose=False,
+                               manifest=None, key=None, events=None):
+    """Download `file` into the directory `path`, unless it's already there.
+    See khinsider.friendlyDownloadFile.
+
+    Return True if the file is there now, False if not.
+    """
+    if verbose:
+        events = combineEvents(events, ProgressPrinter(index))
+
+    if file is None:
+        sendEvent(events, SKIPPED, index=index, total=total, url=None, filename=None,
+                  reason='nonexistent')
+        return False
+
+    filename, byTheWay = localFilename(file)
+    path = os.path.join(path, filename)
+
+    entry = manifest.get(key) if manifest is not None else None
+    if entry is not None and (entry['url'] != file.url or entry['filename'] != filename):
+        entry = None
+
+    size = await _inThread(lambda: os.path.getsize(path) if os.path.exists(path) else None)
+    exists = size is not None
+    redownload = exists and entry is not None and size != entry['size']
+
+    if exists and not redownload:
+        if manifest is not None and entry is None:
+            sha1 = await _inThread(lambda: hashFile(path).hexdigest())
+            manifest.record(key, file, filename, size, sha1)
+        sendEvent(events, SKIPPED, index=index, total=total, url=file.url, filename=filename,
+                  note=byTheWay, reason='exists', bytes=size)
+        return True
+
+    sendEvent(events, FILE_STARTED, index=index, total=total, url=file.url,
+              filename=filename, note=byTheWay, redownload=redownload)
+    start = time.time()
+    progress = None
+    if events is not None:
+        lastProgress = start
+        def progress(bytesSoFar, totalBytes):
+            nonlocal lastProgress
+            now = time.time()
+            if now - lastProgress >= PROGRESS_INTERVAL:
+                lastProgress = now
+                sendEvent(events, PROGRESS, index=index, url=file.url,
+                          bytes=bytesSoFar, totalBytes=totalBytes)
+
+    def onRetry(error, triesElapsed, delay):
+        sendEvent(events, RETRY, index=index, url=file.url, filename=filename,
+                  attempt=triesElapsed + 1, error=str(error), delay=delay)
+
+    size = None
+    error = None
+    try:
+        try:
+            size, sha1 = await _retrying(file.url, lambda: file.download(path, progress=progress),
+                                         onRetry)
+        except (HostUnavailableError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = e
+    finally:
+        sendEvent(events, DONE, index=index, total=total, url=file.url, filename=filename,
+                  success=size is not None, bytes=size, seconds=time.time() - start,
+                  error=str(error) if size is None and error is not None else None)
+
+    if size is None:
+        return False
+    if manifest is not None:
+        manifest.record(key, file, filename, size, sha1)
+    return True
+
+
+async def download(soundtrackId, path='', makeDirs=True, formatOrder=None, verbose=False,
+                   resolveJobs=DEFAULT_RESOLVE_JOBS, jobs=DEFAULT_JOBS, session=None,
+                   events=None):
+    """Download the soundtrack with the ID `soundtrackId`.
+    See Soundtrack.download for more information.
+    """
+    async with _sessionOrNew(session) as session:
+        soundtrack = Soundtrack(soundtrackId, session)
+        await soundtrack.load()
+        path = to_valid_filename(soundtrack.name) if path is None else path
+        if verbose:
+            unicodePrint("Downloading to \"{}\".".format(path))
+        return await soundtrack.download(path, makeDirs, formatOrder, verbose,
+                                         resolveJobs, jobs, events)
+
+
+async def search(term, session=None, hydrate=False, jobs=DEFAULT_RESOLVE_JOBS):
+    """Return the same as khinsider.search, but with this module's
+    Soundtrack objects. Their names are there without loading them - and
+    if `hydrate` is set to True, they're all loaded too, `jobs` at a time.
+    Ones that can't be loaded are left as they are.
+
+    The search is tried again as khinsider.getRetryPolicy() says if it
+    fails. Raise aiohttp.ClientResponseError if KHInsider still responds
+    with an error after that.
+    """
+    async with _sessionOrNew(session) as activeSession:
+        url = urljoin(khinsider.BASE_URL, 'search')
+        async def fetch():
+            async with activeSession.get(url, params={'search': term}) as r:
+                # An error page would otherwise look like there were no results.
+                r.raise_for_status()
+                return CachedPage(str(r.url), await r.read())
+        page = await _retrying(url, fetch)
+        results = await _parse(khinsider.searchResultsFromPage, page, False)
+
+        def convert(syncSoundtrack):
+            soundtrack = Soundtrack(syncSoundtrack.id, session)
+            if syncSoundtrack._isLoaded('name'):
+                soundtrack.name = syncSoundtrack.name
+            return soundtrack
+        if results and isinstance(results[0], khinsider.Soundtrack):
+            results = [convert(s) for s in results]
+            soundtracks = results
+        else:
+            results = [[convert(s) for s in soundtracks] for soundtracks in results]
+            soundtracks = [s for soundtracks in results for s in soundtracks]
+
+        if hydrate:
+            async def load(soundtrack):
+                try:
+                    await soundtrack._load(activeSession)
+                except (KhinsiderError, SoundtrackError, aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+            await _gatherBounded(load, soundtracks, jobs)
+    return results
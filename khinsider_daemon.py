@@ -0,0 +1,721 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# A download daemon for khinsider.py: a process that stays running and
+# downloads the soundtracks it's asked to, one after another (or a few at
+# once), keeping its connections and caches warm between them.
+#
+# Jobs are added over a small HTTP API - on a local port or a Unix socket -
+# and kept in an SQLite queue, so they survive the daemon being restarted.
+# Soundtracks that were being downloaded when it stopped pick up where they
+# left off the next time it starts.
+#
+# Run "khinsider_daemon.py --help" for how to use it from the command line.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import binascii
+import hmac
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from http.client import HTTPConnection
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+except ImportError: # Python 2
+    from httplib import HTTPConnection
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+
+import khinsider
+from khinsider import (DEFAULT_ALBUM_JOBS, DEFAULT_JOBS, DEFAULT_JOBS_PER_HOST,
+                       DEFAULT_RESOLVE_JOBS, DONE, FILE_STARTED, PROGRESS, SKIPPED,
+                       HostLimiter, KhinsiderError, Soundtrack, SoundtrackError,
+                       bandwidthLimiter, maxJobs, poolSize, requests, sqlite3,
+                       to_valid_filename, unicodePrint)
+
+DEFAULT_ADDRESS = '127.0.0.1:8245'
+
+# The names requests may use for the daemon (besides IP addresses and the
+# host it listens on), so that web pages can't reach it by pointing a domain
+# of theirs at 127.0.0.1.
+LOCAL_HOSTNAMES = ('localhost', 'localhost.localdomain')
+
+textType = str if sys.version_info[0] > 2 else unicode
+
+# The states of jobs.
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+JOB_FIELDS = ('id', 'soundtrack', 'path', 'formats', 'state', 'added', 'started',
+              'finished', 'files', 'filesDone', 'filesFailed', 'bytes', 'error')
+
+
+def defaultQueuePath():
+    return os.path.join(khinsider.defaultCacheDirectory(), 'queue.sqlite3')
+
+def defaultTokenPath():
+    return os.path.join(khinsider.defaultCacheDirectory(), 'daemon-token')
+
+
+def makeToken(path=None):
+    """Make up a new token for the API, save it to `path` (readable only by
+    the current user) and return it.
+    """
+    path = defaultTokenPath() if path is None else path
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    token = binascii.hexlify(os.urandom(16)).decode('ascii')
+    if os.path.exists(path):
+        os.remove(path) # So that it's created with the right permissions.
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+def readToken(path=None):
+    """Return the token saved by makeToken, or None if there isn't one."""
+    try:
+        with open(defaultTokenPath() if path is None else path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+class JobQueue(object):
+    """The daemon's jobs, kept in an SQLite database at `path`.
+
+    Each job is a dictionary with these keys:
+    * id:          The job's number.
+    * soundtrack:  The ID of the soundtrack to download.
+    * path:        The directory to download it into a directory of its own in.
+    * formats:     The formatOrder to download it with (or None).
+    * state:       QUEUED, RUNNING, FINISHED (with all files downloaded),
+                   FAILED (without) or CANCELLED.
+    * added, started, finished: When those happened, as time.time()s (or None).
+    * files:       How many files the soundtrack has (or None if not known yet).
+    * filesDone:   How many of them are there.
+    * filesFailed: How many of them couldn't be downloaded.
+    * bytes:       How much has been downloaded (or was already there).
+    * error:       Why the job failed, or None.
+    """
+
+    def __init__(self, path=None):
+        if sqlite3 is None:
+            raise KhinsiderError("The job queue needs Python's sqlite3 module.")
+        self.path = defaultQueuePath() if path is None else path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        try:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, soundtrack TEXT, '
+                    'path TEXT, formats TEXT, state TEXT, added REAL, started REAL, '
+                    'finished REAL, files INTEGER, filesDone INTEGER, filesFailed INTEGER, '
+                    'bytes INTEGER, error TEXT)')
+        except sqlite3.Error as e:
+            raise KhinsiderError("Couldn't open the job queue at {}: {}".format(self.path, e))
+
+    def _job(self, row):
+        if row is None:
+            return None
+        job = dict(zip(JOB_FIELDS, row))
+        job['formats'] = json.loads(job['formats']) if job['formats'] else None
+        return job
+
+    def add(self, soundtrackId, path='', formatOrder=None):
+        """Queue up a download of the soundtrack `soundtrackId` and return the job."""
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                'INSERT INTO jobs (soundtrack, path, formats, state, added, filesDone, '
+                'filesFailed, bytes) VALUES (?, ?, ?, ?, ?, 0, 0, 0)',
+                (soundtrackId, path, json.dumps(formatOrder) if formatOrder else None,
+                 QUEUED, time.time()))
+            jobId = cursor.lastrowid
+        return self.job(jobId)
+
+    def job(self, jobId):
+        """Return the job numbered `jobId`, or None if there isn't one."""
+        with self._lock:
+            return self._job(self._db.execute(
+                'SELECT {} FROM jobs WHERE id = ?'.format(', '.join(JOB_FIELDS)),
+                (jobId,)).fetchone())
+
+    def jobs(self):
+        """Return every job, oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT {} FROM jobs ORDER BY id'.format(', '.join(JOB_FIELDS))).fetchall()
+        return [self._job(row) for row in rows]
+
+    def claim(self):
+        """Mark the oldest queued job as running and return it, or return
+        None if there are none.
+        """
+        with self._lock, self._db:
+            row = self._db.execute("SELECT id FROM jobs WHERE state = ? ORDER BY id LIMIT 1",
+                                   (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE jobs SET state = ?, started = ? WHERE id = ?',
+                             (RUNNING, time.time(), row[0]))
+        return self.job(row[0])
+
+    def update(self, jobId, **fields):
+        """Set the `fields` of the job numbered `jobId`."""
+        if 'formats' in fields:
+            fields['formats'] = json.dumps(fields['formats']) if fields['formats'] else None
+        with self._lock, self._db:
+            self._db.execute('UPDATE jobs SET {} WHERE id = ?'.format(
+                ', '.join('{} = ?'.format(name) for name in fields)),
+                list(fields.values()) + [jobId])
+
+    def cancel(self, jobId):
+        """Cancel the job numbered `jobId` if it's still queued. Return
+        whether it was.
+        """
+        with self._lock, self._db:
+            cursor = self._db.execute('UPDATE jobs SET state = ?, finished = ? '
+                                      'WHERE id = ? AND state = ?',
+                                      (CANCELLED, time.time(), jobId, QUEUED))
+        return cursor.rowcount > 0
+
+    def recover(self):
+        """Queue up the jobs that were running when the daemon last stopped
+        again, and return how many there were. They're older than the rest of
+        the queued jobs, so they're the first to be started again.
+        """
+        with self._lock, self._db:
+            cursor = self._db.execute('UPDATE jobs SET state = ? WHERE state = ?',
+                                      (QUEUED, RUNNING))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Daemon(object):
+    """Downloads the soundtracks queued up in `queue` (a JobQueue), `albumJobs`
+    at a time, into `path` - or into the directories in it that the jobs say.
+
+    All of its downloads share one pool of workers, one limit of connections
+    per host, and khinsider's session and page cache, as with downloadMany -
+    so connections are kept open and pages cached from one job to the next.
+    See Soundtrack.download for the rest of the arguments.
+
+    Soundtracks are downloaded the same way as always, with what's already
+    been downloaded recorded in each one's Manifest, so a job that's started
+    again after the daemon's been stopped in the middle of it only has to
+    download what's left.
+    """
+
+    def __init__(self, queue, path='', albumJobs=DEFAULT_ALBUM_JOBS,
+                 resolveJobs=DEFAULT_RESOLVE_JOBS, jobs=DEFAULT_JOBS,
+                 jobsPerHost=DEFAULT_JOBS_PER_HOST, guessUrls=False, adaptive=False,
+                 bandwidth=None, segments=1, verbose=False):
+        self.queue = queue
+        self.path = path
+        self.albumJobs = albumJobs
+        self.resolveJobs = resolveJobs
+        self.jobs = jobs
+        self.jobsPerHost = jobsPerHost
+        self.guessUrls = guessUrls
+        self.adaptive = adaptive
+        self.segments = segments
+        self.verbose = verbose
+        self._executor = ThreadPoolExecutor(max_workers=maxJobs(max(resolveJobs, jobs, 1), adaptive))
+        self._limiter = HostLimiter(jobsPerHost, adaptive)
+        self._resolveLimiter = HostLimiter(resolveJobs, adaptive)
+        self._bandwidth = bandwidthLimiter(bandwidth)
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._workers = []
+        # How far along each running job's files are, by job and file index.
+        self._progress = {}
+
+    def start(self):
+        """Start downloading, resuming whatever was being downloaded when
+        the daemon last stopped.
+        """
+        recovered = self.queue.recover()
+        if recovered and self.verbose:
+            unicodePrint("Resuming {} unfinished job{}.".format(recovered, "" if recovered == 1 else "s"))
+        for _ in range(max(self.albumJobs, 1)):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        return self
+
+    def stop(self):
+        """Stop taking new jobs, and stop the running ones where they are.
+        They're left running in the queue, so they're resumed next time.
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._executor.shutdown(wait=False)
+
+    def add(self, soundtrackId, path=None, formatOrder=None):
+        """Queue up a download of the soundtrack `soundtrackId` into `path`
+        and return the job. Raise KhinsiderError if `path` isn't in the
+        daemon's download directory.
+        """
+        job = self.queue.add(soundtrackId, self.jobPath(path), formatOrder)
+        with self._condition:
+            self._condition.notify()
+        return job
+
+    def status(self, jobId=None):
+        """Return the job numbered `jobId` (or None if there isn't one), or
+        every job if it's None - with `bytes` including the files that are
+        still being downloaded.
+        """
+        jobs = self.queue.jobs() if jobId is None else [self.queue.job(jobId)]
+        for job in jobs:
+            progress = self._progress.get(job['id']) if job is not None else None
+            if progress is not None:
+                job['bytes'] += sum(list(progress.values()))
+        return jobs if jobId is None else jobs[0]
+
+    def jobPath(self, path=None):
+        """Return where a job that asks to be downloaded into `path` (relative
+        to the download directory, or absolute) goes, or raise
+        KhinsiderError if that's not in the download directory.
+        """
+        root = os.path.realpath(self.path or os.curdir)
+        if path is None:
+            return root
+        jobPath = os.path.realpath(os.path.join(root, path))
+        if jobPath != root and not jobPath.startswith(root.rstrip(os.sep) + os.sep):
+            raise KhinsiderError("{} isn't in the download directory ({}).".format(path, root))
+        return jobPath
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopping:
+                        return
+                    job = self.queue.claim()
+                    if job is not None:
+                        break
+                    self._condition.wait()
+            self._run(job)
+
+    def _run(self, job):
+        jobId = job['id']
+        progress = self._progress[jobId] = {}
+        # Files that were downloaded before a restart are SKIPPED this time,
+        # so they're counted all the same.
+        counts = {'filesDone': 0, 'filesFailed': 0, 'bytes': 0}
+        lock = threading.Lock()
+        def events(event):
+            with lock:
+                if event.type == FILE_STARTED:
+                    progress[event.index] = 0
+                elif event.type == PROGRESS:
+                    progress[event.index] = event.bytes
+                elif event.type in (SKIPPED, DONE):
+                    progress.pop(event.index, None)
+                    if event.type == SKIPPED and event.reason == 'nonexistent':
+                        counts['filesFailed'] += 1
+                    elif event.type == DONE and not event.success:
+                        counts['filesFailed'] += 1
+                    else:
+                        counts['filesDone'] += 1
+                        counts['bytes'] += event.bytes or 0
+                    self.queue.update(jobId, files=event.total, **counts)
+
+        soundtrack = Soundtrack(job['soundtrack'])
+        if self.verbose:
+            unicodePrint("Starting job {} ({}).".format(jobId, job['soundtrack']))
+        error = None
+        try:
+            albumPath = os.path.join(job['path'] or '', to_valid_filename(soundtrack.name))
+            result = soundtrack.download(albumPath, True, job['formats'], False,
+                                         self.resolveJobs, self.jobs, self.jobsPerHost,
+                                         self.guessUrls, self._executor, self._limiter,
+                                         events, self.adaptive, self._bandwidth,
+                                         self._resolveLimiter, self.segments)
+        except (KhinsiderError, SoundtrackError, requests.RequestException,
+                EnvironmentError) as e:
+            result = False
+            error = str(e)
+        except Exception as e:
+            # Whatever went wrong, the job's over, and the worker carries on.
+            if not self._stopping:
+                traceback.print_exc()
+            result = False
+            error = "Unexpected error: {!r}".format(e)
+        finally:
+            self._progress.pop(jobId, None)
+        if not result and self._stopping:
+            # Most likely cut short by stop() - it's left running, to be
+            # resumed next time.
+            if self.verbose:
+                unicodePrint("Job {} ({}) stopped.".format(jobId, job['soundtrack']))
+            return
+        self.queue.update(jobId, state=FINISHED if result else FAILED,
+                          finished=time.time(), error=error)
+        if self.verbose:
+            unicodePrint("Job {} ({}) {}.".format(
+                jobId, job['soundtrack'], "finished" if result else "failed"))
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    """The daemon's API. Everything is JSON:
+    * GET /jobs:         {"jobs": [every job]}
+    * GET /jobs/ID:      The job (see JobQueue).
+    * POST /jobs:        Add a job, given {"soundtrack": ID} and optionally
+                         "path" (in the daemon's download directory) and
+                         "formats" (a list of extensions). Responds with the job.
+    * DELETE /jobs/ID:   Cancel a job that hasn't started yet.
+
+    If the server has a `token` (see serve), every request needs an
+    "Authorization: Bearer TOKEN" header. Requests for hosts other than IP
+    addresses, LOCAL_HOSTNAMES and the server's own `hostname` are refused.
+    """
+
+    JOB_PATH_RE = re.compile(r'^/jobs/([0-9]+)$')
+    HOST_RE = re.compile(r'^(\[[0-9a-fA-F:.]+\]|[^:]*)(:[0-9]+)?$')
+    IP_RE = re.compile(r'^([0-9.]+|\[[0-9a-fA-F:.]+\])$')
+
+    def log_message(self, format, *args):
+        if self.server.daemon.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def address_string(self):
+        # Unix sockets don't have addresses to speak of.
+        return self.client_address[0] if self.client_address else 'local'
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        """Return whether the request may be answered - if not, respond
+        saying why.
+        """
+        m = self.HOST_RE.match(self.headers.get('Host') or '')
+        hostname = m.group(1).lower() if m is not None else ''
+        if not (self.IP_RE.match(hostname) or hostname in LOCAL_HOSTNAMES or
+                hostname == self.server.hostname):
+            self.respond(403, {'error': "Unexpected Host header."})
+            return False
+        token = self.server.token
+        if token is not None:
+            given = self.headers.get('Authorization') or ''
+            if not hmac.compare_digest(given.encode('utf-8'), 'Bearer {}'.format(token).encode('utf-8')):
+                self.respond(401, {'error': "Missing or wrong token."})
+                return False
+        return True
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        daemon = self.server.daemon
+        if self.path == '/jobs':
+            return self.respond(200, {'jobs': daemon.status()})
+        m = self.JOB_PATH_RE.match(self.path)
+        job = daemon.status(int(m.group(1))) if m is not None else None
+        if job is None:
+            return self.respond(404, {'error': "No such job."})
+        self.respond(200, job)
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.path != '/jobs':
+            return self.respond(404, {'error': "Jobs are added at /jobs."})
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+            soundtrackId = data['soundtrack']
+            path = data.get('path')
+            formats = data.get('formats')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self.respond(400, {'error': "Expected {\"soundtrack\": ID}."})
+        if not isinstance(soundtrackId, textType) or not soundtrackId:
+            return self.respond(400, {'error': "\"soundtrack\" should be a soundtrack's ID."})
+        if path is not None and not isinstance(path, textType):
+            return self.respond(400, {'error': "\"path\" should be a string."})
+        if formats is not None and not (isinstance(formats, list) and
+                                        all(isinstance(format, textType) for format in formats)):
+            return self.respond(400, {'error': "\"formats\" should be a list of extensions."})
+        try:
+            job = self.server.daemon.add(soundtrackId, path, formats)
+        except KhinsiderError as e:
+            return self.respond(400, {'error': str(e)})
+        self.respond(201, job)
+
+    def do_DELETE(self):
+        if not self.authorized():
+            return
+        m = self.JOB_PATH_RE.match(self.path)
+        daemon = self.server.daemon
+        if m is None or daemon.queue.job(int(m.group(1))) is None:
+            return self.respond(404, {'error': "No such job."})
+        if not daemon.queue.cancel(int(m.group(1))):
+            return self.respond(409, {'error': "Only jobs that haven't started can be cancelled."})
+        self.respond(200, daemon.status(int(m.group(1))))
+
+
+class DaemonServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class UnixDaemonServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def isSocketPath(address):
+    """Return whether `address` is the path of a Unix socket, rather than a
+    host and port.
+    """
+    return '/' in address or address.endswith('.sock')
+
+def hostAndPort(address):
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+def makeServer(daemon, address=DEFAULT_ADDRESS, tokenPath=None):
+    """Return a server for `daemon`'s API at `address` (as for serve)."""
+    if isSocketPath(address):
+        if os.path.exists(address):
+            os.remove(address) # Left over from last time.
+        server = UnixDaemonServer(address, DaemonHandler)
+        # Only the user running the daemon may connect to it.
+        os.chmod(address, 0o600)
+        server.hostname = 'localhost'
+        server.token = None
+    else:
+        server = DaemonServer(hostAndPort(address), DaemonHandler)
+        server.hostname = hostAndPort(address)[0].lower()
+        server.token = makeToken(tokenPath)
+    server.daemon = daemon
+    return server
+
+def serve(daemon, address=DEFAULT_ADDRESS, tokenPath=None):
+    """Start `daemon` and answer its API at `address` - either "host:port"
+    or the path of a Unix socket - until interrupted.
+
+    A Unix socket can only be used by the user running the daemon. On a
+    port, a new token is saved to `tokenPath` (by default, in the cache
+    directory) each time, and requests without it are refused - see
+    DaemonClient.
+    """
+    server = makeServer(daemon, address, tokenPath)
+    daemon.start()
+    try:
+        server.serve_forever()
+    finally:
+        daemon.stop()
+        server.server_close()
+        if isSocketPath(address) and os.path.exists(address):
+            os.remove(address)
+
+
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, path, timeout=10):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socketPath = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketPath)
+
+
+class DaemonClient(object):
+    """Talks to a daemon at `address` (as for serve), using the token saved
+    at `tokenPath` if it's on a port.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, tokenPath=None):
+        self.address = address
+        self.tokenPath = tokenPath
+
+    def request(self, method, path, data=None):
+        """Make a request to the API and return the status and the response."""
+        headers = {}
+        if isSocketPath(self.address):
+            connection = UnixHTTPConnection(self.address)
+        else:
+            host, port = hostAndPort(self.address)
+            connection = HTTPConnection(host, port, timeout=10)
+            # Read each time, since the daemon makes a new one when it starts.
+            token = readToken(self.tokenPath)
+            if token is not None:
+                headers['Authorization'] = 'Bearer {}'.format(token)
+        try:
+            body = json.dumps(data).encode('utf-8') if data is not None else None
+            if body is not None:
+                headers['Content-Type'] = 'application/json'
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read().decode('utf-8'))
+        finally:
+            connection.close()
+
+    def add(self, soundtrackId, path=None, formatOrder=None):
+        data = {'soundtrack': soundtrackId}
+        if path is not None:
+            # The daemon isn't necessarily running in the same directory.
+            data['path'] = os.path.abspath(path)
+        if formatOrder:
+            data['formats'] = formatOrder
+        return self._check(*self.request('POST', '/jobs', data))
+
+    def jobs(self):
+        return self._check(*self.request('GET', '/jobs'))['jobs']
+
+    def job(self, jobId):
+        return self._check(*self.request('GET', '/jobs/{}'.format(jobId)))
+
+    def cancel(self, jobId):
+        return self._check(*self.request('DELETE', '/jobs/{}'.format(jobId)))
+
+    def _check(self, status, data):
+        if status >= 400:
+            raise KhinsiderError(data.get('error', "The daemon responded with {}.".format(status)))
+        return data
+
+
+def printJobs(jobs, file=sys.stdout):
+    """Print a line about each of the jobs `jobs`."""
+    s = ""
+    for job in jobs:
+        files = "{}/{} files".format(job['filesDone'], job['files']) if job['files'] else "? files"
+        if job['filesFailed']:
+            files += ", {} failed".format(job['filesFailed'])
+        s += "{:>4} {:<10} {} ({}, {}){}\n".format(
+            job['id'], job['state'], job['soundtrack'], files,
+            khinsider.formatSize(job['bytes']),
+            ": " + job['error'] if job['error'] else "")
+    unicodePrint(s or "No jobs.\n", end="", file=file)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Download soundtracks from KHInsider in the background.",
+        epilog="Start the daemon with \"khinsider_daemon.py serve\", and then add soundtracks to "
+        "download with \"khinsider_daemon.py add jumping-flash mother-3\".")
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, metavar="ADDRESS",
+                        help="Where the daemon listens: HOST:PORT, or the path of a Unix socket "
+                        "(default: {}).".format(DEFAULT_ADDRESS))
+    parser.add_argument('--token-file', default=None, metavar="FILE",
+                        help="Where the daemon saves the token requests to a port need "
+                        "(default: in the cache directory).")
+    commands = parser.add_subparsers(dest='command', metavar="command")
+    commands.required = True
+
+    serveParser = commands.add_parser('serve', help="Run the daemon.")
+    serveParser.add_argument('path', nargs='?', default='', metavar="download directory",
+                             help="Where to download soundtracks to (default: the current directory).")
+    serveParser.add_argument('--queue', default=None, metavar="FILE",
+                             help="The job queue's database (default: in the cache directory).")
+    serveParser.add_argument('--album-jobs', type=int, default=DEFAULT_ALBUM_JOBS, metavar="N",
+                             help="Soundtracks to download at once (default: {}).".format(DEFAULT_ALBUM_JOBS))
+    serveParser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS, metavar="N",
+                             help="Files to download at once (default: {}).".format(DEFAULT_JOBS))
+    serveParser.add_argument('--segments', type=int, default=1, metavar="N",
+                             help="Download big files in N parts at once.")
+    serveParser.add_argument('--adaptive', action='store_true',
+                             help="Adapt how much is downloaded at once to how the servers are doing.")
+    serveParser.add_argument('--dedupe', action='store_true',
+                             help="Link to files that have already been downloaded instead of downloading "
+                             "them again (see khinsider.py --help).")
+    serveParser.add_argument('-v', '--verbose', action='store_true',
+                             help="Print jobs starting and finishing, and the API's requests.")
+
+    addParser = commands.add_parser('add', help="Queue up soundtracks to download.")
+    addParser.add_argument('soundtracks', nargs='+', metavar="soundtrack",
+                           help="The ID of a soundtrack to download.")
+    addParser.add_argument('-o', '--output', default=None, metavar="DIRECTORY",
+                           help="Where to download them to (default: the daemon's directory).")
+    addParser.add_argument('-f', '--format', default=None, metavar="...",
+                           help="The file format(s) in order of preference, as for khinsider.py.")
+
+    statusParser = commands.add_parser('status', help="Show how the jobs are doing.")
+    statusParser.add_argument('job', type=int, nargs='?', help="Only show this job.")
+
+    cancelParser = commands.add_parser('cancel', help="Cancel a job that hasn't started yet.")
+    cancelParser.add_argument('job', type=int)
+
+    arguments = parser.parse_args()
+
+    if arguments.command == 'serve':
+        try:
+            queue = JobQueue(arguments.queue)
+        except (KhinsiderError, EnvironmentError) as e:
+            print("Couldn't open the job queue: {}".format(e), file=sys.stderr)
+            return 1
+        if arguments.dedupe:
+            try:
+                khinsider.setContentStore(khinsider.ContentStore())
+            except KhinsiderError as e:
+                print("Couldn't use the content store: {}".format(e), file=sys.stderr)
+                return 1
+        khinsider.setSession(khinsider.makeSession(
+            poolSize(arguments.jobs, arguments.segments, arguments.adaptive)))
+        daemon = Daemon(queue, arguments.path, arguments.album_jobs, jobs=arguments.jobs,
+                        adaptive=arguments.adaptive, segments=arguments.segments,
+                        verbose=arguments.verbose)
+        print("Listening at {}.".format(arguments.address))
+        try:
+            serve(daemon, arguments.address, arguments.token_file)
+        except KeyboardInterrupt:
+            print("Stopped. Unfinished jobs will be resumed next time.", file=sys.stderr)
+        except EnvironmentError as e:
+            print("Couldn't listen at {}: {}".format(arguments.address, e), file=sys.stderr)
+            return 1
+        return 0
+
+    client = DaemonClient(arguments.address, arguments.token_file)
+    try:
+        if arguments.command == 'add':
+            formatOrder = None
+            if arguments.format:
+                formatOrder = [extension.lower() for extension in re.split(r',\s*', arguments.format)]
+            for soundtrackId in arguments.soundtracks:
+                job = client.add(soundtrackId, arguments.output, formatOrder)
+                unicodePrint("Added {} as job {}.".format(soundtrackId, job['id']))
+        elif arguments.command == 'status':
+            printJobs(client.jobs() if arguments.job is None else [client.job(arguments.job)])
+        elif arguments.command == 'cancel':
+            client.cancel(arguments.job)
+            print("Cancelled job {}.".format(arguments.job))
+    except KhinsiderError as e:
+        print(e, file=sys.stderr)
+        return 1
+    except (socket.error, EnvironmentError) as e:
+        print("Couldn't reach the daemon at {}: {}".format(arguments.address, e), file=sys.stderr)
+        print("Is it running? Start it with \"khinsider_daemon.py serve\".", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,838 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Tests for khinsider.py, run against benchmark.py's local stand-in for
+# KHInsider - no internet connection needed. Run with
+# "python -m unittest test_khinsider" (or pytest).
+
+from __future__ import unicode_literals
+
+import errno
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+import requests
+
+import benchmark
+import khinsider
+import khinsider_daemon
+from khinsider_daemon import FAILED, FINISHED, QUEUED, RUNNING
+
+try:
+    import asyncio
+    import khinsider_async
+except (ImportError, SyntaxError): # No aiohttp, or Python 2.
+    khinsider_async = None
+
+
+class StandInTestCase(unittest.TestCase):
+    """Points khinsider at a stand-in server for the tests in the class."""
+
+    # Passed on to benchmark.StandIn.
+    standInOptions = {}
+
+    @classmethod
+    def setUpClass(cls):
+        options = dict({'fileSize': 64 * 1024, 'latency': 0.0}, **cls.standInOptions)
+        cls.standIn = benchmark.StandIn(**options)
+        cls.server = benchmark.StandInServer(cls.standIn).start()
+        cls._baseUrl = khinsider.BASE_URL
+        cls._pageCache = khinsider.getPageCache()
+        khinsider.BASE_URL = cls.server.url
+        khinsider.setPageCache(None)
+
+    @classmethod
+    def tearDownClass(cls):
+        khinsider.BASE_URL = cls._baseUrl
+        khinsider.setPageCache(cls._pageCache)
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def makeDirectory(self):
+        """Return a new temporary directory that's removed after the test."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        return directory
+
+    def url(self, path):
+        return self.server.url + path
+
+
+class RecordingSession(requests.Session):
+    """A session that keeps the method and headers of each request."""
+
+    def __init__(self):
+        super(RecordingSession, self).__init__()
+        self.requests = []
+
+    def request(self, method, url, *args, **kwargs):
+        self.requests.append((method, url, dict(kwargs.get('headers') or {})))
+        return super(RecordingSession, self).request(method, url, *args, **kwargs)
+
+    def ranges(self):
+        return [headers['Range'] for method, url, headers in self.requests if 'Range' in headers]
+
+    def urls(self, method='GET'):
+        return [url for requestMethod, url, headers in self.requests if requestMethod == method]
+
+
+class PageCacheTest(StandInTestCase):
+    def setUp(self):
+        self.listUrl = self.url('game-soundtracks/browse/A')
+
+    def testFreshPageNotFetched(self):
+        cache = khinsider.PageCache(self.makeDirectory())
+        session = RecordingSession()
+        first = khinsider.getPage(self.listUrl, session, cache)
+        second = khinsider.getPage(self.listUrl, session, cache)
+        self.assertEqual(len(session.requests), 1)
+        self.assertEqual(first.content, second.content)
+
+    def testStalePageRevalidated(self):
+        cache = khinsider.PageCache(self.makeDirectory(), ttl=0)
+        session = RecordingSession()
+        content = khinsider.getPage(self.listUrl, session, cache).content
+        page = khinsider.getPage(self.listUrl, session, cache)
+        self.assertEqual(session.requests[1][2]['If-None-Match'], self.standIn.listEtag('A'))
+        self.assertIsInstance(page, khinsider.CachedPage) # The server said 304.
+        self.assertEqual(page.content, content)
+
+        self.standIn.changeList('A')
+        self.addCleanup(setattr, self.standIn, 'listVersions', dict(self.standIn.listVersions))
+        self.assertNotEqual(khinsider.getPage(self.listUrl, session, cache).content, content)
+
+    def testLeastRecentlyUsedEvicted(self):
+        cache = khinsider.PageCache(self.makeDirectory())
+        for letter in 'ABC':
+            khinsider.getPage(self.url('game-soundtracks/browse/' + letter), cache=cache)
+            time.sleep(0.05) # Far enough apart for any filesystem's timestamps.
+        size = sum(size for _, size, _ in cache._entries())
+        cache.get(self.url('game-soundtracks/browse/A')) # A's now used more recently than B.
+        time.sleep(0.05)
+        cache.maxSize = size - 1
+        khinsider.getPage(self.url('game-soundtracks/browse/D'), cache=cache)
+        self.assertIsNotNone(cache.get(self.url('game-soundtracks/browse/A')))
+        self.assertIsNone(cache.get(self.url('game-soundtracks/browse/B')))
+
+
+class ParsingTest(StandInTestCase):
+    def testBrokenAmpersandsFixed(self):
+        # KHInsider doesn't escape "&#" that aren't character references.
+        soup = khinsider.toSoup(b'<p>Album &#Stand-In &#38; &#x26; Co.</p>')
+        self.assertEqual(soup.get_text(), "Album &#Stand-In & & Co.")
+
+    def testAlbumPage(self):
+        soundtrack = khinsider.Soundtrack('album-5')
+        self.assertEqual(soundtrack.name, "Album &#album-5 Stand-In")
+        self.assertEqual(soundtrack.availableFormats, ['mp3', 'flac'])
+        self.assertEqual([song.name for song in soundtrack.songs],
+                         [benchmark.trackName(i) for i in range(1, 6)])
+
+    def testSongPage(self):
+        page = self.standIn.songPage('album-5', benchmark.trackName(2) + '.mp3')
+        self.assertEqual(khinsider.songName(page), benchmark.trackName(2))
+        urls = khinsider.songFileUrls(page)
+        self.assertEqual([khinsider.urlFilename(url) for url in urls],
+                         [benchmark.trackName(2) + '.mp3', benchmark.trackName(2) + '.flac'])
+
+    def testParsePool(self):
+        pool = khinsider.makeParsePool(2)
+        self.addCleanup(pool.shutdown)
+        context = getattr(pool, '_mp_context', None)
+        if context is not None:
+            # Forking from a thread that isn't the only one can deadlock.
+            self.assertNotEqual(context.get_start_method(), 'fork')
+        khinsider.setParsePool(pool)
+        self.addCleanup(khinsider.setParsePool, None)
+
+        soundtrack = khinsider.Soundtrack('album-5')
+        songs = soundtrack.songs
+        files = khinsider.boundedMap(lambda song: [file.url for file in song.files], songs, 5)
+        self.assertEqual([len(urls) for urls in files], [2] * 5)
+
+
+class ManifestTest(StandInTestCase):
+    def download(self, directory, formatOrder=('mp3',)):
+        events = []
+        session = RecordingSession()
+        soundtrack = khinsider.Soundtrack('album-3', session)
+        self.assertTrue(soundtrack.download(directory, formatOrder=list(formatOrder),
+                                            events=events.append))
+        return events, session
+
+    def testCompleteFilesSkipped(self):
+        directory = self.makeDirectory()
+        self.download(directory)
+        events, session = self.download(directory)
+        self.assertEqual(set(event.reason for event in events if event.type == khinsider.SKIPPED),
+                         set(['exists']))
+        # Which files the songs are is in the manifest too, so no song pages are fetched.
+        self.assertEqual([url for url in session.urls() if '/album/album-3/' in url], [])
+
+    def testIncompleteFileDownloadedAgain(self):
+        directory = self.makeDirectory()
+        self.download(directory)
+        path = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                if name.endswith('.mp3')][0]
+        with open(path, 'r+b') as f:
+            f.truncate(1000)
+        events, session = self.download(directory)
+        self.assertEqual([os.path.basename(path)],
+                         [event.filename for event in events
+                          if event.type == khinsider.FILE_STARTED and event.redownload])
+        self.assertEqual(os.path.getsize(path), self.standIn.fileSize)
+
+    def testOtherFormatOrderIgnored(self):
+        directory = self.makeDirectory()
+        self.download(directory)
+        events, session = self.download(directory, ('flac', 'mp3'))
+        self.assertEqual(len([event for event in events if event.type == khinsider.SONG_RESOLVED]), 3)
+
+
+class BusyOnce(RecordingSession):
+    """A session that answers the first HEAD request with a 503 itself."""
+
+    def request(self, method, url, *args, **kwargs):
+        if method == 'HEAD' and not self.urls('HEAD'):
+            self.requests.append((method, url, {}))
+            response = requests.Response()
+            response.status_code, response.reason, response.url = 503, "Busy", url
+            response.headers['Retry-After'] = '0'
+            response._content = b''
+            return response
+        return super(BusyOnce, self).request(method, url, *args, **kwargs)
+
+
+class GuessUrlsTest(StandInTestCase):
+    def setUp(self):
+        self._retryPolicy = khinsider.getRetryPolicy()
+        khinsider.setRetryPolicy(khinsider.RetryPolicy(tries=3, backoff=0))
+        self.addCleanup(khinsider.setRetryPolicy, self._retryPolicy)
+
+    def download(self, session):
+        directory = self.makeDirectory()
+        soundtrack = khinsider.Soundtrack('album-10', session)
+        self.assertTrue(soundtrack.download(directory, formatOrder=['flac'], guessUrls=True))
+        self.assertEqual(len([name for name in os.listdir(directory) if name.endswith('.flac')]), 10)
+        return [url for url in session.urls() if '/album/album-10/' in url]
+
+    def testOnlySamplesLookedUp(self):
+        session = RecordingSession()
+        self.assertEqual(len(self.download(session)), khinsider.GUESS_SAMPLES)
+        self.assertEqual(len(session.urls('HEAD')), 10 - khinsider.GUESS_SAMPLES)
+
+    def testBusyServerTriedAgain(self):
+        # Rather than taken to mean the guess was wrong.
+        session = BusyOnce()
+        self.assertEqual(len(self.download(session)), khinsider.GUESS_SAMPLES)
+        self.assertEqual(len(session.urls('HEAD')), 10 - khinsider.GUESS_SAMPLES + 1)
+
+    def testGuessChecksTakeLimiterSlots(self):
+        limiter = khinsider.HostLimiter(1)
+        file = khinsider.File(self.url('soundtracks/album-10/a1b2c3d4/x.flac'))
+        limiter.acquire(file.url)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(file.isAvailable(limiter)))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive()) # Waiting for the slot.
+        limiter.release(file.url)
+        thread.join()
+        self.assertEqual(result, [True])
+
+
+def failing(errors, result=None):
+    """Return a function that raises each of `errors` in turn, then returns
+    `result`. How many times it's been called is in its `calls`.
+    """
+    errors = list(errors)
+    def func():
+        func.calls += 1
+        if errors:
+            raise errors.pop(0)
+        return result
+    func.calls = 0
+    return func
+
+def statusError(status, retryAfter=None):
+    response = requests.Response()
+    response.status_code = status
+    error = requests.HTTPError(response=response)
+    error.retryAfter = retryAfter
+    return error
+
+
+class RetryPolicyTest(unittest.TestCase):
+    url = 'http://example.com/a'
+
+    def setUp(self):
+        self.policy = khinsider.RetryPolicy(tries=3, backoff=0, failures=10)
+
+    def testTriedAgain(self):
+        retries = []
+        func = failing([requests.ConnectionError(), statusError(503)], 'done')
+        self.assertEqual(self.policy.call(self.url, func, lambda *args: retries.append(args)), 'done')
+        self.assertEqual(func.calls, 3)
+        self.assertEqual([tries for error, tries, delay in retries], [1, 2])
+
+    def testOnlyRetryableErrorsTriedAgain(self):
+        func = failing([statusError(404)])
+        self.assertRaises(requests.HTTPError, self.policy.call, self.url, func)
+        self.assertEqual(func.calls, 1)
+
+    def testGivenUp(self):
+        func = failing([requests.ConnectionError()] * 5)
+        with self.assertRaises(requests.ConnectionError) as context:
+            self.policy.call(self.url, func)
+        self.assertEqual(func.calls, 3)
+        self.assertTrue(context.exception.givenUp)
+        self.assertFalse(self.policy.isRetryable(context.exception))
+
+    def testTooLongRetryAfterNotWaitedFor(self):
+        func = failing([statusError(503, self.policy.maxDelay + 1)])
+        self.assertRaises(requests.HTTPError, self.policy.call, self.url, func)
+        self.assertEqual(func.calls, 1)
+
+    def testNestedCallsTriedOnce(self):
+        inner = failing([requests.ConnectionError()] * 2, 'done')
+        outer = lambda: self.policy.call(self.url, inner)
+        self.assertEqual(self.policy.call(self.url, outer), 'done')
+        self.assertEqual(inner.calls, 3)
+
+    def testCircuitBreaker(self):
+        policy = khinsider.RetryPolicy(tries=2, backoff=0, failures=3, cooldown=60)
+        # The server's there when it says it's busy.
+        for _ in range(3):
+            policy.call(self.url, failing([statusError(429, 0)]))
+        self.assertRaises(requests.ConnectionError, policy.call, self.url,
+                          failing([requests.ConnectionError()] * 2))
+
+        func = failing([requests.ConnectionError()] * 2)
+        self.assertRaises(khinsider.HostUnavailableError, policy.call, self.url, func)
+        self.assertEqual(func.calls, 1)
+        self.assertRaises(khinsider.HostUnavailableError, policy.call, self.url, func)
+        self.assertEqual(func.calls, 1)
+        self.assertEqual(policy.call('http://example.org/a', lambda: 'done'), 'done')
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    def testGrowsWhileServerKeepsUp(self):
+        limiter = khinsider.AdaptiveLimiter(2, 4)
+        for _ in range(20):
+            limiter.record(0.1)
+        self.assertEqual(int(limiter.limit), 4) # But no further.
+
+    def testHalvesWhenSlow(self):
+        limiter = khinsider.AdaptiveLimiter(4, 8)
+        limiter.record(0.01)
+        limiter.record(0.01 * khinsider.LATENCY_TOLERANCE * 10)
+        self.assertEqual(int(limiter.limit), 2)
+
+    def testBackOffPauses(self):
+        limiter = khinsider.AdaptiveLimiter(4, 8)
+        limiter.backOff(0.2)
+        self.assertEqual(limiter.limit, 2)
+        self.assertFalse(limiter.tryAcquire())
+        start = time.time()
+        limiter.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.15)
+        self.assertTrue(limiter.tryAcquire())
+        self.assertFalse(limiter.tryAcquire()) # Only 2 at once now.
+
+    def testFixedLimit(self):
+        limiter = khinsider.HostLimiter(2)
+        for _ in range(20):
+            limiter.record('http://a/', 0.1)
+        self.assertTrue(limiter.tryAcquire('http://a/'))
+        self.assertTrue(limiter.tryAcquire('http://a/'))
+        self.assertFalse(limiter.tryAcquire('http://a/'))
+        self.assertTrue(limiter.tryAcquire('http://b/')) # Each host has its own.
+
+
+class BandwidthLimiterTest(unittest.TestCase):
+    def testSharedLimit(self):
+        limiter = khinsider.BandwidthLimiter(1000)
+        start = time.time()
+        threads = [threading.Thread(target=limiter.consume, args=(100,)) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.time() - start, 0.25)
+
+
+class EventsTest(StandInTestCase):
+    def testEveryFileFinishesOnce(self):
+        events = []
+        soundtrack = khinsider.Soundtrack('album-3')
+        self.assertTrue(soundtrack.download(self.makeDirectory(), formatOrder=['mp3'],
+                                            events=events.append))
+        types = [event.type for event in events]
+        self.assertEqual(types[:2], [khinsider.ALBUM_STARTED, khinsider.ALBUM_FETCHED])
+        self.assertTrue(events[0].fetching)
+        self.assertEqual(types.count(khinsider.SONG_RESOLVED), 3)
+        finished = [event.index for event in events
+                    if event.type in (khinsider.SKIPPED, khinsider.DONE)]
+        self.assertEqual(sorted(finished), [1, 2, 3, 4])
+        self.assertTrue(all(event.soundtrack == 'album-3' for event in events))
+
+    def testSongListOnlyAnnouncedWhenFetched(self):
+        soundtrack = khinsider.Soundtrack('album-3')
+        for fetching in [True, False]:
+            out = io.StringIO()
+            printer = khinsider.ProgressPrinter(out=lambda *args, **kwargs: out.write(args[0] + '\n'))
+            soundtrack.download(self.makeDirectory(), formatOrder=['mp3'], events=printer)
+            self.assertEqual("Getting song list..." in out.getvalue(), fetching)
+
+    def testMetricsWriter(self):
+        path = os.path.join(self.makeDirectory(), 'metrics.jsonl')
+        with khinsider.MetricsWriter(path) as metrics:
+            khinsider.Soundtrack('album-2').download(self.makeDirectory(), formatOrder=['mp3'],
+                                                     events=metrics)
+        with open(path, 'rb') as f:
+            lines = [json.loads(line.decode('utf-8')) for line in f]
+        self.assertEqual(lines[0]['type'], khinsider.ALBUM_STARTED)
+        self.assertEqual(len([line for line in lines if line['type'] == khinsider.DONE]), 3)
+        self.assertTrue(all('time' in line for line in lines))
+
+
+class DownloadManyTest(StandInTestCase):
+    def testEachToItsOwnDirectory(self):
+        directory = self.makeDirectory()
+        events = []
+        results = khinsider.downloadMany(['album-2', 'album-3', 'album-2'], directory,
+                                         formatOrder=['mp3'], events=events.append)
+        self.assertEqual(list(results.items()), [('album-2', True), ('album-3', True)])
+        for soundtrackId, tracks in [('album-2', 2), ('album-3', 3)]:
+            albumPath = os.path.join(directory, "Album &#{} Stand-In".format(soundtrackId))
+            self.assertEqual(len([name for name in os.listdir(albumPath) if name.endswith('.mp3')]),
+                             tracks)
+            self.assertEqual(len([event for event in events if event.type == khinsider.DONE and
+                                  event.soundtrack == soundtrackId]), tracks + 1) # And the cover.
+
+    def testFailureOnlyStopsItsSoundtrack(self):
+        results = khinsider.downloadMany(['nonexistent', 'album-2'], self.makeDirectory(),
+                                         formatOrder=['mp3'])
+        self.assertIsInstance(results['nonexistent'], khinsider.NonexistentSoundtrackError)
+        self.assertIs(results['album-2'], True)
+
+
+class PlanTest(StandInTestCase):
+    def testOnlyAlbumPageNeeded(self):
+        session = RecordingSession()
+        plan = khinsider.Soundtrack('album-3', session).plan(['flac', 'mp3'])
+        self.assertEqual(session.urls(), [self.url('game-soundtracks/album/album-3')])
+        self.assertEqual(session.urls('HEAD'), [])
+
+        self.assertEqual(plan.tracks, 3)
+        self.assertEqual(plan.formats, ['flac'] * 3)
+        self.assertEqual(list(plan.bytesPerFormat), ['mp3', 'flac'])
+        # The album page rounds sizes to hundredths of a megabyte.
+        self.assertAlmostEqual(plan.totalBytes, 3 * 3 * self.standIn.fileSize, delta=3 * 10 * 1024)
+        self.assertEqual(plan.unknownSizes, 0)
+        self.assertEqual(plan.duration, 121 + 182 + 243)
+
+    def testPreferredFormatMissing(self):
+        plan = khinsider.Soundtrack('album-2').plan(['ogg'])
+        self.assertEqual(plan.formats, ['mp3', 'mp3']) # The first one there is.
+        self.assertEqual(plan.totalBytes, plan.bytesPerFormat['mp3'])
+
+
+class SearchTest(StandInTestCase):
+    def testResults(self):
+        results = khinsider.search('kirby', catalog=False, hydrate=True)
+        self.assertEqual(len(results[0]), 20)
+        self.assertTrue(all(soundtrack._isLoaded('songs') for soundtrack in results[0]))
+
+    def testRedirectToAlbum(self):
+        # KHInsider goes straight to the album when only one matches.
+        results = khinsider.search('album-3', catalog=False, hydrate=True)
+        self.assertEqual([soundtrack.id for soundtrack in results], ['album-3'])
+        self.assertTrue(results[0]._isLoaded('songs'))
+        self.assertEqual(len(results[0].songs), 3)
+
+        out = io.StringIO()
+        khinsider.printSearchResults(results, file=out)
+        self.assertIn("album-3", out.getvalue())
+        self.assertIn("3 tracks", out.getvalue())
+
+
+@unittest.skipIf(khinsider.sqlite3 is None, "needs sqlite3")
+class CatalogTest(StandInTestCase):
+    standInOptions = {'listSize': 4}
+
+    def setUp(self):
+        self.catalog = khinsider.Catalog(os.path.join(self.makeDirectory(), 'catalog.sqlite'))
+        self.addCleanup(self.catalog.close)
+        self.assertEqual(self.catalog.update(), len(benchmark.LETTERS))
+
+    def testSearch(self):
+        self.assertEqual(len(self.catalog), 4 * len(benchmark.LETTERS))
+        results = khinsider.search('b flas', catalog=self.catalog)
+        self.assertEqual([soundtrack.name for soundtrack in results[0]], ["B Flash Jumping 1"])
+        self.assertEqual(results[0][0].id, 'album-20001')
+        self.assertEqual(self.catalog.search('nothing like it'), [[], []])
+
+    def testOnlyChangedListsReadAgain(self):
+        session = RecordingSession()
+        self.assertEqual(self.catalog.update(session=session), 0)
+        listRequests = [headers for method, url, headers in session.requests if '/browse/' in url]
+        self.assertEqual(len(listRequests), len(benchmark.LETTERS))
+        self.assertTrue(all('If-None-Match' in headers for headers in listRequests))
+
+        self.addCleanup(setattr, self.standIn, 'listVersions', dict(self.standIn.listVersions))
+        self.standIn.changeList('B')
+        self.assertEqual(self.catalog.update(), 1)
+        self.assertEqual(len(self.catalog), 4 * len(benchmark.LETTERS) + 1)
+        self.assertEqual(len(self.catalog.search('b forever')[0]), 1)
+
+
+class FirstSegmentFails(RecordingSession):
+    """A session whose requests for the start of a file all fail."""
+
+    def request(self, method, url, *args, **kwargs):
+        byteRange = (kwargs.get('headers') or {}).get('Range')
+        if byteRange is not None and byteRange.startswith('bytes=0-'):
+            self.requests.append((method, url, kwargs['headers']))
+            raise requests.ConnectionError("Nope.")
+        return super(FirstSegmentFails, self).request(method, url, *args, **kwargs)
+
+
+class SegmentedDownloadTest(StandInTestCase):
+    def setUp(self):
+        self._retryPolicy = khinsider.getRetryPolicy()
+        khinsider.setRetryPolicy(khinsider.RetryPolicy(tries=3, backoff=0, failures=100))
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        khinsider.setRetryPolicy(self._retryPolicy)
+        shutil.rmtree(self.directory)
+
+    def testFailingSegmentOnlyTriedAgainOnItsOwn(self):
+        session = FirstSegmentFails()
+        file = khinsider.File(self.server.url + 'soundtracks/test/a1b2c3d4/bonus.zip', session)
+        self.assertFalse(khinsider.friendlyDownloadFile(file, self.directory, 1, 1, segments=4))
+        # The file's looked up once, and the first segment tried 3 times -
+        # not 3 times for each time the whole download is tried again.
+        self.assertEqual(len(session.urls('HEAD')), 1)
+        self.assertEqual([byteRange for byteRange in session.ranges()
+                          if byteRange.startswith('bytes=0-')],
+                         ['bytes=0-{}'.format(self.standIn.largeFileSize // 4 - 1)] * 3)
+
+    def download(self, perHost, segments):
+        session = RecordingSession()
+        file = khinsider.File(self.server.url + 'soundtracks/test/a1b2c3d4/bonus.zip', session)
+        limiter = khinsider.HostLimiter(perHost)
+        self.assertTrue(khinsider.friendlyDownloadFile(file, self.directory, 1, 1,
+                                                       limiter=limiter, segments=segments))
+        os.remove(os.path.join(self.directory, 'bonus.zip'))
+        # Every slot is given back.
+        self.assertEqual(limiter.limiter(file.url)._active, 0)
+        return session.ranges()
+
+    def testSegmentsTakeLimiterSlots(self):
+        self.assertEqual(len(self.download(2, 4)), 2)
+        self.assertEqual(len(self.download(4, 4)), 4)
+
+    def testNoSegmentsWithoutFreeSlots(self):
+        self.assertEqual(self.download(1, 4), [])
+
+
+class CountsConnections(RecordingSession):
+    """A session that keeps track of the most streamed responses it's had
+    open at once.
+    """
+
+    def __init__(self):
+        super(CountsConnections, self).__init__()
+        self.lock = threading.Lock()
+        self.open = 0
+        self.mostOpen = 0
+
+    def request(self, *args, **kwargs):
+        response = super(CountsConnections, self).request(*args, **kwargs)
+        if not kwargs.get('stream'):
+            return response
+        with self.lock:
+            self.open += 1
+            self.mostOpen = max(self.mostOpen, self.open)
+        close = response.close
+        def closeOnce():
+            if not response._counted:
+                response._counted = True
+                with self.lock:
+                    self.open -= 1
+            close()
+        response._counted = False
+        response.close = closeOnce
+        return response
+
+
+class ArchiveTest(StandInTestCase):
+    standInOptions = {'fileSize': 4 * khinsider.CHUNK_SIZE}
+    def testZip(self):
+        path = os.path.join(self.makeDirectory(), 'album-3')
+        self.assertTrue(khinsider.download('album-3', path, archiveFormat='zip'))
+        with zipfile.ZipFile(path + '.zip') as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual([info.file_size for info in archive.infolist()
+                              if info.filename.endswith('.mp3')], [self.standIn.fileSize] * 3)
+
+    def testTar(self):
+        path = os.path.join(self.makeDirectory(), 'album-3')
+        self.assertTrue(khinsider.download('album-3', path, archiveFormat='tar'))
+        with tarfile.open(path + '.tar') as archive:
+            songs = [member for member in archive.getmembers() if member.name.endswith('.mp3')]
+            self.assertEqual([member.size for member in songs], [self.standIn.fileSize] * 3)
+            self.assertEqual(archive.extractfile(songs[0]).read(),
+                             self.standIn.fileData(0, self.standIn.fileSize))
+
+    def testAbortedFileTakenBack(self):
+        for writerClass, read in [(khinsider.ZipWriter, lambda f: zipfile.ZipFile(f).namelist()),
+                                  (khinsider.TarWriter, lambda f: tarfile.open(fileobj=f).getnames())]:
+            f = io.BytesIO()
+            writer = writerClass(f)
+            for name, size in [('a', 4), ('b', None)]:
+                writer.begin(name, size)
+                writer.write(b'ab')
+                writer.abort()
+            writer.begin('c', 2)
+            writer.write(b'cd')
+            writer.end()
+            writer.close()
+            f.seek(0)
+            self.assertEqual(read(f), ['c'])
+
+    def testConnectionsOnlyOpenWithSlots(self):
+        session = CountsConnections()
+        files = [song.files[0] for song in khinsider.Soundtrack('album-4', session).songs]
+        del session.requests[:]
+        readAhead = khinsider.CHUNK_SIZE
+        writer = khinsider.ZipWriter(io.BytesIO())
+        self.assertTrue(khinsider.downloadToArchive(files, writer, jobs=4, jobsPerHost=1,
+                                                    readAhead=readAhead))
+        self.assertEqual(session.mostOpen, 1)
+        # The rest of each file is picked up where its read-ahead stopped.
+        self.assertEqual(session.ranges(), ['bytes={}-'.format(readAhead)] * 4)
+
+
+class FailsOnce(requests.Session):
+    """A session whose first request fails."""
+
+    def __init__(self):
+        super(FailsOnce, self).__init__()
+        self.requests = 0
+
+    def request(self, method, url, *args, **kwargs):
+        self.requests += 1
+        if self.requests == 1:
+            raise requests.ConnectionError("Nope.")
+        return super(FailsOnce, self).request(method, url, *args, **kwargs)
+
+
+class CantLink(khinsider.ContentStore):
+    def link(self, file, source, path, size, sha1):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+
+class ContentStoreTest(StandInTestCase):
+    def setUp(self):
+        self._retryPolicy = khinsider.getRetryPolicy()
+        khinsider.setRetryPolicy(khinsider.RetryPolicy(tries=3, backoff=0))
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        khinsider.setRetryPolicy(self._retryPolicy)
+        shutil.rmtree(self.directory)
+
+    def storeWithFile(self, storeClass, session=None):
+        file = khinsider.File(self.server.url + 'soundtracks/test/a1b2c3d4/01.mp3', session)
+        store = storeClass(os.path.join(self.directory, 'store.sqlite3'))
+        self.addCleanup(store.close)
+        first = os.path.join(self.directory, 'first')
+        os.mkdir(first)
+        self.assertTrue(khinsider.friendlyDownloadFile(file, first, 1, 1, store=store))
+        return file, store
+
+    def testProbeTriedAgain(self):
+        session = FailsOnce()
+        file, store = self.storeWithFile(khinsider.ContentStore)
+        file.session = session
+        self.assertIsNotNone(store.find(file))
+        self.assertEqual(session.requests, 2)
+
+    def testDownloadedIfLinkFails(self):
+        file, store = self.storeWithFile(CantLink)
+        second = os.path.join(self.directory, 'second')
+        os.mkdir(second)
+        self.assertTrue(khinsider.friendlyDownloadFile(file, second, 1, 1, store=store))
+        self.assertEqual(os.path.getsize(os.path.join(second, '01.mp3')),
+                         self.standIn.fileSize)
+
+
+@unittest.skipIf(khinsider_async is None, "needs Python 3.7+ and aiohttp")
+class AsyncTest(StandInTestCase):
+    def testDownloadResumed(self):
+        directory = self.makeDirectory()
+        events = []
+        self.assertTrue(asyncio.run(khinsider_async.download('album-3', directory, events=events.append)))
+        self.assertEqual(sum(event.success for event in events if event.type == khinsider.DONE), 4)
+
+        del events[:]
+        self.assertTrue(asyncio.run(khinsider_async.download('album-3', directory, events=events.append)))
+        self.assertEqual([event.type for event in events].count(khinsider.SKIPPED), 4)
+        self.assertNotIn(khinsider.SONG_RESOLVED, [event.type for event in events])
+
+    def testFailureReported(self):
+        events = []
+        file = khinsider_async.File(self.url('404'))
+        self.assertFalse(asyncio.run(khinsider_async.friendlyDownloadFile(
+            file, self.makeDirectory(), 1, 1, events=events.append)))
+        done = events[-1]
+        self.assertEqual(done.type, khinsider.DONE)
+        self.assertFalse(done.success)
+        self.assertIn("404", done.error)
+
+
+@unittest.skipIf(khinsider.sqlite3 is None, "needs sqlite3")
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.queue = khinsider_daemon.JobQueue(os.path.join(directory, 'queue.sqlite3'))
+        self.addCleanup(self.queue.close)
+
+    def testOldestClaimedFirst(self):
+        first = self.queue.add('album-1', '', ['flac', 'mp3'])
+        self.queue.add('album-2')
+        self.assertEqual(first['state'], QUEUED)
+        self.assertEqual(first['formats'], ['flac', 'mp3'])
+        self.assertEqual(self.queue.claim()['soundtrack'], 'album-1')
+        self.assertEqual(self.queue.claim()['soundtrack'], 'album-2')
+        self.assertIsNone(self.queue.claim())
+
+    def testOnlyQueuedJobsCancelled(self):
+        running = self.queue.add('album-1')
+        queued = self.queue.add('album-2')
+        self.queue.claim()
+        self.assertFalse(self.queue.cancel(running['id']))
+        self.assertTrue(self.queue.cancel(queued['id']))
+        self.assertIsNone(self.queue.claim())
+
+    def testRunningJobsRecovered(self):
+        job = self.queue.add('album-1')
+        self.queue.claim()
+        self.queue.update(job['id'], filesDone=1, bytes=10)
+        self.assertEqual(self.queue.recover(), 1)
+        job = self.queue.claim()
+        self.assertEqual((job['soundtrack'], job['filesDone'], job['bytes']), ('album-1', 1, 10))
+
+
+@unittest.skipIf(khinsider.sqlite3 is None, "needs sqlite3")
+class DaemonTest(StandInTestCase):
+    def setUp(self):
+        directory = self.makeDirectory()
+        self.root = os.path.realpath(self.makeDirectory())
+        self.queue = khinsider_daemon.JobQueue(os.path.join(directory, 'queue.sqlite3'))
+        self.addCleanup(self.queue.close)
+        self.daemon = khinsider_daemon.Daemon(self.queue, self.root)
+        self.addCleanup(self.daemon.stop)
+
+        tokenPath = os.path.join(directory, 'token')
+        server = khinsider_daemon.makeServer(self.daemon, '127.0.0.1:0', tokenPath)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.address = '127.0.0.1:{}'.format(server.server_address[1])
+        self.client = khinsider_daemon.DaemonClient(self.address, tokenPath)
+
+    def post(self, data, headers={}):
+        """POST `data` to /jobs with the token, and return the response's status."""
+        headers = dict(headers)
+        headers.setdefault('Authorization', 'Bearer {}'.format(khinsider_daemon.readToken(self.client.tokenPath)))
+        connection = khinsider_daemon.HTTPConnection(*khinsider_daemon.hostAndPort(self.address))
+        try:
+            connection.request('POST', '/jobs', json.dumps(data).encode('utf-8'), headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+    def waitFor(self, jobId, states, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            job = self.client.job(jobId)
+            if job['state'] in states:
+                return job
+            time.sleep(0.02)
+        self.fail("Job {} never got to {}.".format(jobId, states))
+
+    def testTokenRequired(self):
+        self.assertEqual(self.post({'soundtrack': 'album-1'}, {'Authorization': 'Bearer wrong'}), 401)
+        self.assertEqual(self.client.add('album-1')['state'], QUEUED)
+
+    def testOtherHostsRefused(self):
+        # Like from a web page whose domain has been pointed at 127.0.0.1.
+        self.assertEqual(self.post({'soundtrack': 'album-1'}, {'Host': 'example.com'}), 403)
+        self.assertEqual(self.post({'soundtrack': 'album-1'}, {'Host': 'localhost:1'}), 201)
+
+    def testOnlyIntoDownloadDirectory(self):
+        self.assertEqual(self.client.add('album-1', os.path.join(self.root, 'a'))['path'],
+                         os.path.join(self.root, 'a'))
+        self.assertEqual(self.post({'soundtrack': 'album-1', 'path': 'b'}), 201)
+        for path in [os.path.dirname(self.root), os.path.join(self.root, '..', 'c'), '../c']:
+            self.assertEqual(self.post({'soundtrack': 'album-1', 'path': path}), 400)
+        self.assertEqual([job['path'] for job in self.client.jobs()],
+                         [os.path.join(self.root, 'a'), os.path.join(self.root, 'b')])
+
+    def testBadJobsRefused(self):
+        for data in [{'soundtrack': 'album-1', 'formats': 'flac'},
+                     {'soundtrack': 'album-1', 'formats': ['flac', 1]},
+                     {'soundtrack': 'album-1', 'path': 1},
+                     {'soundtrack': ['album-1']},
+                     ['album-1']]:
+            self.assertEqual(self.post(data), 400)
+        self.assertEqual(self.client.jobs(), [])
+
+    def testJobDownloaded(self):
+        self.daemon.start()
+        job = self.waitFor(self.client.add('album-2')['id'], (FINISHED, FAILED))
+        self.assertEqual(job['state'], FINISHED)
+        self.assertEqual(job['filesFailed'], 0)
+        albumPath = os.path.join(self.root, 'Album &#album-2 Stand-In')
+        self.assertEqual(len([name for name in os.listdir(albumPath) if name.endswith('.mp3')]), 2)
+
+    def testStoppedJobResumedNextTime(self):
+        self.addCleanup(setattr, self.standIn, 'latency', self.standIn.latency)
+        self.standIn.latency = 0.05
+        self.daemon.start()
+        job = self.waitFor(self.client.add('album-40')['id'], (RUNNING, FINISHED, FAILED))
+        time.sleep(0.2)
+        self.daemon.stop()
+        for worker in self.daemon._workers:
+            worker.join(30)
+        self.assertEqual(self.queue.job(job['id'])['state'], RUNNING)
+        self.assertIsNone(self.queue.job(job['id'])['error'])
+        self.assertEqual(self.queue.recover(), 1)
+
+
+@unittest.skipIf(benchmark.tracemalloc is None, "tracemalloc isn't available")
+class MemoryTest(StandInTestCase):
+    def testFlatAsAlbumsGrow(self):
+        # Per track, a large album mustn't take up more than a small one.
+        benchmark.checkMemoryGrowth(20, 400, khinsider.DEFAULT_RESOLVE_JOBS)
+
+
+if __name__ == '__main__':
+    unittest.main()